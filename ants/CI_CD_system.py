@@ -1,12 +1,14 @@
 import logging
+import os
 from pathlib import Path
 
 import pytest
-import yaml
 from rich.logging import RichHandler
 
-from network_manager import ConfigureNetwork, DeconfigureNetwork
-from resource_manager import ResourceManager
+from ants.connection import connection_pool
+from ants.inventory import load_inventory
+from ants.network_manager import ConfigureNetwork, DeconfigureNetwork
+from ants.resource_manager import ResourceManager
 
 logging.basicConfig(
     format="{message}",
@@ -17,20 +19,20 @@ logging.basicConfig(
 )
 
 path_home = Path(Path.home(), 'python', 'auto_network_test_system')
-path_connection = Path(path_home, 'data', 'connection_data')
+path_metrics = Path(path_home, 'reports', 'metrics')
+# Tests and their pytest.ini are in the ants directory
+path_tests = Path(__file__).resolve().parent
 
 
+# Run from the repository root: python -m ants.CI_CD_system
 if __name__ == "__main__":
-    with open(f"{path_connection}/devices.yaml", encoding="UTF-8") as file:
-        devices = yaml.safe_load(file)
+    # Metrics of device I/O of the run (including the tests run by pytest) are saved at exit
+    os.environ.setdefault("ANTS_METRICS_DIR", str(path_metrics))
+    # devices.yaml and network_params_for_test.yaml are parsed once and cached between runs
+    inventory = load_inventory()
+    devices_connection_data_dict = inventory.devices_connection_data
 
-    devices_connection_data_dict = {}
-
-    for _, device in devices.items():
-        for keys, values in device.items():
-            devices_connection_data_dict[keys] = values
-
-    resource_manager = ResourceManager()
+    resource_manager = ResourceManager(inventory=inventory)
     all_devices_for_test = resource_manager.get_all_devices_for_test()
     network_params = resource_manager.get_network_params_for_test()
 
@@ -41,6 +43,9 @@ if __name__ == "__main__":
     logging.info(">>>>> Tests with options %s start <<<<<", options_for_test)
     # опция -s включает отображение logging при запуске pytest
     # опция -v включает нормальное отображение тестов в pytest
-    retcode = pytest.main(["-s", "-v", "-m", options_for_test])
-    deconfigure_network = DeconfigureNetwork(devices_connection_data_dict, all_devices_for_test, network_params)
-
+    retcode = pytest.main(["-s", "-v", "-m", options_for_test, str(path_tests)])
+    # Only the objects changed by ConfigureNetwork are returned to the state before the test
+    deconfigure_network = DeconfigureNetwork(devices_connection_data_dict, all_devices_for_test, network_params,
+                                             snapshot=сonfigure_network.snapshot,
+                                             snapshot_id=сonfigure_network.snapshot_id)
+    connection_pool.close_all()
@@ -1,12 +1,7 @@
 import pytest
-import yaml
-from pathlib import Path
 
 from ants.auto_tests.timestamp_replacement.tsins import timestamp_test_with_rpi, configure_device, is_valid_mac
-
-path_home = Path(Path.home(), 'python', 'auto_network_test_system')
-path_connection = Path(path_home, 'data', 'connection_data')
-path_test_network = Path(path_home, 'data', 'network_test_configs')
+from ants.inventory import load_inventory
 
 
 @pytest.fixture
@@ -28,19 +23,12 @@ def wrong_tsins_device_dict():
 
 @pytest.fixture
 def device_connection_data_dict():
-    with open(f"{path_connection}/devices.yaml") as file:
-        devices = yaml.safe_load(file)
-    devices_connection_data_dict = {}
-    for _, device in devices.items():
-        for keys, values in device.items():
-            devices_connection_data_dict[keys] = values
-    return devices_connection_data_dict
+    return load_inventory().connection_data_dict()
 
 @pytest.fixture
 def network_params():
-    with open(f"{path_test_network}/network_params_for_test.yaml") as file:
-        network_params = yaml.safe_load(file)
-    return network_params
+    # A copy: the fixtures with wrong params change it
+    return load_inventory().network_params_dict()
 
 @pytest.fixture
 def wrong_rpi_src_vlan(correct_tsins_device_dict, network_params):
@@ -21,7 +21,6 @@ the last one is configured with erspan, which redirects packets to the ntp serve
 """
 import logging
 import re
-import time
 from datetime import datetime
 from pathlib import Path
 import socket
@@ -34,7 +33,7 @@ import yaml
 from rich.logging import RichHandler
 from jinja2 import Environment, FileSystemLoader
 
-from ants.connection import BaseSSHParamiko, SFTPParamiko
+from ants.connection import ErrorInConnectionException, klish_session, metrics, open_sftp, open_ssh
 
 logging.basicConfig(
     format="{message}",
@@ -133,22 +132,25 @@ def timestamp_test_with_rpi(devices_connection_data: dict, tsins_device: dict,
 
     logging.info("-" * 100)
     logging.info("TEST timestamp_test_with_rpi STARTED")
-    with BaseSSHParamiko(**devices_connection_data[rpi_src]) as cl_src:
-        with BaseSSHParamiko(**devices_connection_data[rpi_dst]) as cl_dst:
+    with open_ssh(**devices_connection_data[rpi_src]) as cl_src:
+        with open_ssh(**devices_connection_data[rpi_dst]) as cl_dst:
             cl_dst.send_shell_commands(
                 ["cd /home/pi/", "mkdir tests", "cd tests", "mkdir tsins", "cd tsins", "mkdir short_tests", "cd short_tests"]
             )
             output_dst = cl_dst.send_shell_commands(
                 f"tcpdump -i {intf_src}.{vlan_src} -c {count_of_packets} udp  -w "
                 f"{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}"
-                f"_tsins_{token}.pcap"
+                f"_tsins_{token}.pcap",
+                expect="listening on"
             )
             logging.debug(output_dst)
-            time.sleep(3)
             cl_src.send_shell_commands("cd /home/pi/tests/tsins/")
-            output_src = cl_src.send_shell_commands(f"python3 {script_path}")
+            # The script sends all packets and returns the prompt
+            output_src = cl_src.send_shell_commands(f"python3 {script_path}", timeout=300)
             logging.debug(output_src)
-            time.sleep(300)
+            # tcpdump returns the prompt when all packets are captured
+            output_dst = cl_dst.wait_for_prompt(timeout=300)
+            logging.debug(output_dst)
 
     logging.info("TEST timestamp_test_with_rpi FINISHED")
     logging.info("-" * 100)
@@ -158,7 +160,7 @@ def timestamp_test_with_rpi(devices_connection_data: dict, tsins_device: dict,
     logging.info("The services used in the test timestamp_test_with_rpi are stopped")
 
     logging.info("Check the .pcap file in the test timestamp_test_with_rpi")
-    with BaseSSHParamiko(**devices_connection_data[rpi_dst]) as cl:
+    with open_ssh(**devices_connection_data[rpi_dst]) as cl:
         cl.send_shell_commands("cd /home/pi/tests/tsins/short_tests/")
         output = cl.send_shell_commands("ls")
         logging.debug(output)
@@ -222,7 +224,7 @@ def timestamp_test_with_bercut(devices_connection_data: dict, tsins_device: dict
 
     logging.info("-" * 100)
     logging.info("TEST timestamp_test_with_bercut STARTED")
-    with BaseSSHParamiko(**devices_connection_data[rpi_ntp]) as cl:
+    with open_ssh(**devices_connection_data[rpi_ntp]) as cl:
         cl.send_shell_commands(
             ["cd /home/pi/", "mkdir tests", "cd tests", "mkdir tsins", "cd tsins", "mkdir long_tests", "cd long_tests"]
         )
@@ -230,11 +232,12 @@ def timestamp_test_with_bercut(devices_connection_data: dict, tsins_device: dict
             output_cl = cl.send_shell_commands(
                 f"tcpdump -i {intf_rpi}.{vlan_rpi}  -c 1000 -w "
                 f"{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}"
-                f"_tsins_{token}.pcap"
+                f"_tsins_{token}.pcap",
+                expect="listening on"
             )
             logging.debug(output_cl)
             if seconds_for_tcpdump > 180:
-                time.sleep(i * seconds_for_tcpdump//4)
+                metrics.sleep(cl.ip, i * seconds_for_tcpdump//4)
             else:
                 break
 
@@ -245,7 +248,7 @@ def timestamp_test_with_bercut(devices_connection_data: dict, tsins_device: dict
     logging.info("The services used in the test timestamp_test_with_bercut are stopped")
 
     logging.info("Check pcap file in the test timestamp_test_with_bercut")
-    with BaseSSHParamiko(**devices_connection_data[rpi_ntp]) as cl:
+    with open_ssh(**devices_connection_data[rpi_ntp]) as cl:
         cl.send_shell_commands("cd /home/pi/tests/tsins/long_tests/")
         output = cl.send_shell_commands("ls")
         logging.debug(output)
@@ -356,10 +359,17 @@ def configure_device(devices_connection_data: dict, file_with_commands: str,
                                   trim_blocks=True, lstrip_blocks=True)
         template = environment.get_template(file_with_commands)
         commands = template.render({**timestamp_test_params}).split("\n")
-        with BaseSSHParamiko(**devices_connection_data[device]) as ssh:
-            output = ssh.send_shell_commands(commands)
-            logging.debug(output)
-            return output
+        with metrics.measure(devices_connection_data[device]["ip"], file_with_commands):
+            if commands[0].strip() == "run-klish":
+                # The klish session on SSFP is kept for the next command files and stop_services_ssfp
+                results = klish_session(**devices_connection_data[device]).send_commands(commands)
+                output = "\n".join(f"{result['command']}\n{result['output']}" for result in results)
+            else:
+                # Other CLIs (ETN) get the commands one by one, the batch mode is only for klish
+                with open_ssh(**devices_connection_data[device]) as ssh:
+                    output = ssh.send_shell_commands(commands)
+        logging.debug(output)
+        return output
     except (FileNotFoundError, FileExistsError) as error:
         logging.error(
             "An error occurred while working with the file '%s' - %s", file_with_commands, error
@@ -380,14 +390,14 @@ def stop_services_ssfp(devices_connection_data: dict, ssfp: str) -> bool:
     """
     logging.info("Stopping services on device %s", ssfp)
     try:
-        with BaseSSHParamiko(**devices_connection_data[ssfp]) as ssh:
-            output = ssh.send_shell_commands(["run-klish", "configure terminal",
-                                              "timesync stop profile0",
-                                              "tsins stop profile0", "erspan stop profile0"])
-            logging.debug(output)
-            return True
+        session = klish_session(**devices_connection_data[ssfp])
+        results = session.send_commands(["run-klish", "configure terminal",
+                                         "timesync stop profile0",
+                                         "tsins stop profile0", "erspan stop profile0"])
+        logging.debug(results)
+        return True
     except OSError as error:
-        logging.error("An error has occurred on the device %s - %s", ssh.ip, error)
+        logging.error("An error has occurred on the device %s - %s", ssfp, error)
         return False
 
 
@@ -403,7 +413,7 @@ def get_rpi_settings_for_script(devices_connection_data: dict, rpi: str, vlan: i
     """
     logging.info("Getting MAC address from %s", rpi)
     try:
-        with BaseSSHParamiko(**devices_connection_data[rpi]) as ssh:
+        with open_ssh(**devices_connection_data[rpi]) as ssh:
             output = ssh.send_exec_commands("ip a")
             match = re.search(rf"\w+.{vlan}.+link/ether\s+(?P<mac>\S+)", output, re.DOTALL)
             if match:
@@ -430,25 +440,18 @@ def send_file_to_rpi(devices_connection_data: dict, file_path: str, rpi: str) ->
     """
     logging.info("Sending script '%s' to device %s", file_path, rpi)
     try:
-        remote_path = "/home/pi/tests/"
-        name_of_test: str = "tsins"
-        with SFTPParamiko(**devices_connection_data[rpi]) as sftp:
-            # Change directory to /home/pi/tests/
-            sftp.change_dir(remote_path)
-            # Check tsins directory on rpi
-            if name_of_test not in sftp.list_dir():
-                sftp.mkdir(name_of_test)
-            sftp.change_dir(name_of_test)
-            # Send file to /home/pi/tests/tsins/
-            sftp.put_file(Path(path_test, file_path), sftp.get_cwd())
-            file_path = Path(sftp.get_cwd(), file_path)
-        with BaseSSHParamiko(**devices_connection_data[rpi]) as ssh:
-            ssh.send_exec_commands(f"chmod +x {file_path}")
-        return file_path
+        remote_path = "/home/pi/tests/tsins"
+        with open_sftp(**devices_connection_data[rpi]) as sftp:
+            # The file is uploaded only if it differs from the file on rpi
+            remote_paths = sftp.sync_files([Path(path_test, file_path)], remote_path, mode=0o755)
+        if None in remote_paths:
+            logging.error("The file '%s' was not copied to the device %s", file_path, rpi)
+            return False
+        return Path(remote_path, file_path)
     except (FileNotFoundError, FileExistsError) as error:
         logging.error("An error occurred while working with the file '%s' - %s", file_path, error)
         return False
-    except OSError as error:
+    except (OSError, ErrorInConnectionException) as error:
         logging.error("An error has occurred on the device %s - %s", rpi, error)
         return False
 
@@ -0,0 +1,118 @@
+"""
+CONNECTION BROKER
+
+A long-lived local process which keeps authenticated SSH sessions to the lab devices
+between test runs, like ControlMaster of OpenSSH. Test processes send commands and files
+to it over a Unix socket (BrokerSSH, BrokerSFTP and open_ssh/open_sftp in connection.py).
+
+Each client connection of BrokerSSH gets its own shell on the pooled transport.
+When the client closes it, the shell is closed and a new one (with root, if the device
+has root_password) is prepared in the background for the next run.
+
+Run from the repository root: python -m ants.broker [socket path]
+"""
+import json
+import logging
+import os
+import socketserver
+import sys
+import threading
+from pathlib import Path
+
+from rich.logging import RichHandler
+from ants.connection import (BROKER_SOCKET_PATH, BROKER_SFTP_METHODS, BROKER_SSH_METHODS, BaseSSHParamiko,
+                             ErrorInConnectionException, SFTPParamiko, connection_pool)
+
+logging.basicConfig(
+    format="{message}",
+    datefmt="%H:%M:%S",
+    style="{",
+    level=logging.INFO,
+    handlers=[RichHandler()]
+)
+
+# Sessions are kept while the stand is used, not only during one run.
+# Transports with only prepared shells are idle, the shells are closed together with them.
+idle_timeout: int = 3600
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.ssh = None
+        self.device = None
+        try:
+            for line in self.rfile:
+                try:
+                    response = {"ok": True, "result": self.handle_request(json.loads(line))}
+                except (ErrorInConnectionException, OSError, KeyError, TypeError, ValueError) as error:
+                    logging.error(f"Request failed: {error!r}")
+                    response = {"ok": False, "error": repr(error)}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+                self.wfile.flush()
+        finally:
+            if self.ssh:
+                self.ssh.close()
+                prepare_shell(self.device)
+
+    def handle_request(self, request):
+        op = request["op"]
+        if op == "open":
+            if self.ssh:
+                raise ValueError("The session is already open")
+            self.device = request["device"]
+            self.ssh = BaseSSHParamiko(**self.device)
+            return self.ssh.promt
+        if op == "ssh":
+            if not self.ssh:
+                raise ValueError("The session is not open")
+            if request["method"] not in BROKER_SSH_METHODS:
+                raise ValueError(f"Unknown method {request['method']}")
+            return getattr(self.ssh, request["method"])(*request["args"])
+        if op == "sftp":
+            if request["method"] not in BROKER_SFTP_METHODS:
+                raise ValueError(f"Unknown method {request['method']}")
+            args = request["args"]
+            if request["method"] == "sync_files":
+                args = [[Path(path) for path in args[0]], *args[1:]]
+            with SFTPParamiko(**request["device"]) as sftp:
+                return getattr(sftp, request["method"])(*args)
+        if op == "invalidate":
+            # The device was rebooted, its transports and parked shells are dead
+            connection_pool.invalidate(request["ip"])
+            return True
+        if op == "ping":
+            return "pong"
+        raise ValueError(f"Unknown operation {op}")
+
+
+def prepare_shell(device):
+    """Opens a shell for the next session to the device in the background"""
+    def prepare():
+        try:
+            BaseSSHParamiko(**device).park()
+        except (ErrorInConnectionException, OSError) as error:
+            logging.warning(f"Unable to prepare a shell on {device['ip']}: {error!r}")
+
+    threading.Thread(target=prepare, daemon=True).start()
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path=BROKER_SOCKET_PATH):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    connection_pool.idle_timeout = idle_timeout
+    with BrokerServer(socket_path, BrokerHandler) as server:
+        os.chmod(socket_path, 0o600)
+        logging.info(f"Connection broker is listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+            connection_pool.close_all()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1] if len(sys.argv) > 1 else BROKER_SOCKET_PATH)
@@ -1,6 +1,15 @@
+import asyncio
+import atexit
+import codecs
+import hashlib
+import json
 import logging
+import os
+import random
 import re
+import shlex
 import socket
+import threading
 import time
 
 from paramiko.client import SSHClient, AutoAddPolicy
@@ -10,6 +19,8 @@ import pexpect
 from rich.logging import RichHandler
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import requests
 
 logging.basicConfig(
@@ -20,6 +31,32 @@ logging.basicConfig(
     handlers=[RichHandler()]
 )
 
+# The prompt is expected at the very end of the output: "pi@rpi:~$", "ssfp(config)#", "switch>".
+# Only for logging in and changing the user, while the prompt of the shell is not known yet.
+PROMPT_PATTERN = r"[>#\$][ \t]*\Z"
+# After logging in the prompt is the whole last line: "user@host:path$", "host(config-if)#".
+# Output which only ends with ">", "#" or "$" ("<BROADCAST,UP>", "$VAR") is not a prompt.
+PROMPT_LINE_PATTERN = r"[\w.@~/:-]+(?:\([\w./:-]+\))?[ \t]?[>#\$]"
+PASSWORD_PATTERN = r"[Pp]assword:[ \t]*\Z"
+# Local manifest of files uploaded by SFTPParamiko.sync_files: sha256, size and mtime of remote files
+SFTP_MANIFEST_PATH = Path(Path.home(), ".cache", "ants", "sftp_manifest.json")
+# Exec channels opened at once by send_exec_commands(parallel=True): sshd allows 10 sessions
+# per connection by default (MaxSessions), one more is left for the shell of the caller
+MAX_PARALLEL_CHANNELS = 9
+# Unix socket of the connection broker (broker.py), which keeps sessions between test runs
+BROKER_SOCKET_PATH = os.environ.get("ANTS_BROKER_SOCKET", "/tmp/ants_broker.sock")
+# Methods which can be called through the broker
+BROKER_SSH_METHODS = ("send_shell_commands", "send_shell_batch", "send_exec_commands", "wait_for_prompt")
+BROKER_SFTP_METHODS = ("read_file", "add_to_file", "overwrite_file", "sync_files", "send_exec_commands")
+# ubus returns this status for calls with an expired session
+UBUS_STATUS_PERMISSION_DENIED = 6
+# Command errors of klish, SNR and Linux shell ("Error: ..." of iproute2), not "errors: 0" of counters
+ERROR_PATTERN = r"(?im)^\s*%\s*(error|unknown|invalid|incomplete|ambiguous)|^\s*error:|command not found"
+# Commands which start a new program or change the user, the rest of the batch is not sent
+# until the program shows its prompt, otherwise it can drop the input typed in advance
+BATCH_BARRIER_PATTERN = r"^(run-klish|su\b|ssh\b|telnet\b)"
+
+
 class ErrorInConnectionException(Exception):
     pass
 
@@ -68,6 +105,624 @@ class BaseSSHPexpect:
         logging.info(f"<<<<< Close connection {self.ip}")
 
 
+class Metrics:
+    """
+    Metrics of device I/O: counters by device (connect_seconds, connects, retries, wait_seconds,
+    sleep_seconds, bytes_sent, bytes_received) and time of commands by device.
+    Exported as Prometheus text and as a JSON summary.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {device: {metric: value}}
+        self.devices = {}
+        # {(device, command): [count, seconds]}
+        self.commands = {}
+
+    def add(self, device, metric, value=1):
+        with self._lock:
+            device_metrics = self.devices.setdefault(device, {})
+            device_metrics[metric] = device_metrics.get(metric, 0) + value
+
+    def observe_command(self, device, command, seconds):
+        with self._lock:
+            observation = self.commands.setdefault((device, command), [0, 0.0])
+            observation[0] += 1
+            observation[1] += seconds
+
+    @contextmanager
+    def measure(self, device, command):
+        """Measures the time of a command, a command file or any other operation on the device"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe_command(device, command, time.monotonic() - start)
+
+    def sleep(self, device, seconds):
+        """Fixed pause, counted separately from waiting for the device"""
+        self.add(device, "sleep_seconds", seconds)
+        time.sleep(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.devices.clear()
+            self.commands.clear()
+
+    def to_dict(self):
+        with self._lock:
+            commands = [{"device": device, "command": command, "count": count, "seconds": round(seconds, 3)}
+                        for (device, command), (count, seconds) in self.commands.items()]
+            devices = {device: dict(device_metrics) for device, device_metrics in self.devices.items()}
+        commands.sort(key=lambda command: command["seconds"], reverse=True)
+        return {"devices": devices, "commands": commands}
+
+    def to_prometheus(self):
+        summary = self.to_dict()
+        lines = []
+        metric_names = sorted({metric for device_metrics in summary["devices"].values()
+                               for metric in device_metrics})
+        for metric in metric_names:
+            lines.append(f"# TYPE ants_{metric}_total counter")
+            for device, device_metrics in summary["devices"].items():
+                if metric in device_metrics:
+                    lines.append(f'ants_{metric}_total{{device="{_label(device)}"}} {device_metrics[metric]}')
+        lines.append("# TYPE ants_command_seconds summary")
+        for command in summary["commands"]:
+            labels = f'device="{_label(command["device"])}",command="{_label(command["command"])}"'
+            lines.append(f"ants_command_seconds_sum{{{labels}}} {command['seconds']}")
+            lines.append(f"ants_command_seconds_count{{{labels}}} {command['count']}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, directory, name="ants_metrics"):
+        """Writes {name}.prom and {name}.json to the directory"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        Path(directory, f"{name}.prom").write_text(self.to_prometheus(), encoding="utf-8")
+        Path(directory, f"{name}.json").write_text(json.dumps(self.to_dict(), indent=2), encoding="utf-8")
+        logging.info(f"Metrics are saved to {directory}")
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _command_label(command):
+    """
+    Name of a command in the metrics: the program and the next words without digits and paths,
+    "tcpdump -i eth0.100 -w /tmp/dump_1697.pcap" -> "tcpdump", "show gbe a" -> "show gbe a".
+    Timestamps, file names and addresses in the arguments would make a new label on every run.
+    """
+    words = []
+    for word in str(command).split()[:3]:
+        pattern = r"[A-Za-z][\w-]*" if not words else r"[A-Za-z][A-Za-z_-]*"
+        if not re.fullmatch(pattern, word):
+            break
+        words.append(word)
+    return " ".join(words) or "other"
+
+
+metrics = Metrics()
+
+
+def _save_metrics_at_exit():
+    # The directory for the metrics of the run, e.g. set by CI_CD_system.py
+    directory = os.environ.get("ANTS_METRICS_DIR")
+    if directory and metrics.devices:
+        metrics.save(directory, f"ants_metrics_{os.getpid()}")
+
+
+atexit.register(_save_metrics_at_exit)
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter between attempts to connect to a device"""
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=10, jitter=0.5, connect_timeout=30,
+                 use_circuit_breaker=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Part of the delay which is randomized, so that devices are not retried in lockstep
+        self.jitter = jitter
+        # Timeout in seconds of one connect
+        self.connect_timeout = connect_timeout
+        # Connects are refused by the circuit breaker and change its state
+        self.use_circuit_breaker = use_circuit_breaker
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+
+# Reconnect policies by "device_type" from the connection data.
+# SNR switches close the connection (EOFError) if sessions are opened one after another,
+# they need a few seconds of pause.
+# Readiness probes connect once with a short timeout: the waiter has its own backoff and deadline,
+# and the failures of a rebooting device are not failures of the device for the other callers.
+RETRY_POLICIES = {
+    "default": RetryPolicy(max_attempts=3, base_delay=0.5, max_delay=5),
+    "switch": RetryPolicy(max_attempts=5, base_delay=1, max_delay=8),
+    "probe": RetryPolicy(max_attempts=1, connect_timeout=5, use_circuit_breaker=False),
+}
+
+
+class CircuitBreaker:
+    """
+    Fails connections to a device at once after failure_threshold failed connections in a row.
+    After reset_timeout seconds one more attempt is allowed.
+    """
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # {ip: (failures in a row, time of the last failure)}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def check(self, ip):
+        with self._lock:
+            failures, failed_at = self._failures.get(ip, (0, 0))
+        if failures >= self.failure_threshold and time.monotonic() - failed_at < self.reset_timeout:
+            raise ErrorInConnectionException(
+                f"Device {ip} failed {failures} times in a row, next attempt in "
+                f"{self.reset_timeout - (time.monotonic() - failed_at):.0f} s"
+            )
+
+    def success(self, ip):
+        with self._lock:
+            self._failures.pop(ip, None)
+
+    def failure(self, ip):
+        with self._lock:
+            failures, _ = self._failures.get(ip, (0, 0))
+            self._failures[ip] = (failures + 1, time.monotonic())
+
+    def reset(self):
+        with self._lock:
+            self._failures.clear()
+
+
+circuit_breaker = CircuitBreaker()
+
+
+def _connect_with_retry(ip, username, password, device_type="default"):
+    """Connects to the device with the retry policy of its type, authentication errors are not retried"""
+    policy = RETRY_POLICIES.get(device_type, RETRY_POLICIES["default"])
+    if policy.use_circuit_breaker:
+        circuit_breaker.check(ip)
+    for attempt in range(policy.max_attempts):
+        try:
+            start = time.monotonic()
+            try:
+                client = _connect_client(ip, username, password, policy.connect_timeout)
+            finally:
+                # Handshake and authentication, the backoff sleep is counted in sleep_seconds
+                metrics.add(ip, "connect_seconds", time.monotonic() - start)
+            if policy.use_circuit_breaker:
+                circuit_breaker.success(ip)
+            metrics.add(ip, "connects")
+            return client
+        except (AuthenticationException, BadHostKeyException):
+            if policy.use_circuit_breaker:
+                circuit_breaker.failure(ip)
+            raise
+        except (SSHException, EOFError, OSError) as error:
+            if attempt == policy.max_attempts - 1:
+                if policy.use_circuit_breaker:
+                    circuit_breaker.failure(ip)
+                raise
+            delay = policy.delay(attempt)
+            logging.warning(f"An error {error!r} occurred on {ip}, reconnect in {delay:.1f} s")
+            metrics.add(ip, "retries")
+            metrics.sleep(ip, delay)
+
+
+class ConnectionPool:
+    """
+    Process-wide pool of authenticated SSH transports keyed by (ip, username).
+    Shell, exec and SFTP channels are opened on one transport, so the handshake
+    and authentication are done once per device per run.
+    """
+    def __init__(self, idle_timeout=300, max_idle_shells=32):
+        # Transports unused for idle_timeout seconds are closed
+        self.idle_timeout = idle_timeout
+        # Maximum number of ready shells (e.g. opened by ScanDevices) kept for the next user
+        self.max_idle_shells = max_idle_shells
+        self._clients = {}
+        self._last_used = {}
+        # {(ip, username, root): [(client, shell, promt)]}
+        self._idle_shells = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except (SSHException, EOFError, OSError):
+            return False
+
+    def acquire(self, ip, username, password, device_type="default"):
+        """Returns a live authenticated SSHClient, connects if there is no healthy one in the pool"""
+        self.evict_idle()
+        key = (ip, username)
+        with self._key_lock(key):
+            client = self._clients.get(key)
+            if client is not None and not self._is_alive(client):
+                logging.debug(f"Connection to {ip} as {username} is dead, reconnect")
+                self.invalidate(ip, username)
+                client = None
+            if client is None:
+                client = _connect_with_retry(ip, username, password, device_type)
+                logging.info(f"Authentication on {ip} as {username} is successful")
+                self._clients[key] = client
+            self._last_used[key] = time.monotonic()
+            return client
+
+    def open_channel(self, ip, username, password, open_channel, device_type="default"):
+        """
+        Opens a channel on the pooled transport with open_channel(client),
+        reconnects once if the transport turned out to be dead.
+        Returns the client and the channel.
+        """
+        client = self.acquire(ip, username, password, device_type)
+        try:
+            return client, open_channel(client)
+        except (SSHException, EOFError, OSError):
+            logging.debug(f"Unable to open a channel on {ip}, reconnect")
+            self.invalidate(ip, username)
+            client = self.acquire(ip, username, password, device_type)
+            return client, open_channel(client)
+
+    def put_shell(self, key, client, shell, promt):
+        """
+        Keeps an opened shell for the next BaseSSHParamiko with the same key (ip, username, root).
+        Returns False if the limit of idle shells is reached.
+        """
+        with self._lock:
+            if sum(len(shells) for shells in self._idle_shells.values()) >= self.max_idle_shells:
+                return False
+            self._idle_shells.setdefault(key, []).append((client, shell, promt))
+            return True
+
+    def take_shell(self, key):
+        """Returns a live idle shell (client, shell, promt) or None"""
+        while True:
+            with self._lock:
+                shells = self._idle_shells.get(key)
+                if not shells:
+                    return None
+                client, shell, promt = shells.pop()
+            if not shell.closed and self._is_alive(client):
+                with self._lock:
+                    self._last_used[key[:2]] = time.monotonic()
+                return client, shell, promt
+            shell.close()
+
+    def invalidate(self, ip, username=None):
+        """Closes and removes connections to the device, e.g. after reboot"""
+        with self._lock:
+            keys = [key for key in self._clients if key[0] == ip and username in (None, key[1])]
+            clients = [self._clients.pop(key) for key in keys]
+            for key in keys:
+                self._last_used.pop(key, None)
+            for key in [key for key in self._idle_shells if key[0] == ip and username in (None, key[1])]:
+                del self._idle_shells[key]
+        for client in clients:
+            client.close()
+
+    def _parked_shells(self, client):
+        with self._lock:
+            return sum(1 for shells in self._idle_shells.values()
+                       for shell_client, _, _ in shells if shell_client is client)
+
+    def evict_idle(self):
+        """
+        Closes transports unused for idle_timeout seconds. A transport with open channels
+        (a klish session, a long exec command) is in use, its idle time starts again.
+        Shells parked in the pool are not a use, they are closed together with the transport.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [(key, self._clients.get(key)) for key, last_used in self._last_used.items()
+                          if now - last_used > self.idle_timeout]
+        keys = []
+        for key, client in candidates:
+            if client is not None and _open_channels(client) > self._parked_shells(client):
+                with self._lock:
+                    self._last_used[key] = now
+                continue
+            keys.append(key)
+        for ip, username in keys:
+            logging.debug(f"Close idle connection to {ip} as {username}")
+            self.invalidate(ip, username)
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._last_used.clear()
+            self._idle_shells.clear()
+        for client in clients:
+            client.close()
+
+
+def _connect_client(ip, username, password, timeout=30):
+    client = SSHClient()
+    client.set_missing_host_key_policy(AutoAddPolicy())
+    client.connect(
+        hostname=ip,
+        username=username,
+        password=password,
+        look_for_keys=False,
+        allow_agent=False,
+        timeout=timeout,
+        banner_timeout=timeout,
+        auth_timeout=timeout,
+        disabled_algorithms={'pubkeys': ['rsa-sha2-256', 'rsa-sha2-512']}
+    )
+    return client
+
+
+def _exec_commands(client, ip, commands, print_output=True):
+    logging.info(f">>> Send exec command(s) on {ip}: {commands}")
+    try:
+        result = []
+        if type(commands) == str:
+            with metrics.measure(ip, _command_label(commands)):
+                stdin, stdout, stderr = client.exec_command(commands)
+                if print_output:
+                    result.append(stdout.read().decode("utf-8").replace("\r\n", "\n"))
+        else:
+            for command in commands:
+                with metrics.measure(ip, _command_label(command)):
+                    stdin, stdout, stderr = client.exec_command(command)
+                    if print_output:
+                        result.append(stdout.read().decode("utf-8").replace("\r\n", "\n") + '\n')
+        if print_output:
+            metrics.add(ip, "bytes_received", sum(len(output) for output in result))
+            return "".join(result)
+    except paramiko.SSHException as error:
+        logging.error(f"An error {error} occurred on {ip}")
+
+
+def _open_channels(client):
+    transport = client.get_transport()
+    # paramiko has no public list of channels, a closed channel is removed from the map
+    channels = getattr(transport, "_channels", None)
+    return len(channels) if channels else 0
+
+
+def _exec_commands_parallel(client, ip, commands, max_channels=MAX_PARALLEL_CHANNELS):
+    logging.info(f">>> Send exec command(s) in parallel on {ip}: {commands}")
+    if type(commands) == str:
+        commands = [commands]
+    # The shell of the caller and other channels on the transport are sessions of sshd too
+    window = max(1, max_channels - _open_channels(client))
+    results = []
+    with metrics.measure(ip, "parallel exec"):
+        for start in range(0, len(commands), window):
+            results += _exec_window(client, ip, commands[start:start + window])
+    metrics.add(ip, "bytes_received", sum(len(result["stdout"]) + len(result["stderr"]) for result in results))
+    return results
+
+
+def _exec_window(client, ip, commands):
+    """
+    Starts all the commands before reading any output. If a channel cannot be opened,
+    each command of the window gets a result with exit_status None and the error.
+    """
+    channels = []
+    try:
+        for command in commands:
+            channels.append(client.exec_command(command)[1].channel)
+        outputs = _drain_channels(channels)
+        return [{"command": command,
+                 "stdout": stdout.decode("utf-8").replace("\r\n", "\n"),
+                 "stderr": stderr.decode("utf-8").replace("\r\n", "\n"),
+                 "exit_status": channel.recv_exit_status(),
+                 "error": None}
+                for command, channel, (stdout, stderr) in zip(commands, channels, outputs)]
+    except (paramiko.SSHException, EOFError, OSError) as error:
+        logging.error(f"An error {error} occurred on {ip}")
+        return [{"command": command, "stdout": "", "stderr": "", "exit_status": None, "error": repr(error)}
+                for command in commands]
+    finally:
+        for channel in channels:
+            channel.close()
+
+
+def _drain_channels(channels, max_read=32768):
+    """
+    Reads stdout and stderr of exec channels together until the commands exit.
+    A command stops when the window of a stream which is not read is full,
+    so no stream is read to the end before the others.
+    Returns [(stdout, stderr)] in the order of channels.
+    """
+    outputs = [(bytearray(), bytearray()) for _ in channels]
+    running = set(range(len(channels)))
+    while running:
+        received = False
+        for index in list(running):
+            channel = channels[index]
+            stdout, stderr = outputs[index]
+            if channel.recv_ready():
+                stdout += channel.recv(max_read)
+                received = True
+            if channel.recv_stderr_ready():
+                stderr += channel.recv_stderr(max_read)
+                received = True
+            # The exit status comes after all the data of the command
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                running.discard(index)
+        if running and not received:
+            time.sleep(0.01)
+    return [(bytes(stdout), bytes(stderr)) for stdout, stderr in outputs]
+
+
+def _sha256_file(local_path):
+    sha256 = hashlib.sha256()
+    with open(local_path, "rb") as file:
+        for block in iter(lambda: file.read(65536), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+# Content of remote files read or written by SFTPParamiko: {(ip, path): {"content", "mtime", "size"}}
+_file_cache = {}
+_file_cache_lock = threading.Lock()
+_manifest_lock = threading.Lock()
+
+
+def _load_manifest(manifest_path):
+    with _manifest_lock:
+        try:
+            with open(manifest_path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+
+def _save_manifest(manifest_path, updates):
+    # Other runs could update the manifest in the meantime, so only the changed entries are written
+    manifest = _load_manifest(manifest_path)
+    manifest.update(updates)
+    with _manifest_lock:
+        try:
+            Path(manifest_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(manifest_path, "w", encoding="utf-8") as file:
+                json.dump(manifest, file, indent=2)
+        except OSError as error:
+            logging.warning(f"Unable to save the manifest {manifest_path}: {error}")
+
+
+def _iter_channel_lines(channel, ip, expect=None, timeout=None, max_read=10000):
+    """
+    Yields decoded lines from the channel as they arrive. Only the last incomplete line
+    is kept in memory. Stops when the channel is closed, when the expect pattern appears
+    in the incomplete line (it is not yielded) or when the timeout expires.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    regex = re.compile(expect) if expect else None
+    deadline = None if timeout is None else time.monotonic() + timeout
+    if deadline is None:
+        # _read_until leaves its short timeout on the channel, recv should block instead
+        channel.settimeout(None)
+    partial = ""
+    while True:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"Timeout {timeout} s while reading the output on {ip}")
+                return
+            channel.settimeout(remaining)
+        try:
+            data = channel.recv(max_read)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        metrics.add(ip, "bytes_received", len(data))
+        lines = (partial + decoder.decode(data)).replace("\r\n", "\n").split("\n")
+        partial = lines.pop()
+        yield from lines
+        if regex and regex.search(partial):
+            return
+        if len(partial) > max_read:
+            yield partial
+            partial = ""
+    partial += decoder.decode(b"", final=True)
+    if partial:
+        yield partial
+
+
+def _spill_lines(lines, spill_path=None):
+    if spill_path is None:
+        yield from lines
+        return
+    with open(spill_path, "a", encoding="utf-8") as file:
+        for line in lines:
+            file.write(f"{line}\n")
+            yield line
+
+
+def prompt_pattern(promt=None):
+    """Returns the pattern of the prompt line at the end of the output, promt is the prompt found at login"""
+    alternatives = [PROMPT_LINE_PATTERN] + ([re.escape(promt.strip())] if promt else [])
+    return rf"(?m)^(?:{'|'.join(alternatives)})[ \t]*\Z"
+
+
+def _split_batch(commands, window=None):
+    """Splits commands into batches by window size and by barrier commands"""
+    batches = []
+    batch = []
+    for command in commands:
+        if re.search(BATCH_BARRIER_PATTERN, command):
+            if batch:
+                batches.append(batch)
+            batches.append([command])
+            batch = []
+            continue
+        batch.append(command)
+        if window and len(batch) == window:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def split_batch_output(output, commands):
+    """
+    Splits the output of commands sent at once into the outputs of each command.
+    The output of a command starts after the line with its echo and ends before
+    the prompt line with the echo of the next command.
+    The echo is a line which ends with the command after the prompt, so short commands
+    ("up", "exit") are not found inside the output of the previous commands.
+    The first command can also be echoed without the prompt, which was read before the batch.
+    """
+    starts = []
+    cursor = 0
+    for index, command in enumerate(commands):
+        echo = rf"[ \t]*{re.escape(command)}[ \t]*$"
+        match = re.compile(rf"^[^\n]*[>#\$]{echo}", re.MULTILINE).search(output, cursor)
+        if index == 0:
+            first_line = re.compile(rf"\A{echo}", re.MULTILINE).match(output)
+            match = first_line or match
+        if match is None:
+            logging.warning(f"Echo of the command '{command}' not found in the output")
+            starts.append(None)
+            continue
+        line_end = output.find("\n", match.end())
+        line_end = len(output) if line_end == -1 else line_end + 1
+        starts.append((match.start(), line_end))
+        cursor = line_end
+
+    results = []
+    for index, start in enumerate(starts):
+        if start is None:
+            results.append("")
+            continue
+        next_starts = [next_start[0] for next_start in starts[index + 1:] if next_start]
+        if next_starts:
+            end = next_starts[0]
+        else:
+            # The output of the last command ends with the prompt line
+            end = output.rfind("\n", start[1]) + 1 or start[1]
+        results.append(output[start[1]:max(end, start[1])].rstrip("\n"))
+    return results
+
+
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close_all)
+
+
 class BaseSSHParamiko:
     def __init__(self, **device_data):
         self.ip = device_data["ip"]
@@ -77,28 +732,23 @@ class BaseSSHParamiko:
             self.root_password = device_data["root_password"]
         except KeyError:
             self.root_password = None
-        self.short_sleep = 0.2
-        self.long_sleep = 2
+        # Timeout in seconds to wait for the prompt after each command
+        self.timeout = device_data.get("timeout", 10)
+        # Type of device for the reconnect policy (RETRY_POLICIES)
+        self.device_type = device_data.get("device_type", "default")
         self.max_read = 10000
 
         logging.info(f">>>>> Connection to {self.ip} as {self.login}")
         try:
-            self.cl = SSHClient()
-            self.cl.set_missing_host_key_policy(AutoAddPolicy())
-            self.cl.connect(
-                hostname=self.ip,
-                username=self.login,
-                password=self.password,
-                look_for_keys=False,
-                allow_agent=False,
-                timeout=30,
-                disabled_algorithms={'pubkeys': ['rsa-sha2-256', 'rsa-sha2-512']}
+            warm_shell = connection_pool.take_shell(self._shell_key())
+            if warm_shell:
+                logging.info(f"Use the opened shell on {self.ip}")
+                self.cl, self._shell, self.promt = warm_shell
+                return
+            self.cl, self._shell = connection_pool.open_channel(
+                self.ip, self.login, self.password, SSHClient.invoke_shell, self.device_type
             )
-            logging.info("Authentication is successful")
-
-            self._shell = self.cl.invoke_shell()
-            time.sleep(self.short_sleep)
-            self._shell.recv(self.max_read)
+            self._read_until(PROMPT_PATTERN)
             if self.root_password:
                 self._change_to_root()
             self.promt = self._get_promt()
@@ -114,56 +764,179 @@ class BaseSSHParamiko:
         except SSHException as error:
             logging.critical(f"Unable to establish SSH connection: {error}")
             raise ErrorInConnectionException(error)
-        except EOFError:
-            # Данная ошибка возникает при попытке подключения к устройству (конкретно только на SNR)
-            # Тестово лечится попыткой переподключения или
-            # Добавлением паузы (5 сек), если подключения к свитчам происходит подряд
-            logging.error("Try to reconnect")
-            self.__init__(**device_data)
+        except EOFError as error:
+            # Данная ошибка возникает при попытке подключения к устройству (конкретно только на SNR).
+            # Переподключение с паузой выполняется по RETRY_POLICIES
+            logging.critical(f"Connection closed by {self.ip}: {error!r}")
+            raise ErrorInConnectionException(error)
+
+    def _shell_key(self):
+        return self.ip, self.login, bool(self.root_password)
+
+    def park(self):
+        """
+        Leaves the fresh shell in the connection pool for the next connection to the device
+        instead of closing it. The shell should not be used after that.
+        """
+        if not connection_pool.put_shell(self._shell_key(), self.cl, self._shell, self.promt):
+            self.close()
 
     def _get_promt(self):
-        time.sleep(self.short_sleep)
-        self._shell.send("\n")
-        time.sleep(self.short_sleep)
-        output = self._formatting_output()
-        match = re.search(r".+[\$#]", output)
+        self._send_shell("\n")
+        output = self._read_until(PROMPT_PATTERN).strip()
+        match = re.search(r".+[\$#>]", output.split("\n")[-1])
         if match:
             return match.group()
         else:
-            return "\$"
+            # A bare "$" prompt, it is matched as text by prompt_pattern
+            return "$"
+
+    def _read_until(self, pattern, timeout=None):
+        """
+        Reads the shell output until the pattern appears at the output or the timeout expires.
+        Returns everything that was read, even if the pattern was not found.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        regex = re.compile(pattern)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        output = []
+        tail = ""
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"Timeout {timeout} s waiting for '{regex.pattern}' on {self.ip}")
+                break
+            self._shell.settimeout(remaining)
+            try:
+                data = self._shell.recv(self.max_read)
+            except socket.timeout:
+                continue
+            if not data:
+                logging.debug(f"Shell channel closed on {self.ip}")
+                break
+            metrics.add(self.ip, "bytes_received", len(data))
+            text = decoder.decode(data)
+            output.append(text)
+            tail = (tail + text)[-self.max_read:]
+            if regex.search(tail):
+                break
+        metrics.add(self.ip, "wait_seconds", time.monotonic() - start)
+        return "".join(output).replace("\r\n", "\n")
+
+    def _prompt_pattern(self):
+        return prompt_pattern(self.promt)
 
-    def _formatting_output(self):
-        return self._shell.recv(self.max_read).decode("utf-8").replace("\r\n", "\n")
+    def wait_for_prompt(self, timeout=None):
+        """Waits for the prompt, e.g. when a command running in the foreground is finished"""
+        return self._read_until(self._prompt_pattern(), timeout)
+
+    def _send_shell(self, data):
+        metrics.add(self.ip, "bytes_sent", len(data))
+        return self._shell.send(data)
 
     def _send_line_shell(self, command):
-        return self._shell.send(f"{command}\n")
+        return self._send_shell(f"{command}\n")
+
+    def send_shell_commands(self, commands, print_output=True, expect=None, timeout=None):
+        """
+        Sends commands to the shell one by one. After each command waits for the prompt
+        or for the expect pattern.
 
-    def send_shell_commands(self, commands, print_output=True):
-        time.sleep(self.long_sleep)
-        output = ""
+        :param commands: command or list of commands
+        :param print_output: return the output of commands
+        :param expect: regex to wait for instead of the prompt, or a list of regexes
+                       (one for each command, None - wait for the prompt)
+        :param timeout: timeout in seconds for each command
+        """
         logging.info(f">>> Send shell command(s) on {self.ip}: {commands}")
+        if type(commands) == str:
+            commands = [commands]
+        if expect is None or type(expect) == str:
+            expect = [expect] * len(commands)
+        output = []
         try:
-            if type(commands) == str:
-                self._send_line_shell(commands)
-                time.sleep(self.long_sleep)
-                output = self._formatting_output()
-            else:
-                for command in commands:
+            for command, pattern in zip(commands, expect):
+                with metrics.measure(self.ip, _command_label(command)):
                     self._send_line_shell(command)
-                    time.sleep(self.long_sleep)
-                    output += self._formatting_output()
+                    output.append(self._read_until(pattern or self._prompt_pattern(), timeout))
             if print_output:
-                return output
+                return "".join(output)
+        except paramiko.SSHException as error:
+            logging.error(f"An error {error} occurred on {self.ip}")
+
+    def send_shell_batch(self, commands, window=None, timeout=None):
+        """
+        Sends commands to the shell in batches without waiting for the prompt after each command.
+        The output is split into the outputs of each command by the echo of commands.
+
+        :param commands: list of commands
+        :param window: maximum number of commands sent at once, None - all commands
+        :param timeout: timeout in seconds for each command
+        :return: list of dictionaries {"command": command, "output": output, "error": True/False}
+        """
+        logging.info(f">>> Send shell batch on {self.ip}: {commands}")
+        timeout = self.timeout if timeout is None else timeout
+        commands = [command.strip() for command in commands if command.strip()]
+        results = []
+        try:
+            for batch in _split_batch(commands, window):
+                with metrics.measure(self.ip, f"batch: {_command_label(batch[0])}"):
+                    self._send_shell("".join(f"{command}\n" for command in batch))
+                    output = self._read_batch(batch[-1], timeout * len(batch))
+                for command, command_output in zip(batch, split_batch_output(output, batch)):
+                    error = bool(re.search(ERROR_PATTERN, command_output))
+                    if error:
+                        logging.error(f"Command '{command}' failed on {self.ip}: {command_output}")
+                    results.append({"command": command, "output": command_output, "error": error})
         except paramiko.SSHException as error:
             logging.error(f"An error {error} occurred on {self.ip}")
+        return results
+
+    def _read_batch(self, last_command, timeout):
+        """Reads the shell output until the prompt after the echo of the last command of the batch"""
+        output = []
+        pattern = self._prompt_pattern()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"Timeout {timeout} s waiting for the batch on {self.ip}")
+                break
+            chunk = self._read_until(pattern, remaining)
+            if not chunk:
+                break
+            output.append(chunk)
+            text = "".join(output)
+            position = text.rfind(last_command)
+            if position != -1 and re.search(pattern, text[position + len(last_command):]):
+                break
+        return "".join(output)
+
+    # -----------------------------Streaming output----------------------------#
+    def stream_shell_command(self, command, expect=None, timeout=None, spill_path=None):
+        """
+        Sends a command to the shell and yields lines of the output as they arrive,
+        until the expect pattern (the prompt by default) appears.
+
+        :param command: command, e.g. tcpdump or show bert
+        :param expect: regex after which the output is finished, None - the prompt line
+        :param timeout: maximum time in seconds for the command, None - without limit
+        :param spill_path: local file to which the lines are appended
+        """
+        logging.info(f">>> Stream shell command on {self.ip}: {command}")
+        self._send_line_shell(command)
+        lines = _iter_channel_lines(self._shell, self.ip, expect or self._prompt_pattern(), timeout, self.max_read)
+        yield from _spill_lines(lines, spill_path)
 
     def _change_to_root(self):
         logging.info("Change privileges to root")
         try:
             self._send_line_shell("su -")
-            time.sleep(self.long_sleep)
+            self._read_until(PASSWORD_PATTERN)
             self._send_line_shell(f"{self.root_password}")
-            time.sleep(self.short_sleep)
+            self._read_until(PROMPT_PATTERN)
         except paramiko.SSHException as error:
             logging.error(f"An error {error} occurred on {self.ip}")
 
@@ -173,28 +946,53 @@ class BaseSSHParamiko:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    @property
+    def closed(self):
+        return self._shell.closed
+
     def close(self):
-        self.cl.close()
+        # The transport stays in the connection pool, only the shell is closed
+        self._shell.close()
         logging.info(f"<<<<< Close connection {self.ip}")
 
     # -----------------------------Exec commands----------------------------#
-    def send_exec_commands(self, commands, print_output=True):
-        logging.info(f">>> Send exec command(s) on {self.ip}: {commands}")
+    def send_exec_commands(self, commands, print_output=True, parallel=False,
+                           max_channels=MAX_PARALLEL_CHANNELS):
+        """
+        Runs commands on exec channels.
+
+        :param commands: command or list of commands
+        :param print_output: return the output of commands
+        :param parallel: open exec channels at once on the same transport,
+                         for read-only commands which do not depend on each other
+        :param max_channels: maximum number of channels open at once on the transport,
+                             including the channels which are already open (e.g. this shell)
+        :return: str: output of commands
+                 list of dictionaries {"command", "stdout", "stderr", "exit_status", "error"}
+                 for each command in the order of commands if parallel,
+                 exit_status is None and error is set if the command was not run
+        """
+        if parallel:
+            return _exec_commands_parallel(self.cl, self.ip, commands, max_channels)
+        return _exec_commands(self.cl, self.ip, commands, print_output)
+
+    def stream_exec_command(self, command, timeout=None, spill_path=None):
+        """
+        Runs a command on the exec channel and yields lines of stdout and stderr as they arrive.
+
+        :param command: command
+        :param timeout: maximum time in seconds for the command, None - without limit
+        :param spill_path: local file to which the lines are appended
+        """
+        logging.info(f">>> Stream exec command on {self.ip}: {command}")
+        channel = self.cl.get_transport().open_session()
         try:
-            result = ""
-            if type(commands) == str:
-                stdin, stdout, stderr = self.cl.exec_command(commands)
-                if print_output:
-                    result = stdout.read().decode("utf-8").replace("\r\n", "\n")
-            else:
-                for command in commands:
-                    stdin, stdout, stderr = self.cl.exec_command(command)
-                    if print_output:
-                        result += stdout.read().decode("utf-8").replace("\r\n", "\n") + '\n'
-            if print_output:
-                return result
-        except paramiko.SSHException as error:
-            logging.error(f"An error {error} occurred on {self.ip}")
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            lines = _iter_channel_lines(channel, self.ip, None, timeout, self.max_read)
+            yield from _spill_lines(lines, spill_path)
+        finally:
+            channel.close()
 
 
 class SFTPParamiko:
@@ -202,22 +1000,16 @@ class SFTPParamiko:
         self.ip = device_data["ip"]
         self.login = device_data["login"]
         self.root_password = device_data["root_password"]
+        self.device_type = device_data.get("device_type", "default")
+
+        # Files which cache entries are known to be up to date in this session
+        self._fresh_files = set()
 
         logging.info(f">>>>> Connection to {self.ip} with root")
         try:
-            self.root_cl = SSHClient()
-            self.root_cl.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.root_cl.connect(
-                hostname=self.ip,
-                username="root",
-                password=self.root_password,
-                look_for_keys=False,
-                allow_agent=False,
-                timeout=30,
-                disabled_algorithms={'pubkeys': ['rsa-sha2-256', 'rsa-sha2-512']},
+            self.root_cl, self.sftp_cl = connection_pool.open_channel(
+                self.ip, "root", self.root_password, SSHClient.open_sftp, self.device_type
             )
-            logging.info("Authentication as root is successful")
-            self.sftp_cl = self.root_cl.open_sftp()
             logging.info("SFTP was opened")
         except socket.timeout as error:
             logging.critical(f"An error {error} occurred on {self.ip}")
@@ -233,11 +1025,24 @@ class SFTPParamiko:
             raise ErrorInConnectionException(error)
 
     # -----------------------------File actions----------------------------#
-    def read_file(self, file_path):
+    def read_file(self, file_path, use_cache=True):
+        """
+        Reads the remote file. The content is cached by (host, path, mtime, size):
+        a cached file is not read again if its mtime and size have not changed.
+        Files read or written by this client are not checked again until the client is closed.
+        """
         try:
+            if use_cache:
+                content = self._get_cached(file_path)
+                if content is not None:
+                    logging.info(f"Read the file {file_path} from cache")
+                    return content
             logging.info(f"Read the file {file_path}")
             remote_file = self.sftp_cl.open(file_path)
-            result = remote_file.read().decode("utf-8").replace('\r\n', '\n')
+            data = remote_file.read()
+            metrics.add(self.ip, "bytes_received", len(data))
+            result = data.decode("utf-8").replace('\r\n', '\n')
+            self._set_cached(file_path, result, remote_file.stat())
             remote_file.close()
             return result
         except (paramiko.SFTPError, IOError) as error:
@@ -246,12 +1051,20 @@ class SFTPParamiko:
     def add_to_file(self, content, file_path):
         try:
             logging.info(f"Opening a file {file_path}")
+            cached = self._get_cached(file_path) if file_path in self._fresh_files else None
             remote_file = self.sftp_cl.open(file_path, mode="a")
             remote_file.write(content)
+            metrics.add(self.ip, "bytes_sent", len(content.encode()))
             logging.info(f"Interface added to file {file_path}")
+            # Writes are buffered, mtime and size of the file are known after close
             remote_file.close()
             logging.info(f"File {file_path} closed successfully")
+            if cached is not None:
+                self._set_cached(file_path, cached + content, self.sftp_cl.stat(file_path))
+            else:
+                self._drop_cached(file_path)
         except (paramiko.SFTPError, IOError) as error:
+            self._drop_cached(file_path)
             logging.error(f"There was an error {error} while working with the file {file_path}")
 
     def overwrite_file(self, content, file_path):
@@ -259,12 +1072,42 @@ class SFTPParamiko:
             logging.info(f"Open the file {file_path}")
             remote_file = self.sftp_cl.open(file_path, mode="w+")
             remote_file.write(content)
+            metrics.add(self.ip, "bytes_sent", len(content.encode()))
             logging.info(f"The file {file_path} have changed")
             remote_file.close()
             logging.info(f"File {file_path} closed successfully")
+            self._set_cached(file_path, content, self.sftp_cl.stat(file_path))
         except (paramiko.SFTPError, IOError) as error:
+            self._drop_cached(file_path)
             logging.error(f"There was an error {error} while working with the file {file_path}")
 
+    def _get_cached(self, file_path):
+        """Returns the cached content if the remote file has not changed, otherwise None"""
+        with _file_cache_lock:
+            entry = _file_cache.get((self.ip, file_path))
+        if entry is None:
+            return None
+        if file_path not in self._fresh_files:
+            remote_stat = self._stat(file_path)
+            if (remote_stat is None or remote_stat.st_mtime != entry["mtime"]
+                    or remote_stat.st_size != entry["size"]):
+                self._drop_cached(file_path)
+                return None
+            self._fresh_files.add(file_path)
+        return entry["content"]
+
+    def _set_cached(self, file_path, content, remote_stat):
+        with _file_cache_lock:
+            _file_cache[(self.ip, file_path)] = {
+                "content": content, "mtime": remote_stat.st_mtime, "size": remote_stat.st_size
+            }
+        self._fresh_files.add(file_path)
+
+    def _drop_cached(self, file_path):
+        with _file_cache_lock:
+            _file_cache.pop((self.ip, file_path), None)
+        self._fresh_files.discard(file_path)
+
     def put_file(self, local_path, remote_path):
         """
         Должен передаваться полный путь
@@ -276,14 +1119,118 @@ class SFTPParamiko:
             # Therefore, need to add a filename to the directory.
             # https://github.com/paramiko/paramiko/issues/1000?ysclid=lg51z5k5nz705979083
             if isinstance(local_path, Path):
+                self._drop_cached(f"{remote_path}/{local_path.name}")
                 self.sftp_cl.put(local_path, f"{remote_path}/{local_path.name}")
+                metrics.add(self.ip, "bytes_sent", local_path.stat().st_size)
                 logging.info(f"File {local_path} has been copied to path {remote_path}")
             else:
                 logging.error(f"Wrong type of local path - {type(local_path)} instead Path")
         except (paramiko.SFTPError, IOError) as error:
             logging.error(f"There was an error - '{error}' while working with the file {local_path}")
 
+    # -----------------------------Sync actions----------------------------#
+    def sync_files(self, local_paths, remote_dir, mode=None, workers=4, manifest_path=SFTP_MANIFEST_PATH):
+        """
+        Uploads to remote_dir only the files which differ from the remote ones.
+        A file is not uploaded if the remote size and mtime match the local manifest
+        written after the previous upload, or if the remote sha256 matches the local one.
+        Changed files are uploaded at once over several SFTP channels of the same transport.
+
+        :param local_paths: list of local files (Path)
+        :param remote_dir: remote directory, created if it does not exist
+        :param mode: file mode to set, e.g. 0o755
+        :param workers: maximum number of files uploaded at once
+        :param manifest_path: local manifest file
+        :return: list of remote paths in the order of local_paths, None for files which failed to upload
+        """
+        logging.info(f"Sync {[str(path) for path in local_paths]} to {remote_dir} on {self.ip}")
+        self.makedirs(remote_dir)
+        manifest = _load_manifest(manifest_path)
+        remote_paths = [f"{remote_dir.rstrip('/')}/{path.name}" for path in local_paths]
+        local_hashes = [_sha256_file(path) for path in local_paths]
+
+        to_upload = []
+        to_check = []
+        for local_path, remote_path, local_hash in zip(local_paths, remote_paths, local_hashes):
+            remote_stat = self._stat(remote_path)
+            entry = manifest.get(f"{self.ip}:{remote_path}")
+            if remote_stat is None or remote_stat.st_size != local_path.stat().st_size:
+                to_upload.append((local_path, remote_path))
+            elif (entry and entry["sha256"] == local_hash and entry["size"] == remote_stat.st_size
+                  and entry["mtime"] == remote_stat.st_mtime):
+                logging.debug(f"File {remote_path} is up to date")
+            else:
+                to_check.append((local_path, remote_path, local_hash))
+
+        if to_check:
+            remote_hashes = self._remote_sha256([remote_path for _, remote_path, _ in to_check])
+            for local_path, remote_path, local_hash in to_check:
+                if remote_hashes.get(remote_path) != local_hash:
+                    to_upload.append((local_path, remote_path))
+
+        failed = set()
+        if to_upload:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                uploaded = list(executor.map(lambda paths: self._upload(*paths), to_upload))
+            failed = {remote_path for (_, remote_path), ok in zip(to_upload, uploaded) if not ok}
+
+        updates = {}
+        for remote_path, local_hash in zip(remote_paths, local_hashes):
+            # A partly written file must not be taken for the uploaded one next time
+            remote_stat = self._stat(remote_path) if remote_path not in failed else None
+            if remote_stat is None:
+                continue
+            if mode is not None and remote_stat.st_mode & 0o777 != mode:
+                self.sftp_cl.chmod(remote_path, mode)
+            updates[f"{self.ip}:{remote_path}"] = {
+                "sha256": local_hash, "size": remote_stat.st_size, "mtime": remote_stat.st_mtime
+            }
+        _save_manifest(manifest_path, updates)
+        logging.info(f"Uploaded {len(to_upload) - len(failed)} of {len(local_paths)} file(s) to {self.ip}")
+        return [None if remote_path in failed else remote_path for remote_path in remote_paths]
+
+    def _upload(self, local_path, remote_path):
+        """Uploads the file on its own SFTP channel (put() pipelines the writes), returns False on errors"""
+        self._drop_cached(remote_path)
+        try:
+            sftp_cl = self.root_cl.open_sftp()
+            try:
+                sftp_cl.put(str(local_path), remote_path)
+            finally:
+                sftp_cl.close()
+        except (paramiko.SFTPError, SSHException, EOFError, IOError) as error:
+            logging.error(f"There was an error {error} while copying the file {local_path} to {remote_path}")
+            return False
+        metrics.add(self.ip, "bytes_sent", local_path.stat().st_size)
+        logging.info(f"File {local_path} has been copied to {remote_path}")
+        return True
+
+    def _stat(self, remote_path):
+        try:
+            return self.sftp_cl.stat(remote_path)
+        except IOError:
+            return None
+
+    def _remote_sha256(self, remote_paths):
+        paths = " ".join(shlex.quote(remote_path) for remote_path in remote_paths)
+        output = self.send_exec_commands(f"sha256sum {paths}") or ""
+        hashes = {}
+        for line in output.splitlines():
+            # "<hash>  <path>", the path can contain spaces
+            match = re.match(r"(?P<hash>[0-9a-f]{64}) [ *](?P<path>.+)$", line)
+            if match:
+                hashes[match.group("path")] = match.group("hash")
+        return hashes
+
     # -----------------------------Path actions----------------------------#
+    def makedirs(self, remote_path):
+        """Creates the remote directory with all parent directories"""
+        path = ""
+        for part in remote_path.strip("/").split("/"):
+            path = f"{path}/{part}"
+            if self._stat(path) is None:
+                self.mkdir(path)
+
     def change_dir(self, dir_path):
         try:
             logging.info(f"Change directory to {dir_path}")
@@ -319,79 +1266,167 @@ class SFTPParamiko:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    # -----------------------------Exec commands----------------------------#
+    def send_exec_commands(self, commands, print_output=True):
+        """Runs commands as root on the same transport as SFTP"""
+        return _exec_commands(self.root_cl, self.ip, commands, print_output)
+
     def close(self):
-        self.root_cl.close()
+        # The transport stays in the connection pool, only the SFTP session is closed
+        self.sftp_cl.close()
         logging.info(f"<<<<< Close SFTP connection {self.ip}")
 
 
 class RESTfulAPIClient:
+    # ubus session timeout in seconds, the token is refreshed before it expires
+    session_timeout = 300
+    refresh_margin = 30
+    # Keep-alive HTTP connections shared by all clients
+    _http_session = requests.Session()
+    _http_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+    # Cached ubus session tokens: {(ip, login): (token, expiration time)}
+    _tokens = {}
+    _tokens_lock = threading.Lock()
+
     def __init__(self, **device_data):
         self.ip = device_data["ip"]
         self.login = device_data["login"]
         self.password = device_data["password"]
+        self.url = f"http://{self.ip}/api"
 
         logging.info(f">>>>> Connection to {self.ip} with RESTful API")
         try:
-            connection = requests.post(f"http://{self.ip}/api", json=
-            {
-                "jsonrpc": "2.0",
-                "id": 1,
-                "method": "call",
-                "params":
-                    ["00000000000000000000000000000000", "session", "login",
-                     {
-                         "username": self.login, "password": self.password, "timeout": 300
-                     }
-                     ]
-            })
-            self.connection_id = connection.json()["result"][1]["ubus_rpc_session"]
+            self.connection_id = self._get_token()
             logging.info("Connected to %s", self.ip)
             logging.debug("Connection id is %s", self.connection_id)
-        except (IndexError, OSError, requests.exceptions.ConnectionError):
+        except (IndexError, KeyError, TypeError, ValueError, OSError, requests.exceptions.RequestException):
             logging.error("Can't connect to %s", self.ip)
 
-    def send_command_restapi(self, service, action, json_commands):
-        if action not in ["setprm", "getprm", "getsts"]:
-            logging.error("Invalid action in function send_command_restapi")
+    def _post(self, payload):
+        with metrics.measure(self.ip, "RESTful API request"):
+            response = self._http_session.post(self.url, json=payload, timeout=30)
+        metrics.add(self.ip, "bytes_received", len(response.content))
+        return response.json()
+
+    def _get_token(self, refresh=False):
+        """Returns the cached ubus session token, logs in if it is missing or about to expire"""
+        key = (self.ip, self.login)
+        with self._tokens_lock:
+            token, expiration = self._tokens.get(key, (None, 0))
+        if not refresh and token and time.monotonic() < expiration:
+            return token
+        response = self._post(_jsonrpc_request(
+            1, "00000000000000000000000000000000", "session", "login",
+            {"username": self.login, "password": self.password, "timeout": self.session_timeout}
+        ))
+        token = response["result"][1]["ubus_rpc_session"]
+        self._touch_token(token)
+        return token
+
+    def _touch_token(self, token):
+        # ubus prolongs the session on each call
+        with self._tokens_lock:
+            self._tokens[(self.ip, self.login)] = (
+                token, time.monotonic() + self.session_timeout - self.refresh_margin
+            )
+
+    def _send(self, commands):
+        """Sends commands in one JSON-RPC batch, logs in again once if the session has expired"""
+        for refresh in (False, True):
+            self.connection_id = self._get_token(refresh)
+            payload = [_jsonrpc_request(request_id, self.connection_id, service, action, json_commands)
+                       for request_id, (service, action, json_commands) in enumerate(commands, 1)]
+            responses = self._post(payload)
+            if isinstance(responses, dict):
+                responses = [responses]
+            responses = sorted(responses, key=lambda response: response.get("id", 0))
+            if not any(response.get("result", [0])[0] == UBUS_STATUS_PERMISSION_DENIED
+                       for response in responses):
+                break
+            logging.debug("Session on %s has expired", self.ip)
+        self._touch_token(self.connection_id)
+        return responses
+
+    def _check_response(self, response):
+        try:
+            if response['result'][1]["retcode"] != 0:
+                logging.error("Commands don't send on %s. Error: %s", self.ip, response['result'][1]['retmsg'])
+                return False
+            logging.debug("Result received from %s: %s", self.ip, response)
+            return response
+        except (KeyError, IndexError):
+            logging.error("Commands don't send on %s. Error: %s. Check the service name.",
+                          self.ip, response.get('error', response.get('result')))
             return False
+
+    def send_command_restapi(self, service, action, json_commands):
+        result = self.send_batch_restapi([(service, action, json_commands)])
+        return result[0] if result else False
+
+    def send_batch_restapi(self, commands):
+        """
+        Sends many commands in one HTTP request (JSON-RPC 2.0 batch).
+
+        :param commands: list of (service, action, json_commands)
+        :return: list of results in the order of commands, False for failed commands
+        """
+        for _, action, _ in commands:
+            if action not in ["setprm", "getprm", "getsts"]:
+                logging.error("Invalid action in function send_command_restapi")
+                return False
         logging.info(">>>>> Sending commands to %s", self.ip)
         try:
-            r = requests.post(f"http://{self.ip}/api", json=
-            {
-                "jsonrpc": "2.0",
-                "id": 1,
-                "method": "call",
-                "params":
-                    [
-                        self.connection_id, service, action, json_commands
-                    ]
-            }
-                              )
-        except (IndexError, OSError, requests.exceptions.ConnectionError):
+            responses = self._send(commands)
+        except (IndexError, KeyError, TypeError, ValueError, OSError, requests.exceptions.RequestException):
             logging.error("Error occurred on %s", self.ip)
             return False
-        try:
-            if r.json()['result'][1]["retcode"] != 0:
-                logging.error("Commands don't send on %s. Error: %s", self.ip, r.json()['result'][1]['retmsg'])
-                return False
+        results = [self._check_response(response) for response in responses]
+        if all(results):
             logging.info("Commands sent successfully on %s", self.ip)
-            logging.debug("Result received from %s: %s", self.ip, r.json())
-            return r.json()
-        except KeyError:
-            logging.error("Commands don't send on %s. Error: %s. Check the service name.", self.ip, r.json()['error'])
-            return False
+        return results
+
+
+def _jsonrpc_request(request_id, session_id, service, action, params):
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "method": "call",
+        "params": [session_id, service, action, params]
+    }
 
 
 class ScanDevices:
-    def __init__(self, devices_connection_data, test_devices):
+    # Devices which passed the scan are not scanned again for ttl seconds:
+    # {(ip, port, check_auth): time of the scan}
+    _passed = {}
+    _passed_lock = threading.Lock()
+
+    def __init__(self, devices_connection_data, test_devices, ttl=300,
+                 keep_connections=False, with_root=False):
         self.params_list = []
+        self.ttl = ttl
+        # Authenticated connections are left in the connection pool for the next phase,
+        # with_root also leaves a shell where root is already obtained (see _open_device)
+        self.keep_connections = keep_connections
+        self.with_root = with_root
 
         for dev in test_devices:
             self.params_list.append(devices_connection_data[dev])
 
+    @staticmethod
+    def _scan_port(device_params):
+        # REST devices can set "scan_port: 80" in the connection data
+        return device_params.get("scan_port", 22)
+
+    @classmethod
+    def _is_ssh(cls, device_params):
+        return cls._scan_port(device_params) == 22
+
     def _scan_device(self, device_params):
         ip_address = device_params["ip"]
         logging.info(f"Scanning device {ip_address} for test")
+        if self.keep_connections:
+            return self._open_device(device_params)
         try:
             with SSHClient() as ssh:
                 ssh.set_missing_host_key_policy(AutoAddPolicy())
@@ -411,14 +1446,627 @@ class ScanDevices:
             logging.error(f"An error {error} occurred on {ip_address}")
             return False
 
-    def scan_devices(self, limit=10):
-        scan_success = []
-        scan_fail = []
-        with ThreadPoolExecutor(max_workers=limit) as executor:
-            result = executor.map(self._scan_device, self.params_list)
-            for device, status in zip(self.params_list, result):
-                if status:
-                    scan_success.append(device["ip"])
+    def _open_device(self, device_params):
+        """
+        Authenticates with the credentials of the next phase and leaves the transport in the pool:
+        root for devices with root_password (SFTP of the network manager), the login for the others.
+        with_root also parks a shell with root obtained, as BaseSSHParamiko opens it for the test.
+        """
+        ip_address = device_params["ip"]
+        device_type = device_params.get("device_type", "default")
+        try:
+            if device_params.get("root_password"):
+                connection_pool.acquire(ip_address, "root", device_params["root_password"], device_type)
+            else:
+                connection_pool.acquire(ip_address, device_params["login"], device_params["password"], device_type)
+            if self.with_root and device_params.get("root_password"):
+                BaseSSHParamiko(**device_params).park()
+            return True
+        except (ErrorInConnectionException, socket.timeout, paramiko.SSHException, OSError) as error:
+            logging.error(f"An error {error} occurred on {device_params['ip']}")
+            return False
+
+    async def _probe_port(self, ip_address, port, timeout, semaphore):
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(ip_address, port), timeout)
+                writer.close()
+                return True
+            except (asyncio.TimeoutError, OSError) as error:
+                logging.error(f"Port {port} on {ip_address} is not available: {error or 'timeout'}")
+                return False
+
+    async def _probe_ports(self, params_list, timeout, limit):
+        semaphore = asyncio.Semaphore(limit)
+        return await asyncio.gather(*(
+            self._probe_port(device["ip"], self._scan_port(device), timeout, semaphore)
+            for device in params_list
+        ))
+
+    def scan_devices(self, limit=10, check_auth=True, timeout=1, probe_limit=256):
+        """
+        Checks the availability of devices in two stages: TCP connect to the SSH (or REST) port
+        of all devices at once, then SSH authentication only on the devices which answered.
+
+        :param limit: number of devices authenticated at once
+        :param check_auth: check authentication on the devices after TCP connect
+        :param timeout: timeout in seconds of TCP connect
+        :param probe_limit: number of TCP connects at once
+        :return: lists of IP addresses of available and unavailable devices
+        """
+        now = time.monotonic()
+        with self._passed_lock:
+            to_scan = [device for device in self.params_list
+                       if now - self._passed.get(self._cache_key(device, check_auth), -self.ttl) >= self.ttl]
+        status = {device["ip"]: True for device in self.params_list}
+        if to_scan:
+            logging.info(f"Checking ports of {len(to_scan)} device(s)")
+            reachable = asyncio.run(self._probe_ports(to_scan, timeout, probe_limit))
+            for device, probe in zip(to_scan, reachable):
+                status[device["ip"]] = probe
+            if check_auth:
+                # REST devices have no SSH login, the TCP connect is their check
+                to_auth = [device for device in to_scan if status[device["ip"]] and self._is_ssh(device)]
+                with ThreadPoolExecutor(max_workers=limit) as executor:
+                    for device, auth in zip(to_auth, executor.map(self._scan_device, to_auth)):
+                        status[device["ip"]] = auth
+            with self._passed_lock:
+                for device in to_scan:
+                    if status[device["ip"]]:
+                        self._passed[self._cache_key(device, check_auth)] = now
+
+        scan_success = [device["ip"] for device in self.params_list if status[device["ip"]]]
+        scan_fail = [device["ip"] for device in self.params_list if not status[device["ip"]]]
+        return scan_success, scan_fail
+
+    def _cache_key(self, device_params, check_auth):
+        return device_params["ip"], self._scan_port(device_params), check_auth
+
+    @classmethod
+    def invalidate(cls, ip_address):
+        """Forgets the scan results of the device, e.g. after reboot"""
+        with cls._passed_lock:
+            for key in [key for key in cls._passed if key[0] == ip_address]:
+                del cls._passed[key]
+
+
+# -----------------------------Async clients----------------------------#
+class AsyncClient:
+    """
+    Base asyncio wrapper over the blocking clients.
+    Blocking calls run in the executor of the event loop, so many devices are served at once.
+    """
+    sync_class = None
+
+    def __init__(self, **device_data):
+        self.device_data = device_data
+        self.ip = device_data["ip"]
+        self.client = None
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(function, *args, **kwargs))
+
+    async def connect(self):
+        self.client = await self._run(self.sync_class, **self.device_data)
+        return self
+
+    async def close(self):
+        if self.client is not None and hasattr(self.client, "close"):
+            await self._run(self.client.close)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncSSHParamiko(AsyncClient):
+    sync_class = BaseSSHParamiko
+
+    async def send_shell_commands(self, commands, **kwargs):
+        return await self._run(self.client.send_shell_commands, commands, **kwargs)
+
+    async def send_shell_batch(self, commands, window=None, timeout=None):
+        return await self._run(self.client.send_shell_batch, commands, window, timeout)
+
+    async def send_exec_commands(self, commands, print_output=True, parallel=False,
+                                 max_channels=MAX_PARALLEL_CHANNELS):
+        return await self._run(self.client.send_exec_commands, commands, print_output,
+                               parallel, max_channels)
+
+
+class AsyncSFTPParamiko(AsyncClient):
+    sync_class = SFTPParamiko
+
+    async def read_file(self, file_path):
+        return await self._run(self.client.read_file, file_path)
+
+    async def add_to_file(self, content, file_path):
+        return await self._run(self.client.add_to_file, content, file_path)
+
+    async def overwrite_file(self, content, file_path):
+        return await self._run(self.client.overwrite_file, content, file_path)
+
+    async def put_file(self, local_path, remote_path):
+        return await self._run(self.client.put_file, local_path, remote_path)
+
+    async def send_exec_commands(self, commands, print_output=True):
+        return await self._run(self.client.send_exec_commands, commands, print_output)
+
+
+class AsyncRESTfulAPIClient(AsyncClient):
+    sync_class = RESTfulAPIClient
+
+    async def send_command_restapi(self, service, action, json_commands):
+        return await self._run(self.client.send_command_restapi, service, action, json_commands)
+
+    async def send_batch_restapi(self, commands):
+        return await self._run(self.client.send_batch_restapi, commands)
+
+
+async def run_on_fleet(devices_connection_data, commands, limit=10, exec_commands=False, **kwargs):
+    """
+    Sends commands to many devices at once, no more than limit devices at a time.
+
+    :param devices_connection_data: dictionary {device: connection data} of devices for commands
+    :param commands: command or list of commands for all devices,
+                     or dictionary {device: commands} with own commands for each device
+    :param limit: maximum number of devices configured at the same time
+    :param exec_commands: send commands to exec channels instead of the shell
+    :param kwargs: parameters for send_shell_commands (expect, timeout)
+    :return: dictionary {device: output}, False for devices with errors
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_on_device(device):
+        device_commands = commands[device] if isinstance(commands, dict) else commands
+        async with semaphore:
+            try:
+                async with AsyncSSHParamiko(**devices_connection_data[device]) as ssh:
+                    if exec_commands:
+                        return await ssh.send_exec_commands(device_commands)
+                    return await ssh.send_shell_commands(device_commands, **kwargs)
+            except (ErrorInConnectionException, OSError) as error:
+                logging.error(f"An error {error} occurred on {device}")
+                return False
+
+    devices = list(devices_connection_data)
+    results = await asyncio.gather(*(run_on_device(device) for device in devices))
+    return dict(zip(devices, results))
+
+
+def send_commands_to_fleet(devices_connection_data, commands, limit=10, **kwargs):
+    """Blocking entry point for run_on_fleet, the executor has a thread for each concurrent device"""
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=limit))
+        return await run_on_fleet(devices_connection_data, commands, limit, **kwargs)
+
+    return asyncio.run(main())
+
+
+# -----------------------------Readiness----------------------------#
+# Backoff between probes of a device which is not ready yet
+READY_POLICY = RetryPolicy(base_delay=1, max_delay=15, jitter=0.3)
+# Id of the current boot of Linux, a new one is generated on each boot
+BOOT_ID_COMMAND = "cat /proc/sys/kernel/random/boot_id"
+# Timeout in seconds of the prompt and of the commands of readiness probes
+PROBE_TIMEOUT = 5
+
+
+async def probe_ssh_banner(device_data, timeout=2):
+    """Cheap probe: the SSH server of the device sends its banner"""
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(device_data["ip"], device_data.get("scan_port", 22)), timeout
+        )
+        try:
+            banner = await asyncio.wait_for(reader.readline(), timeout)
+        finally:
+            writer.close()
+        return banner.startswith(b"SSH-")
+    except (asyncio.TimeoutError, OSError):
+        return False
+
+
+def _probe_ssh(device_data):
+    """
+    Session for a readiness probe: one connect with a short timeout ("probe" retry policy),
+    so that a probe does not overrun the deadline of the waiter
+    """
+    return open_ssh(**{**device_data, "device_type": "probe", "timeout": PROBE_TIMEOUT})
+
+
+def probe_prompt(device_data):
+    """The device accepts the login and returns the prompt. Use after probe_ssh_banner."""
+    try:
+        with _probe_ssh(device_data) as ssh:
+            return bool(ssh.promt)
+    except (ErrorInConnectionException, paramiko.SSHException, OSError) as error:
+        logging.debug(f"The prompt of {device_data['ip']} is not available: {error}")
+        return False
+
+
+def probe_rebooted(boot_ids):
+    """
+    Returns a probe which passes when the device has booted again: its boot id differs from
+    the one read before the reboot. sshd answers for a while after the reboot command,
+    so the other probes can pass on a device which is still going down.
+
+    :param boot_ids: dictionary {ip: boot id before the reboot}, devices without it are not checked
+    """
+    def probe(device_data):
+        boot_id = boot_ids.get(device_data["ip"])
+        if boot_id is None:
+            return True
+        try:
+            with _probe_ssh(device_data) as ssh:
+                output = ssh.send_exec_commands(BOOT_ID_COMMAND)
+        except (ErrorInConnectionException, paramiko.SSHException, OSError) as error:
+            logging.debug(f"The boot id of {device_data['ip']} is not available: {error}")
+            return False
+        return bool(output and output.strip()) and output.strip() != boot_id
+    return probe
+
+
+def probe_command(commands, pattern):
+    """
+    Returns a probe which sends commands to the shell of the device
+    and checks their output by the pattern, e.g. the state of "ip -j addr" or a "show" status
+    """
+    def probe(device_data):
+        try:
+            with _probe_ssh(device_data) as ssh:
+                output = ssh.send_shell_commands(commands)
+        except (ErrorInConnectionException, paramiko.SSHException, OSError) as error:
+            logging.debug(f"The probe {commands} on {device_data['ip']} failed: {error}")
+            return False
+        return bool(re.search(pattern, output or ""))
+    return probe
+
+
+async def _wait_device_ready(device_data, probes, deadline, policy, semaphore):
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        ready = True
+        async with semaphore:
+            for probe in probes:
+                if asyncio.iscoroutinefunction(probe):
+                    ready = await probe(device_data)
                 else:
-                    scan_fail.append(device["ip"])
-            return scan_success, scan_fail
+                    ready = await loop.run_in_executor(None, probe, device_data)
+                if not ready:
+                    break
+        if ready:
+            metrics.add(device_data["ip"], "ready_seconds", time.monotonic() - start)
+            return True
+        remaining = start + deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(policy.delay(attempt), remaining))
+        attempt += 1
+
+
+def wait_until_ready(devices_connection_data, devices, probes=(probe_ssh_banner, probe_prompt),
+                     deadline=300, limit=32, policy=READY_POLICY):
+    """
+    Polls the devices at once until each of them passes all the probes or its deadline expires.
+
+    :param devices_connection_data: dictionary with data for connecting to devices
+    :param devices: list of devices to wait for
+    :param probes: probes which are run one after another, a probe is a function or coroutine
+                   (device_data) -> bool, the next probe is run only if the previous one passed
+    :param deadline: maximum wait in seconds for each device
+    :param limit: maximum number of devices probed at the same time
+    :param policy: backoff between the probes of a device
+    :return: list of ready devices, list of devices which were not ready before the deadline
+    """
+    logging.info(f"Waiting until devices are ready: {devices}")
+
+    async def main():
+        semaphore = asyncio.Semaphore(limit)
+        return await asyncio.gather(*(
+            _wait_device_ready(devices_connection_data[device], probes, deadline, policy, semaphore)
+            for device in devices
+        ))
+
+    results = asyncio.run(main()) if devices else []
+    ready = [device for device, result in zip(devices, results) if result]
+    not_ready = [device for device, result in zip(devices, results) if not result]
+    if not_ready:
+        logging.error(f"Devices are not ready after {deadline} s: {not_ready}")
+    return ready, not_ready
+
+
+# -----------------------------Connection broker----------------------------#
+class BrokerClient:
+    """Connection to the broker: one JSON request per line, one JSON response per line"""
+    def __init__(self, socket_path=BROKER_SOCKET_PATH):
+        self.socket_path = socket_path
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(str(socket_path))
+        self._file = self._socket.makefile("rwb")
+
+    def request(self, op, **params):
+        # Connection data from the inventory has read-only mappings
+        self._file.write(json.dumps({"op": op, **params}, default=dict).encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ErrorInConnectionException("The connection broker closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise ErrorInConnectionException(response["error"])
+        return response["result"]
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+class BrokerSSH:
+    """
+    Shell session kept by the connection broker, has the same methods as BaseSSHParamiko
+    (without streaming). The shell lives until close().
+    """
+    def __init__(self, socket_path=BROKER_SOCKET_PATH, **device_data):
+        self.ip = device_data["ip"]
+        logging.info(f">>>>> Connection to {self.ip} through the broker")
+        self._broker = BrokerClient(socket_path)
+        try:
+            self.promt = self._broker.request("open", device=device_data)
+        except ErrorInConnectionException:
+            self._broker.close()
+            raise
+
+    def _call(self, method, *args):
+        with metrics.measure(self.ip, _broker_label(method, args)):
+            return self._broker.request("ssh", method=method, args=list(args))
+
+    def send_shell_commands(self, commands, print_output=True, expect=None, timeout=None):
+        return self._call("send_shell_commands", commands, print_output, expect, timeout)
+
+    def send_shell_batch(self, commands, window=None, timeout=None):
+        return self._call("send_shell_batch", commands, window, timeout)
+
+    def send_exec_commands(self, commands, print_output=True, parallel=False,
+                           max_channels=MAX_PARALLEL_CHANNELS):
+        return self._call("send_exec_commands", commands, print_output, parallel, max_channels)
+
+    def wait_for_prompt(self, timeout=None):
+        return self._call("wait_for_prompt", timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._broker._socket.fileno() == -1
+
+    def close(self):
+        self._broker.close()
+        logging.info(f"<<<<< Close connection {self.ip}")
+
+
+class BrokerSFTP:
+    """File actions of SFTPParamiko done by the connection broker"""
+    def __init__(self, socket_path=BROKER_SOCKET_PATH, **device_data):
+        self.ip = device_data["ip"]
+        self.device_data = device_data
+        self._broker = BrokerClient(socket_path)
+
+    def _call(self, method, *args):
+        with metrics.measure(self.ip, _broker_label(method, args)):
+            return self._broker.request("sftp", device=self.device_data, method=method, args=list(args))
+
+    def read_file(self, file_path):
+        return self._call("read_file", file_path)
+
+    def add_to_file(self, content, file_path):
+        return self._call("add_to_file", content, file_path)
+
+    def overwrite_file(self, content, file_path):
+        return self._call("overwrite_file", content, file_path)
+
+    def sync_files(self, local_paths, remote_dir, mode=None):
+        return self._call("sync_files", [str(Path(path).absolute()) for path in local_paths], remote_dir, mode)
+
+    def send_exec_commands(self, commands, print_output=True):
+        return self._call("send_exec_commands", commands, print_output)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._broker.close()
+
+
+def _broker_label(method, args):
+    """
+    The broker does the device I/O in its own process, so the time of a request is recorded
+    by the client under the command (the first one of a list) or under the file action
+    """
+    commands = args[0] if args and method in BROKER_SSH_METHODS[:3] else None
+    if commands:
+        return f"broker: {_command_label(commands if type(commands) == str else commands[0])}"
+    return f"broker: {method}"
+
+
+def _broker_running(socket_path=BROKER_SOCKET_PATH):
+    return os.path.exists(socket_path)
+
+
+def open_ssh(**device_data):
+    """Returns the session of the connection broker if it is running, otherwise BaseSSHParamiko"""
+    if _broker_running():
+        try:
+            return BrokerSSH(**device_data)
+        except OSError as error:
+            logging.warning(f"The connection broker is not available: {error}")
+    return BaseSSHParamiko(**device_data)
+
+
+def open_sftp(**device_data):
+    """Returns BrokerSFTP if the connection broker is running, otherwise SFTPParamiko"""
+    if _broker_running():
+        try:
+            return BrokerSFTP(**device_data)
+        except OSError as error:
+            logging.warning(f"The connection broker is not available: {error}")
+    return SFTPParamiko(**device_data)
+
+
+def invalidate_device(ip):
+    """
+    Forgets the connections to the device and its scan results, e.g. after reboot:
+    in this process and in the connection broker, which would hand out its dead sessions otherwise
+    """
+    connection_pool.invalidate(ip)
+    ScanDevices.invalidate(ip)
+    if _broker_running():
+        try:
+            broker = BrokerClient()
+            try:
+                broker.request("invalidate", ip=ip)
+            finally:
+                broker.close()
+        except (OSError, ErrorInConnectionException) as error:
+            logging.warning(f"The connection broker did not forget {ip}: {error}")
+
+
+# -----------------------------Klish sessions----------------------------#
+KLISH_LINUX = "linux"
+KLISH_EXEC = "exec"
+KLISH_CONFIGURE = "configure"
+KLISH_PROFILE = "profile"
+KLISH_PROFILE_PATTERN = r"^\S+ config profile\d+$"
+# Commands which move the session one mode deeper and one mode back
+KLISH_ENTER = {KLISH_LINUX: "run-klish", KLISH_EXEC: "configure terminal"}
+KLISH_LEAVE = {KLISH_PROFILE: "up", KLISH_CONFIGURE: "exit", KLISH_EXEC: "exit"}
+KLISH_MODES = [KLISH_LINUX, KLISH_EXEC, KLISH_CONFIGURE, KLISH_PROFILE]
+
+
+class KlishSession:
+    """
+    Shell session on SSFP which remembers the klish mode it is in
+    (Linux shell, klish exec, configure, profile) and sends only the mode transitions it needs.
+    The session stays open between command files, see klish_session().
+    """
+    def __init__(self, ssh):
+        self.ssh = ssh
+        self.ip = ssh.ip
+        self.mode = KLISH_LINUX
+        self.broken = False
+
+    @property
+    def closed(self):
+        return self.broken or self.ssh.closed
+
+    def _transitions(self, target):
+        """Returns the commands which move the session from the current mode to the target mode"""
+        commands = []
+        mode = self.mode
+        while KLISH_MODES.index(mode) > KLISH_MODES.index(target):
+            commands.append(KLISH_LEAVE[mode])
+            mode = KLISH_MODES[KLISH_MODES.index(mode) - 1]
+        while KLISH_MODES.index(mode) < KLISH_MODES.index(target):
+            if mode == KLISH_CONFIGURE:
+                raise ValueError("The profile mode is entered only by the 'config profile' command")
+            commands.append(KLISH_ENTER[mode])
+            mode = KLISH_MODES[KLISH_MODES.index(mode) + 1]
+        return commands
+
+    def _plan(self, commands):
+        """
+        Replaces the mode commands of a command file with the transitions needed from the current mode.
+        Returns the commands to send and the mode after them.
+        """
+        planned = []
+        start_mode = self.mode
+        try:
+            for command in commands:
+                command = command.strip()
+                if not command:
+                    continue
+                if command == KLISH_ENTER[KLISH_LINUX]:
+                    if self.mode == KLISH_LINUX:
+                        planned.append(command)
+                        self.mode = KLISH_EXEC
+                elif command == KLISH_ENTER[KLISH_EXEC]:
+                    planned.extend(self._transitions(KLISH_CONFIGURE))
+                    self.mode = KLISH_CONFIGURE
+                elif re.search(KLISH_PROFILE_PATTERN, command):
+                    planned.extend(self._transitions(KLISH_CONFIGURE))
+                    planned.append(command)
+                    self.mode = KLISH_PROFILE
+                elif command in ("up", "exit") and self.mode != KLISH_LINUX:
+                    planned.append(command)
+                    self.mode = KLISH_MODES[KLISH_MODES.index(self.mode) - 1]
+                else:
+                    planned.append(command)
+            return planned, self.mode
+        finally:
+            self.mode = start_mode
+
+    def send_commands(self, commands, window=None, timeout=None):
+        """
+        Sends the commands of a command file in the session.
+        The commands 'run-klish' and 'configure terminal' are sent only if the session is not in klish
+        or in the configure mode yet, the profile mode is left with 'up' when needed.
+
+        :param commands: list of commands
+        :param window: maximum number of commands sent at once, None - all commands
+        :param timeout: timeout in seconds for each command
+        :return: list of dictionaries {"command": command, "output": output, "error": True/False}
+        """
+        planned, mode = self._plan(commands)
+        skipped = len([command for command in commands if command.strip()]) - len(planned)
+        if skipped > 0:
+            logging.info(f"The session on {self.ip} is in the {self.mode} mode, {skipped} commands are not sent")
+        results = self.ssh.send_shell_batch(planned, window, timeout)
+        mode_commands = set(KLISH_ENTER.values()) | set(KLISH_LEAVE.values())
+        failed = [result for result in results if result["error"] and
+                  (result["command"] in mode_commands or re.search(KLISH_PROFILE_PATTERN, result["command"]))]
+        if len(results) < len(planned) or failed:
+            # The mode of the shell is unknown, the next klish_session() opens a new session
+            logging.error(f"The klish mode on {self.ip} is unknown, the session will be reopened")
+            self.broken = True
+        else:
+            self.mode = mode
+        return results
+
+    def close(self):
+        # The shell is closed, not parked: it may be left in klish
+        self.ssh.close()
+
+
+_klish_sessions = {}
+
+
+def klish_session(**device_data):
+    """Returns the open klish session on the device or opens a new one"""
+    session = _klish_sessions.get(device_data["ip"])
+    if session is None or session.closed:
+        if session is not None:
+            session.close()
+        session = KlishSession(open_ssh(**device_data))
+        _klish_sessions[device_data["ip"]] = session
+    return session
+
+
+def close_klish_sessions():
+    for session in _klish_sessions.values():
+        session.close()
+    _klish_sessions.clear()
+
+
+atexit.register(close_klish_sessions)
@@ -0,0 +1,208 @@
+"""
+Inventory of the lab: devices.yaml (connection data) and network_params_for_test.yaml.
+
+The files are parsed once with the C loader of PyYAML and checked against a small schema.
+The parsed data is kept in a binary cache keyed by the mtime, size and hash of the files,
+so the next runs and every pytest fixture get the inventory without parsing YAML.
+The model is immutable: mappings are read-only and lists are tuples,
+connection_data_dict() and network_params_dict() return mutable copies.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from pathlib import Path
+from types import MappingProxyType
+
+import yaml
+
+path_home = Path(Path.home(), 'python', 'auto_network_test_system')
+path_connection = Path(path_home, 'data', 'connection_data')
+path_test_network = Path(path_home, 'data', 'network_test_configs')
+
+DEVICES_PATH = Path(path_connection, 'devices.yaml')
+NETWORK_PARAMS_PATH = Path(path_test_network, 'network_params_for_test.yaml')
+INVENTORY_CACHE_PATH = Path(Path.home(), ".cache", "ants", "inventory.pickle")
+
+# The C loader is much faster, the pure Python one is used if PyYAML is built without libyaml
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Types of known keys, other keys are allowed
+DEVICE_SCHEMA = {
+    "ip": str, "login": str, "password": str, "root_password": str,
+    "switch1": str, "port1": (int, str), "switch2": str, "port2": (int, str),
+    "timeout": (int, float), "scan_port": int, "type": str, "device_type": str,
+    "vlan_domain": str, "uplinks": dict,
+}
+NETWORK_PARAMS_SCHEMA = {
+    "vlan": (int, str, list), "ip": str, "interface": str, "netmask": str,
+    "ip_port_a": str, "ip_port_b": str, "netmask_port_a": str, "netmask_port_b": str,
+}
+
+
+class ErrorInInventoryException(Exception):
+    pass
+
+
+def _check_entry(file_name: str, name: str, entry, schema: dict, required=()):
+    if not isinstance(entry, dict):
+        raise ErrorInInventoryException(f"{file_name}: {name} should be a mapping")
+    for key in required:
+        if key not in entry:
+            raise ErrorInInventoryException(f"{file_name}: {name} has no '{key}'")
+    for key, value in entry.items():
+        if key in schema and not isinstance(value, schema[key]):
+            raise ErrorInInventoryException(f"{file_name}: '{key}' of {name} has a wrong type {type(value).__name__}")
+    for switch_key, port_key in (("switch1", "port1"), ("switch2", "port2")):
+        if entry.get(switch_key) and port_key not in entry:
+            raise ErrorInInventoryException(f"{file_name}: {name} has '{switch_key}' without '{port_key}'")
+
+
+def validate_devices(devices: dict):
+    """devices.yaml: {group: {device: connection data}}, every device has an IP address"""
+    if not isinstance(devices, dict):
+        raise ErrorInInventoryException("devices.yaml should be a mapping of groups")
+    seen = set()
+    for group, group_devices in devices.items():
+        if not isinstance(group_devices, dict):
+            raise ErrorInInventoryException(f"devices.yaml: group {group} should be a mapping")
+        for name, data in group_devices.items():
+            if name in seen:
+                raise ErrorInInventoryException(f"devices.yaml: device {name} is defined twice")
+            seen.add(name)
+            _check_entry("devices.yaml", name, data, DEVICE_SCHEMA, required=("ip",))
+
+
+def validate_network_params(network_params: dict):
+    """network_params_for_test.yaml: {device type: {device: network params}}"""
+    if not isinstance(network_params, dict):
+        raise ErrorInInventoryException("network_params_for_test.yaml should be a mapping of device types")
+    for device_type, devices in network_params.items():
+        if not isinstance(devices, dict):
+            raise ErrorInInventoryException(f"network_params_for_test.yaml: {device_type} should be a mapping")
+        for name, params in devices.items():
+            _check_entry("network_params_for_test.yaml", name, params, NETWORK_PARAMS_SCHEMA)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+class Inventory:
+    """Immutable device model with indexes by name, group, type and IP address"""
+    def __init__(self, devices: dict, network_params: dict):
+        self.groups = _freeze({group: list(group_devices) for group, group_devices in devices.items()})
+        # {device: connection data}, the flat dictionary used by all entry points
+        self.devices_connection_data = _freeze({name: data for group_devices in devices.values()
+                                                for name, data in group_devices.items()})
+        # {device type: {device: network params}}
+        self.network_params = _freeze(network_params)
+        # {device type: (devices)} as in ResourceManager.get_all_devices_for_test
+        self.devices_by_type = MappingProxyType({device_type: tuple(params)
+                                                 for device_type, params in network_params.items()})
+        self.device_types = MappingProxyType({name: device_type
+                                              for device_type, params in network_params.items() for name in params})
+        self.devices_by_ip = MappingProxyType({data["ip"]: name for name, data in self.devices_connection_data.items()})
+
+    def connection_data(self, device: str):
+        try:
+            return self.devices_connection_data[device]
+        except KeyError:
+            raise ErrorInInventoryException(f"Unknown device: {device}")
+
+    def params(self, device: str):
+        """Returns the network params for test of the device"""
+        return self.network_params[self.device_types[device]][device]
+
+    def connection_data_dict(self) -> dict:
+        return _thaw(self.devices_connection_data)
+
+    def network_params_dict(self) -> dict:
+        return _thaw(self.network_params)
+
+
+def _file_key(path: Path):
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def _load_cache(cache_path: Path) -> dict:
+    try:
+        with open(cache_path, "rb") as file:
+            return pickle.load(file)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return {}
+
+
+def _save_cache(cache_path: Path, cache: dict):
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as file:
+            pickle.dump(cache, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as error:
+        logging.warning(f"Cannot save the inventory cache {cache_path}: {error}")
+
+
+def _load_file(path: Path, cache: dict, validate) -> tuple:
+    """Returns the parsed file and True if the cache was changed"""
+    mtime, size = _file_key(path)
+    entry = cache.get(str(path))
+    if entry and (entry["mtime"], entry["size"]) == (mtime, size):
+        return entry["data"], False
+    digest = _sha256(path)
+    if entry and entry["sha256"] == digest:
+        # The file was touched but not changed
+        entry.update(mtime=mtime, size=size)
+        return entry["data"], True
+    with open(path, encoding="UTF-8") as file:
+        data = yaml.load(file, Loader=YamlLoader)
+    validate(data)
+    cache[str(path)] = {"mtime": mtime, "size": size, "sha256": digest, "data": data}
+    return data, True
+
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def load_inventory(devices_path: Path = None, network_params_path: Path = None,
+                   cache_path: Path = None) -> Inventory:
+    """
+    Returns the inventory of the lab. In one process the inventory is built once
+    while the files are not changed, between processes it is taken from the binary cache.
+    """
+    devices_path = Path(devices_path or DEVICES_PATH)
+    network_params_path = Path(network_params_path or NETWORK_PARAMS_PATH)
+    cache_path = Path(cache_path or INVENTORY_CACHE_PATH)
+    key = (devices_path, _file_key(devices_path), network_params_path, _file_key(network_params_path))
+    with _inventories_lock:
+        if key in _inventories:
+            return _inventories[key]
+        cache = _load_cache(cache_path)
+        devices, devices_changed = _load_file(devices_path, cache, validate_devices)
+        network_params, params_changed = _load_file(network_params_path, cache, validate_network_params)
+        if devices_changed or params_changed:
+            _save_cache(cache_path, cache)
+        inventory = Inventory(devices, network_params)
+        _inventories.clear()
+        _inventories[key] = inventory
+        return inventory
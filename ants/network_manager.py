@@ -1,12 +1,18 @@
+import json
 import logging
+import os
 import re
+import secrets
 import sys
-import time
+from ipaddress import IPv4Network
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from jinja2 import Environment, FileSystemLoader
 from rich.logging import RichHandler
-from connection import BaseSSHParamiko, SFTPParamiko, ScanDevices
+from ants.connection import (BOOT_ID_COMMAND, ScanDevices, invalidate_device, open_sftp, open_ssh,
+                             probe_prompt, probe_rebooted, probe_ssh_banner, wait_until_ready)
+from ants.topology import Topology
 
 logging.basicConfig(
     format="{message}",
@@ -26,15 +32,36 @@ path_test_network = Path(path_home, 'data', 'network_test_configs')
 rpi_config_file_path: str = "/etc/network/interfaces"
 ssfp_config_file_path: str = "/etc/network/interfaces.d/gbe"
 
+ETN_SHOW_COMMANDS = ["show network a", "show network b", "show gbe a", "show gbe b"]
+# Turns off "--More--" paging of the switch CLI for the session, show commands are read to the end
+SWITCH_NO_PAGING = "terminal length 0"
+
+# State of switches and devices before ConfigureNetwork, DeconfigureNetwork restores it.
+# Runs on the same stand (e.g. tests with different leases) keep their snapshots in separate files.
+network_snapshot_dir = Path(path_home, 'reports', 'network_snapshots')
+
 
 class ErrorInNetworkManagerException(Exception):
     pass
 
 
 class BaseNetworkManager:
+    # The scan parks root shells on the devices for the phase which follows
+    warm_root_shells = False
+
     def __init__(self, devices_connection_data: dict, all_devices_for_test: dict,
-                 network_params_for_test: dict):
+                 network_params_for_test: dict, limit: int = 10, live_apply: bool = True):
         self.devices_connection_data = devices_connection_data
+        # Maximum number of switches and devices configured at the same time
+        self.limit = limit
+        # Subinterfaces are brought up and down without reboot, the reboot is only a fallback
+        self.live_apply = live_apply
+        # Current state of switches and devices read by read_state
+        self.state = {"switches": {}, "devices": {}}
+        # Devices rebooted while configuring, they are waited for by wait_for_rebooted
+        self.rebooted = []
+        # Boot ids of the rebooted devices before the reboot: {ip: boot id}
+        self.boot_ids = {}
         self.network_params = {}
         self.test_device_list = []
 
@@ -46,12 +73,17 @@ class BaseNetworkManager:
             for element in devices:
                 self.test_device_list.append(element)
 
+        # Switch ports and types of devices are looked up in the topology graph
+        self.topology = Topology.from_connection_data(devices_connection_data, network_params_for_test)
+
         self.scan_devices()
 
     def scan_devices(self):
         logging.info("Checking the availability of devices selected for the test")
 
-        scan_test = ScanDevices(self.devices_connection_data, self.test_device_list)
+        # Authenticated connections stay in the connection pool for configuring devices
+        scan_test = ScanDevices(self.devices_connection_data, self.test_device_list, keep_connections=True,
+                                with_root=self.warm_root_shells)
         _, fail = scan_test.scan_devices()
         if fail:
             sys.exit(f"There are devices to which it was not possible to connect - {fail}"
@@ -59,183 +91,384 @@ class BaseNetworkManager:
         else:
             logging.info("All devices are available")
 
+    def build_plan(self) -> dict:
+        """
+        Groups the work by resource: each switch gets the list of its (port, vlan) changes,
+        each device of the test is a separate resource.
+        """
+        plan = {"switches": {}, "devices": []}
+        for current_device in self.test_device_list:
+            vlan = self.network_params[current_device]['vlan']
+            for switch, port in self.topology.device_ports[current_device]:
+                plan["switches"].setdefault(switch, []).append((port, vlan))
+            plan["devices"].append(current_device)
+        return plan
+
+    def run_plan(self, plan: dict, switch_action, device_action):
+        """
+        Runs the plan: the changes of one switch are made one after another,
+        different switches and devices are configured in parallel, no more than self.limit at a time.
+
+        :param plan: plan from build_plan
+        :param switch_action: function (switch, changes) which configures one switch
+        :param device_action: function (device) which configures one device
+        :return: dictionary {"switches": {switch: result}, "devices": {device: result}} with results of actions
+        """
+        with ThreadPoolExecutor(max_workers=self.limit) as executor:
+            switch_futures = {switch: executor.submit(switch_action, switch, changes)
+                              for switch, changes in plan["switches"].items()}
+            device_futures = {device: executor.submit(device_action, device) for device in plan["devices"]}
+            # Errors of the resources are raised after all the resources are done
+            return {"switches": {switch: future.result() for switch, future in switch_futures.items()},
+                    "devices": {device: future.result() for device, future in device_futures.items()}}
+
+    def read_state(self, plan: dict) -> dict:
+        """Reads the current state of all switches and devices of the plan in one parallel pass"""
+        logging.info("Reading the current state of switches and devices")
+        self.state = self.run_plan(plan, self.read_switch_state, self.read_device_state)
+        return self.state
+
+    def read_switch_state(self, switch: str, changes: list = None) -> dict:
+        with open_ssh(**{"device_type": "switch", **self.devices_connection_data[switch]}) as ssh:
+            results = ssh.send_shell_batch([SWITCH_NO_PAGING, "show running-config"])
+        if not results or not results[-1]["output"]:
+            logging.error(f"Cannot read the running config of the switch {switch}")
+            return None
+        return parse_switch_config(results[-1]["output"])
+
+    def read_device_state(self, current_device: str):
+        """Returns the network config file of rpi and ssfp, the network and gbe settings of etn"""
+        device_type = self.topology.device_type(current_device)
+        if device_type == 'etn':
+            with open_ssh(**self.devices_connection_data[current_device]) as ssh:
+                results = ssh.send_shell_batch(ETN_SHOW_COMMANDS)
+            return parse_etn_state({result["command"]: result["output"] for result in results})
+        file_path = ssfp_config_file_path if device_type == 'ssfp' else rpi_config_file_path
+        with open_sftp(**self.devices_connection_data[current_device]) as sftp:
+            return sftp.read_file(file_path)
+
+    def etn_settings(self, current_device: str) -> dict:
+        """Returns the network and gbe settings of etn ports for the test"""
+        current_params_for_test = self.network_params[current_device]
+        vlan = current_params_for_test['vlan']
+        ip_port_a = current_params_for_test['ip_port_a']
+        ip_port_b = current_params_for_test['ip_port_b']
+        netmask_port_a = current_params_for_test['netmask_port_a']
+        netmask_port_b = current_params_for_test['netmask_port_b']
+        return {"a": {"ip": ip_port_a, "subnet": netmask_port_a, "vlan count": "1", "vlan id": str(vlan)},
+                "b": {"ip": ip_port_b, "subnet": netmask_port_b, "vlan count": "1", "vlan id": str(vlan)}}
+
+    def wait_for_rebooted(self, deadline: int = 300) -> list:
+        """
+        Waits until the rebooted devices have booted again and accept connections,
+        returns devices which are not ready
+        """
+        probes = (probe_ssh_banner, probe_rebooted(self.boot_ids), probe_prompt)
+        _, not_ready = wait_until_ready(self.devices_connection_data, self.rebooted, probes=probes,
+                                        deadline=deadline, limit=self.limit)
+        self.rebooted = []
+        self.boot_ids = {}
+        return not_ready
+
+    def reboot(self, sftp, current_device: str):
+        """Reboots the device as root on the SFTP connection, keeps its boot id for wait_for_rebooted"""
+        boot_id = (sftp.send_exec_commands(BOOT_ID_COMMAND) or "").strip()
+        if not boot_id:
+            logging.warning(f"Cannot read the boot id of {current_device}, the reboot will not be checked")
+        self.boot_ids[sftp.ip] = boot_id or None
+        sftp.send_exec_commands("reboot", print_output=False)
+
+    def apply_subinterface(self, sftp, current_device: str, up: bool = True) -> bool:
+        """
+        Brings the VLAN subinterface of the test up (or down) without reboot:
+        ifup/ifdown first, ip link if ifupdown did not help. The result is checked by "ip -j addr".
+
+        :param sftp: SFTP connection to the device, commands are sent as root
+        :param current_device: device from network params for test
+        :param up: bring the subinterface up, otherwise down
+        :return: True if the subinterface is in the expected state, otherwise False
+        """
+        params = self.network_params[current_device]
+        name = f"{params['interface']}.{params['vlan']}"
+        sftp.send_exec_commands(f"ifup {name}" if up else f"ifdown {name}")
+        if check_subinterface(sftp.send_exec_commands("ip -j addr show"), params, up):
+            return True
+        logging.warning(f"ifupdown did not change {name} on {current_device}, trying ip link")
+        sftp.send_exec_commands(subinterface_commands(params, up))
+        if check_subinterface(sftp.send_exec_commands("ip -j addr show"), params, up):
+            return True
+        logging.warning(f"The subinterface {name} on {current_device} was not applied live")
+        return False
+
+    def apply_switch_changes(self, switch: str, changes: list, remove: bool = False,
+                             current: dict = None) -> bool:
+        """
+        Applies all port/VLAN changes of the switch in one session and checks them with one show command.
+
+        :param switch: switch from devices_connection_data
+        :param changes: list of (port, vlan) pairs, vlan is a number or a list of numbers
+        :param remove: remove VLANs from the ports instead of adding them
+        :param current: current state of the switch from read_switch_state,
+                        if it is passed only the missing VLANs are added
+        :return: True if all VLANs are in the expected state after the changes, otherwise False
+        """
+        port_vlans = _port_vlans(changes)
+        vlans = set().union(*port_vlans.values())
+        if current is not None and not remove:
+            port_vlans = {port: port_vlans[port] - current["ports"].get(int(port), set())
+                          for port in port_vlans}
+            port_vlans = {port: port_vlans[port] for port in port_vlans if port_vlans[port]}
+            new_vlans = vlans - current["vlans"]
+            if not port_vlans and not new_vlans:
+                logging.info(f"The switch {switch} is already configured")
+                return True
+            commands = switch_commands(port_vlans, vlans=new_vlans)
+        else:
+            commands = switch_commands(port_vlans, remove)
+        logging.info(f"Configuring ports {list(port_vlans)} on switch {switch}")
+
+        # Reconnects to the switch use the backoff of the "switch" retry policy
+        with open_ssh(**{"device_type": "switch", **self.devices_connection_data[switch]}) as ssh:
+            results = ssh.send_shell_batch([SWITCH_NO_PAGING, *commands])
+            logging.debug(results)
+            output = ssh.send_shell_commands("show vlan")
+        return check_switch_vlans(output, vlans, present=not remove)
+
 
 class ConfigureNetwork(BaseNetworkManager):
+    # The test runs in the same process after ConfigureNetwork and opens root shells on the devices
+    warm_root_shells = True
+
     def __init__(self, devices_connection_data: dict, all_devices_for_test: dict,
-                 network_params_for_test: dict):
-        super().__init__(devices_connection_data, all_devices_for_test, network_params_for_test)
+                 network_params_for_test: dict, limit: int = 10, desired_state: bool = True,
+                 live_apply: bool = True, snapshot_id: str = None):
+        super().__init__(devices_connection_data, all_devices_for_test, network_params_for_test, limit,
+                         live_apply)
+        # Desired state mode: only the difference from the current state is applied
+        self.desired_state = desired_state
+        # Name of the snapshot file of the run, e.g. the id of the lease of the test
+        self.snapshot_id = snapshot_id or f"{os.getpid()}_{secrets.token_hex(4)}"
+        self.snapshot = {"switches": {}, "devices": {}}
         self.configure_test()
 
     def configure_test(self):
         logging.info("Configuring network for test")
-        for current_device in self.test_device_list:
-            connection_data_dict = self.devices_connection_data[current_device]
-            vlan = self.network_params[current_device]['vlan']
-            switch1 = connection_data_dict["switch1"]
-            port1 = connection_data_dict["port1"]
-            self.configure_switch(switch1, port1, vlan)
-            try:
-                switch2 = connection_data_dict["switch2"]
-                port2 = connection_data_dict["port2"]
-            except KeyError:
-                switch2 = None
-                port2 = None
-            if switch2:
-                self.configure_switch(switch2, port2, vlan)
-            if 'ssfp' in current_device:
-                file_path = ssfp_config_file_path
-                self.configure_network_config_file(current_device, file_path)
-            elif 'rpi' in current_device:
-                file_path = rpi_config_file_path
-                self.configure_network_config_file(current_device, file_path)
-            elif 'etn' in current_device:
-                self.configure_etn(current_device)
-            else:
-                raise ErrorInNetworkManagerException(f"Unknown device type: {current_device}")
-
-
-    def configure_switch(self, switch: str, port: str, vlan: str):
-        time.sleep(5)
-        if type(vlan) == int:
-            pass
-        elif type(vlan) == list:
-            vlans_str = []
-            for vl in vlan:
-                vlans_str.append(str(vl))
-            vlan = ",".join(vlans_str)
+        plan = self.build_plan()
+        self.read_state(plan)
+        self.take_snapshot(plan)
+        results = self.run_plan(plan, self.configure_switch, self.configure_device)
+        not_ready = self.wait_for_rebooted()
+        failed = failed_switches(results)
+        if failed:
+            sys.exit(f"VLANs are not configured on switches - {failed}\nCannot run test.")
+        if not_ready:
+            sys.exit(f"Devices are not ready after reboot - {not_ready}\nCannot run test.")
+
+    def take_snapshot(self, plan: dict) -> dict:
+        """
+        Keeps the state of the objects which the plan changes: VLANs of the switch ports,
+        network config files, network and gbe settings of etn. The snapshot is saved to the file of snapshot_id.
+        """
+        snapshot = {"switches": {}, "devices": {}}
+        for switch, changes in plan["switches"].items():
+            current = self.state["switches"].get(switch)
+            if current is None:
+                continue
+            port_vlans = _port_vlans(changes)
+            vlans = set().union(*port_vlans.values())
+            snapshot["switches"][switch] = {
+                "vlans": sorted(current["vlans"] & vlans),
+                "ports": {str(port): sorted(current["ports"].get(int(port), set()) & port_vlans[port])
+                          for port in port_vlans},
+            }
+        for current_device in plan["devices"]:
+            current = self.state["devices"].get(current_device)
+            if isinstance(current, (str, dict)):
+                snapshot["devices"][current_device] = current
+        self.snapshot = snapshot
+        save_snapshot(snapshot, snapshot_path(self.snapshot_id))
+        return snapshot
+
+    def configure_switch(self, switch: str, changes: list) -> bool:
+        current = self.state["switches"].get(switch) if self.desired_state else None
+        return self.apply_switch_changes(switch, changes, current=current)
+
+    def configure_device(self, current_device: str):
+        device_type = self.topology.device_type(current_device)
+        if device_type == 'ssfp':
+            file_path = ssfp_config_file_path
+            self.configure_network_config_file(current_device, file_path)
+        elif device_type == 'rpi':
+            file_path = rpi_config_file_path
+            self.configure_network_config_file(current_device, file_path)
+        elif device_type == 'etn':
+            self.configure_etn(current_device)
         else:
-            logging.error(f"Unknown vlan type {type(vlan)}")
-            raise ErrorInNetworkManagerException(f"Error in vlan type {type(vlan)}")
-
-        logging.info(f"Configuring port {port} on switch {switch}")
-        config_switch_template = ["configure terminal",
-                                  f"vlan {vlan}",
-                                  f"interface ethernet 1/0/{port}",
-                                  "switchport mode trunk",
-                                  f"switchport trunk allowed vlan add {vlan}",
-                                  "exit"]
-
-        with BaseSSHParamiko(**self.devices_connection_data[switch]) as ssh:
-            output = ssh.send_shell_commands(config_switch_template)
-            logging.debug(output)
+            raise ErrorInNetworkManagerException(f"Unknown device type: {current_device}")
 
     def configure_network_config_file(self, current_device: str, file_path: str) -> bool:
+        """
+        Adds the subinterface of the test to the network config file and brings it up.
+        A subinterface which is already in the file is brought up if it is not up on the device.
+
+        :return: True if the device was changed, False if the subinterface was already up
+        """
         current_params_for_test = self.network_params[current_device]
-        output = ""
-        with SFTPParamiko(**self.devices_connection_data[current_device]) as sftp:
-            file_content = sftp.read_file(file_path)
+        with open_sftp(**self.devices_connection_data[current_device]) as sftp:
+            file_content = self.state["devices"].get(current_device)
+            if not isinstance(file_content, str):
+                file_content = sftp.read_file(file_path)
             template = check_network_config_file(current_params_for_test, file_content)
             if template:
                 logging.info(f"Configuring a subinterface on a device {current_device}")
                 sftp.add_to_file(template, file_path)
                 file_content = sftp.read_file(file_path)
                 logging.debug(file_content)
-            else:
+            elif check_subinterface(sftp.send_exec_commands("ip -j addr show"), current_params_for_test):
                 return False
-        with BaseSSHParamiko(**self.devices_connection_data[current_device]) as ssh:
-            ssh.send_shell_commands("reboot")
+            else:
+                # e.g. ifdown was run or the file was edited without a reboot
+                logging.info(f"The subinterface of the test is not up on a device {current_device}")
+            if self.live_apply and self.apply_subinterface(sftp, current_device):
+                return True
+            self.reboot(sftp, current_device)
+        self.rebooted.append(current_device)
+        invalidate_device(sftp.ip)
+        return True
 
     def configure_etn(self, current_device: str):
-        current_params_for_test = self.network_params[current_device]
-        vlan = current_params_for_test['vlan']
-        ip_port_a = current_params_for_test['ip_port_a']
-        ip_port_b = current_params_for_test['ip_port_b']
-        netmask_port_a = current_params_for_test['netmask_port_a']
-        netmask_port_b = current_params_for_test['netmask_port_b']
-        with BaseSSHParamiko(**self.devices_connection_data[current_device]) as ssh:
-            output = ssh.send_shell_commands(
-                ["configure", f"network a ip {ip_port_a}", f"network a subnet {netmask_port_a}",
-                "gbe a vlan count 1", f"gbe a vlan 1 id {vlan}", f"network b ip {ip_port_b}",
-                f"network b subnet {netmask_port_b}", "gbe b vlan count 1",
-                f"gbe b vlan 1 id {vlan}", "exit", "show network a", "show network b",
-                "show gbe a", "show gbe b"]
-            )
+        current = self.state["devices"].get(current_device) if self.desired_state else None
+        commands = etn_commands(self.etn_settings(current_device), current)
+        if not commands:
+            logging.info(f"The device {current_device} is already configured")
+            return
+        with open_ssh(**self.devices_connection_data[current_device]) as ssh:
+            output = ssh.send_shell_commands(["configure", *commands, "exit", *ETN_SHOW_COMMANDS])
         logging.debug(output)
 
 
 class DeconfigureNetwork(BaseNetworkManager):
     def __init__(self, devices_connection_data: dict, all_devices_for_test: dict,
-                 network_params_for_test: dict):
-        super().__init__(devices_connection_data, all_devices_for_test, network_params_for_test)
+                 network_params_for_test: dict, limit: int = 10, live_apply: bool = True,
+                 snapshot: dict = None, snapshot_id: str = None):
+        super().__init__(devices_connection_data, all_devices_for_test, network_params_for_test, limit,
+                         live_apply)
+        # snapshot_id of ConfigureNetwork, the snapshot is read from its file if it is not passed
+        self.snapshot_id = snapshot_id
+        if snapshot is None and snapshot_id is not None:
+            snapshot = load_snapshot(snapshot_path(snapshot_id))
+        elif snapshot is None:
+            logging.warning("There is no network snapshot, default configs are used")
+            snapshot = {"switches": {}, "devices": {}}
+        # Objects without a snapshot are deconfigured to the default configs
+        self.snapshot = snapshot
         self.deconfigure_test()
 
     def deconfigure_test(self):
         logging.info("Deconfiguring network for test")
-        for current_device in self.test_device_list:
-            connection_data_dict = self.devices_connection_data[current_device]
-            vlan = self.network_params[current_device]['vlan']
-            switch1 = connection_data_dict["switch1"]
-            port1 = connection_data_dict["port1"]
-            self.deconfigure_switch(switch1, port1, vlan)
-            try:
-                switch2 = connection_data_dict["switch2"]
-                port2 = connection_data_dict["port2"]
-            except KeyError:
-                switch2 = None
-                port2 = None
-            if switch2:
-                self.deconfigure_switch(switch2, port2, vlan)
-            if 'ssfp' in current_device:
-                file_path = ssfp_config_file_path
-                self.deconfigure_network_config_file(current_device, file_path)
-            elif 'rpi' in current_device:
-                file_path = rpi_config_file_path
-                self.deconfigure_network_config_file(current_device, file_path)
-            elif 'etn' in current_device:
+        results = self.run_plan(self.build_plan(), self.deconfigure_switch, self.deconfigure_device)
+        self.wait_for_rebooted()
+        # The test is over, the errors are only reported
+        failed = failed_switches(results)
+        if failed:
+            logging.error(f"VLANs of the test are not removed from switches - {failed}")
+        if self.snapshot_id is not None:
+            snapshot_path(self.snapshot_id).unlink(missing_ok=True)
+
+    def deconfigure_switch(self, switch: str, changes: list) -> bool:
+        snapshot = self.snapshot["switches"].get(switch)
+        if snapshot is None:
+            return self.apply_switch_changes(switch, changes, remove=True)
+        return self.restore_switch(switch, changes, snapshot)
+
+    def restore_switch(self, switch: str, changes: list, snapshot: dict) -> bool:
+        """Removes only the VLANs which were added to the switch ports by ConfigureNetwork"""
+        port_vlans = _port_vlans(changes)
+        vlans = set().union(*port_vlans.values()) - set(snapshot["vlans"])
+        port_vlans = {port: port_vlans[port] - set(snapshot["ports"].get(str(port), []))
+                      for port in port_vlans}
+        port_vlans = {port: port_vlans[port] for port in port_vlans if port_vlans[port]}
+        if not port_vlans and not vlans:
+            logging.info(f"The switch {switch} is already in the state before the test")
+            return True
+        logging.info(f"Restoring ports {list(port_vlans)} on switch {switch}")
+        with open_ssh(**{"device_type": "switch", **self.devices_connection_data[switch]}) as ssh:
+            commands = switch_commands(port_vlans, remove=True, vlans=vlans)
+            results = ssh.send_shell_batch([SWITCH_NO_PAGING, *commands])
+            logging.debug(results)
+            output = ssh.send_shell_commands("show vlan")
+        return check_switch_vlans(output, vlans, present=False)
+
+    def deconfigure_device(self, current_device: str):
+        snapshot = self.snapshot["devices"].get(current_device)
+        device_type = self.topology.device_type(current_device)
+        if device_type == 'ssfp':
+            file_path = ssfp_config_file_path
+            self.deconfigure_network_config_file(current_device, file_path, snapshot)
+        elif device_type == 'rpi':
+            file_path = rpi_config_file_path
+            self.deconfigure_network_config_file(current_device, file_path, snapshot)
+        elif device_type == 'etn':
+            if snapshot is None:
                 self.deconfigure_etn(current_device)
             else:
-                raise ErrorInNetworkManagerException(f"Unknown device type: {current_device}")
-
+                self.restore_etn(current_device, snapshot)
+        else:
+            raise ErrorInNetworkManagerException(f"Unknown device type: {current_device}")
 
-    def deconfigure_network_config_file(self, current_device: str, file_path: str):
+    def deconfigure_network_config_file(self, current_device: str, file_path: str, content: str = None):
         current_default_params = self.devices_connection_data[current_device]
-        if 'ssfp' in current_device:
+        device_type = self.topology.device_type(current_device)
+        if content is not None:
+            # The file from the snapshot taken before the test
+            template = content
+        elif device_type == 'ssfp':
             template = _default_template_network_config_file(current_default_params,
                                                              "ssfp_default_config_template.txt")
-        elif 'rpi' in current_device:
+        elif device_type == 'rpi':
             template = _default_template_network_config_file(current_default_params,
                                                              "rpi_default_config_template.txt")
         else:
             raise ErrorInNetworkManagerException(f"Unknown device type: {current_device}")
         if template:
-            with SFTPParamiko(**self.devices_connection_data[current_device]) as sftp:
+            with open_sftp(**self.devices_connection_data[current_device]) as sftp:
+                if sftp.read_file(file_path) == template:
+                    logging.info(f"The network config file of {current_device} is not changed")
+                    return True
                 logging.info("Deconfiguring a subinterface on a device")
+                # ifdown needs the subinterface in the file, so it goes before the file is overwritten
+                applied = self.live_apply and self.apply_subinterface(sftp, current_device, up=False)
                 sftp.overwrite_file(template, file_path)
                 file_content = sftp.read_file(file_path)
                 logging.debug(file_content)
-            with BaseSSHParamiko(**self.devices_connection_data[current_device]) as ssh:
-                output = ssh.send_exec_commands("reboot")
-                logging.debug(output)
-                return True
+                if applied:
+                    return True
+                self.reboot(sftp, current_device)
+            self.rebooted.append(current_device)
+            invalidate_device(sftp.ip)
+            return True
         return False
 
-    def deconfigure_switch(self, switch: str, port: str, vlan: str):
-        time.sleep(5)
-        if type(vlan) == int:
-            pass
-        elif type(vlan) == list:
-            vlans_str = []
-            for vl in vlan:
-                vlans_str.append(str(vl))
-            vlan = ",".join(vlans_str)
-        else:
-            logging.error(f"Unknown vlan type {type(vlan)}")
-            raise ErrorInNetworkManagerException(f"Unknown vlan type {type(vlan)}")
-
-        logging.info(f"Configuring port {port} on switch {switch}")
-        config_switch_template = ["configure terminal",
-                                  f"no vlan {vlan}",
-                                  f"interface ethernet 1/0/{port}",
-                                  "switchport mode trunk",
-                                  f"switchport trunk allowed vlan remove {vlan}",
-                                  "exit"]
-
-        with BaseSSHParamiko(**self.devices_connection_data[switch]) as ssh:
-            output = ssh.send_shell_commands(config_switch_template)
-            logging.debug(output)
+    def restore_etn(self, current_device: str, snapshot: dict):
+        """Returns the etn settings changed by ConfigureNetwork to the values from the snapshot"""
+        settings = self.etn_settings(current_device)
+        if any(snapshot.get(port, {}).get(key) is None for port in settings for key in settings[port]):
+            # The show output before the test was not parsed, the values to restore are unknown
+            logging.warning(f"The snapshot of {current_device} is incomplete, default settings are restored")
+            return self.deconfigure_etn(current_device)
+        restore = {port: {key: value for key, value in snapshot[port].items()
+                          if key in settings[port] and value != str(settings[port][key])}
+                   for port in settings}
+        commands = etn_commands(restore)
+        if not commands:
+            logging.info(f"The device {current_device} is already in the state before the test")
+            return
+        with open_ssh(**self.devices_connection_data[current_device]) as ssh:
+            output = ssh.send_shell_commands(["configure", *commands, "exit", *ETN_SHOW_COMMANDS])
+        logging.debug(output)
 
     def deconfigure_etn(self, current_device: str):
-        with BaseSSHParamiko(**self.devices_connection_data[current_device]) as ssh:
+        with open_ssh(**self.devices_connection_data[current_device]) as ssh:
             output = ssh.send_shell_commands(
                 ["configure", f"network a ip 192.168.1.1", f"network a subnet 255.255.255.0",
                 "gbe a vlan count off", f"network b ip 192.168.2.1",
@@ -246,6 +479,187 @@ class DeconfigureNetwork(BaseNetworkManager):
         logging.debug(output)
 
 
+def failed_switches(results: dict) -> list:
+    """Returns the switches whose VLANs were not verified after the changes from the results of run_plan"""
+    return [switch for switch, result in results["switches"].items() if not result]
+
+
+def _parse_vlans(text: str) -> set:
+    """Parses VLAN lists of the switch config: "1;100-102,105" -> {1, 100, 101, 102, 105}"""
+    vlans = set()
+    for first, last in re.findall(r"(\d+)(?:-(\d+))?", text):
+        vlans.update(range(int(first), int(last or first) + 1))
+    return vlans
+
+
+def parse_switch_config(output: str) -> dict:
+    """
+    Returns VLANs of the switch and VLANs allowed on its trunk ports from "show running-config":
+    {"vlans": {VLANs}, "ports": {port: {VLANs}}}
+    """
+    state = {"vlans": set(), "ports": {}}
+    port = None
+    for line in output.splitlines():
+        match = re.match(r"vlan ([\d,;-]+)\s*$", line)
+        if match:
+            state["vlans"] |= _parse_vlans(match.group(1))
+            continue
+        match = re.match(r"interface ethernet\s*1/0/(\d+)\s*$", line, re.IGNORECASE)
+        if match:
+            port = int(match.group(1))
+            continue
+        if line and not line[0].isspace():
+            port = None
+        match = re.match(r"\s+switchport trunk allowed vlan (?:add )?([\d,;-]+)", line)
+        if port is not None and match:
+            state["ports"].setdefault(port, set()).update(_parse_vlans(match.group(1)))
+    return state
+
+
+def parse_etn_state(outputs: dict) -> dict:
+    """
+    Returns the settings of etn ports from the outputs of ETN_SHOW_COMMANDS:
+    {port: {"ip": ..., "subnet": ..., "vlan count": ..., "vlan id": ...}}, unknown values are None
+    """
+    patterns = {"ip": r"\bip\b\D*?(\d+\.\d+\.\d+\.\d+)",
+                "subnet": r"(?:subnet|mask)\D*?(\d+\.\d+\.\d+\.\d+)",
+                "vlan count": r"vlan count\W*(\w+)",
+                "vlan id": r"vlan 1 id\W*(\d+)"}
+    state = {}
+    for port in ("a", "b"):
+        output = outputs.get(f"show network {port}", "") + outputs.get(f"show gbe {port}", "")
+        state[port] = {}
+        for key, pattern in patterns.items():
+            match = re.search(pattern, output, re.IGNORECASE)
+            state[port][key] = match.group(1) if match else None
+    return state
+
+
+def etn_commands(desired: dict, current: dict = None) -> list:
+    """Returns configure commands for etn settings which differ from the current state"""
+    templates = {"ip": "network {port} ip {value}", "subnet": "network {port} subnet {value}",
+                 "vlan count": "gbe {port} vlan count {value}", "vlan id": "gbe {port} vlan 1 id {value}"}
+    commands = []
+    for port, settings in desired.items():
+        for key, value in settings.items():
+            if current and current.get(port, {}).get(key) == str(value):
+                continue
+            commands.append(templates[key].format(port=port, value=value))
+    return commands
+
+
+def _subinterface_address(params: dict) -> str:
+    if "/" in params["ip"]:
+        return params["ip"]
+    prefix = IPv4Network(f"0.0.0.0/{params.get('netmask', '255.255.255.0')}").prefixlen
+    return f"{params['ip']}/{prefix}"
+
+
+def subinterface_commands(params: dict, up: bool = True) -> list:
+    """Returns ip commands which add (or delete) the VLAN subinterface with the IP address of the test"""
+    name = f"{params['interface']}.{params['vlan']}"
+    if not up:
+        return [f"ip link delete {name}"]
+    return [f"ip link add link {params['interface']} name {name} type vlan id {params['vlan']}",
+            f"ip addr add {_subinterface_address(params)} dev {name}",
+            f"ip link set {name} up"]
+
+
+def check_subinterface(output: str, params: dict, up: bool = True) -> bool:
+    """
+    Checks by the output of "ip -j addr show" that the subinterface has the IP address of the test
+    (or that the subinterface does not exist)
+    """
+    name = f"{params['interface']}.{params['vlan']}"
+    try:
+        interfaces = {interface["ifname"]: interface for interface in json.loads(output or "")}
+    except (json.JSONDecodeError, TypeError, KeyError):
+        logging.warning("Cannot parse the output of 'ip -j addr show'")
+        return False
+    if not up:
+        return name not in interfaces
+    addresses = [address.get("local") for address in interfaces.get(name, {}).get("addr_info", [])]
+    return params["ip"].split("/")[0] in addresses
+
+
+def snapshot_path(snapshot_id: str) -> Path:
+    return Path(network_snapshot_dir, f"network_snapshot_{snapshot_id}.json")
+
+
+def save_snapshot(snapshot: dict, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(snapshot, indent=2), encoding="utf-8")
+
+
+def load_snapshot(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        logging.warning(f"There is no network snapshot {path}, default configs are used")
+        return {"switches": {}, "devices": {}}
+
+
+def _port_vlans(changes: list) -> dict:
+    """Returns {port: VLANs} from (port, vlan) pairs"""
+    port_vlans = {}
+    for port, vlan in changes:
+        port_vlans.setdefault(port, set()).update(_vlan_list(vlan))
+    return port_vlans
+
+
+def _vlan_list(vlan) -> list:
+    if type(vlan) == int:
+        return [vlan]
+    elif type(vlan) == list:
+        return [int(vl) for vl in vlan]
+    logging.error(f"Unknown vlan type {type(vlan)}")
+    raise ErrorInNetworkManagerException(f"Error in vlan type {type(vlan)}")
+
+
+def vlan_ranges(vlans) -> str:
+    """Returns VLANs in the range syntax of the switch CLI: [100, 101, 102, 105] -> "100-102,105" """
+    ranges = []
+    for vlan in sorted(set(vlans)):
+        if ranges and ranges[-1][1] == vlan - 1:
+            ranges[-1][1] = vlan
+        else:
+            ranges.append([vlan, vlan])
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def switch_commands(port_vlans: dict, remove: bool = False, vlans=None) -> list:
+    """
+    Returns commands for one switch session which add (or remove) VLANs on trunk ports.
+
+    :param port_vlans: dictionary {port: VLANs of the port}
+    :param remove: remove VLANs instead of adding them
+    :param vlans: VLANs to create (or delete) on the switch, None - all VLANs of the ports
+    """
+    if vlans is None:
+        vlans = set().union(*port_vlans.values())
+    commands = ["configure terminal"]
+    if vlans:
+        commands.append(f"no vlan {vlan_ranges(vlans)}" if remove else f"vlan {vlan_ranges(vlans)}")
+    for port, vlans in sorted(port_vlans.items()):
+        commands += [f"interface ethernet 1/0/{port}",
+                     "switchport mode trunk",
+                     f"switchport trunk allowed vlan {'remove' if remove else 'add'} {vlan_ranges(vlans)}",
+                     "exit"]
+    commands.append("exit")
+    return commands
+
+
+def check_switch_vlans(output: str, vlans, present: bool = True) -> bool:
+    """Checks by the output of "show vlan" that the VLANs exist (or do not exist) on the switch"""
+    configured = {int(vlan) for vlan in re.findall(r"^\s*(\d+)\s", output, re.MULTILINE)}
+    wrong = sorted(set(vlans) - configured if present else set(vlans) & configured)
+    if wrong:
+        state = "not configured" if present else "still configured"
+        logging.error(f"VLANs {vlan_ranges(wrong)} are {state} on the switch")
+        return False
+    return True
+
+
 def _default_template_network_config_file(current_default_params: dict,
                                           file_config: str) -> str:
     env = Environment(loader=FileSystemLoader(path_default), trim_blocks=True, lstrip_blocks=True)
@@ -270,7 +684,10 @@ def check_network_config_file(current_params_for_test: dict, content: str) -> st
                          f"{current_params_for_test['vlan']}")
     ip_network = current_params_for_test["ip"]
 
-    if ip_network in ip_content:
+    if ip_network in ip_content and intf_vlan_network in intf_vlan_content:
+        logging.info(f"The subinterface {intf_vlan_network} with IP address {ip_network} "
+                     f"is already configured on the device")
+    elif ip_network in ip_content:
         logging.warning(f"The IP address: {ip_network} is already configured on the device")
     elif intf_vlan_network in intf_vlan_content:
         logging.warning(f"The subinterface: {intf_vlan_network} "
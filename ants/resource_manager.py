@@ -1,8 +1,14 @@
+import copy
 import logging
-from pathlib import Path
-import yaml
+import secrets
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from ipaddress import IPv4Address, IPv4Network
 
 from rich.logging import RichHandler
+from ants.inventory import load_inventory
+from ants.topology import Topology
 
 logging.basicConfig(
     format="{message}",
@@ -12,22 +18,412 @@ logging.basicConfig(
     handlers=[RichHandler()]
 )
 
-path_home = Path(Path.home(), 'python', 'auto_network_test_system')
-path_test_network = Path(path_home, 'data', 'network_test_configs')
+
+class ErrorInResourceManagerException(Exception):
+    pass
+
+
+class VlanAllocator:
+    """
+    VLAN bitmap of one switch domain. Free VLANs are kept in a stack,
+    so allocation and release take O(1): VLANs reserved out of order are skipped lazily.
+    """
+    def __init__(self, first: int = 2, last: int = 4000):
+        self.first = first
+        self.last = last
+        self._used = bytearray(4096)
+        self._free = list(range(last, first - 1, -1))
+
+    def is_free(self, vlan: int) -> bool:
+        return self.first <= vlan <= self.last and not self._used[vlan]
+
+    def reserve(self, vlan: int) -> bool:
+        """Marks the VLAN as used, returns False if it is already used"""
+        if not self.is_free(vlan):
+            return False
+        self._used[vlan] = 1
+        return True
+
+    def allocate(self) -> int:
+        while self._free:
+            vlan = self._free.pop()
+            if self.reserve(vlan):
+                return vlan
+        raise ErrorInResourceManagerException(f"There are no free VLANs in {self.first}-{self.last}")
+
+    def release(self, vlan: int):
+        if self._used[vlan]:
+            self._used[vlan] = 0
+            self._free.append(vlan)
+
+
+class IpPool:
+    """
+    Pool of host addresses of one subnet. Addresses are given out from a pointer
+    and from a stack of released addresses, both in O(1).
+    """
+    def __init__(self, subnet: str):
+        self.subnet = IPv4Network(subnet)
+        self._next = int(self.subnet.network_address) + 1
+        self._last = int(self.subnet.broadcast_address) - 1
+        self._used = set()
+        self._released = []
+
+    def reserve(self, address: str) -> bool:
+        address = int(IPv4Address(address))
+        if address in self._used or not int(self.subnet.network_address) < address <= self._last:
+            return False
+        self._used.add(address)
+        return True
+
+    def allocate(self) -> str:
+        while self._released:
+            address = self._released.pop()
+            if address not in self._used:
+                self._used.add(address)
+                return str(IPv4Address(address))
+        while self._next <= self._last:
+            address = self._next
+            self._next += 1
+            if address not in self._used:
+                self._used.add(address)
+                return str(IPv4Address(address))
+        raise ErrorInResourceManagerException(f"There are no free addresses in {self.subnet}")
+
+    def release(self, address: str):
+        address = int(IPv4Address(address))
+        if address in self._used:
+            self._used.discard(address)
+            self._released.append(address)
+
+
+class AllocationIndex:
+    """
+    Lab-wide index of VLANs and IP addresses given to tests: a VLAN bitmap per switch domain
+    and an IP pool per subnet. Switches set their domain with "vlan_domain" in the connection data.
+    """
+    def __init__(self, vlan_range: tuple = (2, 4000)):
+        self.vlan_range = vlan_range
+        self.vlans = {}
+        self.pools = {}
+
+    def _vlans(self, domain: str) -> VlanAllocator:
+        if domain not in self.vlans:
+            self.vlans[domain] = VlanAllocator(*self.vlan_range)
+        return self.vlans[domain]
+
+    def _pool(self, subnet: str) -> IpPool:
+        if subnet not in self.pools:
+            self.pools[subnet] = IpPool(subnet)
+        return self.pools[subnet]
+
+    def reserve_vlan(self, domains, vlan: int):
+        for domain in domains:
+            self._vlans(domain).reserve(vlan)
+
+    def allocate_vlan(self, domains) -> int:
+        """Returns a VLAN which is free in all the domains and marks it as used in them"""
+        first, *others = domains
+        skipped = []
+        try:
+            while True:
+                vlan = self._vlans(first).allocate()
+                if all(self._vlans(domain).is_free(vlan) for domain in others):
+                    self.reserve_vlan(others, vlan)
+                    return vlan
+                skipped.append(vlan)
+        finally:
+            for vlan in skipped:
+                self._vlans(first).release(vlan)
+
+    def release_vlan(self, domains, vlan: int):
+        for domain in domains:
+            self._vlans(domain).release(vlan)
+
+    def reserve_ip(self, subnet: str, address: str) -> bool:
+        if IPv4Address(address) not in IPv4Network(subnet):
+            return False
+        return self._pool(subnet).reserve(address)
+
+    def allocate_ip(self, subnet: str) -> str:
+        return self._pool(subnet).allocate()
+
+    def release_ip(self, subnet: str, address: str):
+        self._pool(subnet).release(address)
+
+
+class Lease:
+    """Exclusive lease of devices for one test, the devices are free again after release or expiration"""
+    def __init__(self, owner: str, devices: dict, network_params: dict, ttl: float):
+        self.id = secrets.token_urlsafe(8)
+        self.owner = owner
+        # {device_type: [devices]} as in get_all_devices_for_test
+        self.devices = devices
+        # {device_type: {device: params}} as in get_network_params_for_test
+        self.network_params = network_params
+        self.ttl = ttl
+        self.expires_at = time.monotonic() + ttl
+        # VLAN domains and VLAN, (subnet, address) pairs given to the test by the allocation index
+        self.vlan_domains = []
+        self.vlan = None
+        self.addresses = []
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def device_list(self) -> list:
+        return [device for devices in self.devices.values() for device in devices]
+
+    def __repr__(self):
+        return f"Lease({self.owner}, {self.devices})"
 
 
 class ResourceManager:
-    def __init__(self):
-        with open(f"{path_test_network}/network_params_for_test.yaml") as file:
-            self.network_params = yaml.safe_load(file)
+    def __init__(self, devices_connection_data: dict = None, test_subnet: str = "10.100.0.0/16",
+                 vlan_range: tuple = (2, 4000), inventory=None):
+        self.inventory = inventory or load_inventory()
+        self.network_params = self.inventory.network_params_dict()
 
         self.all_devices_for_test = {}
 
         for device_type, device in self.network_params.items():
             self.all_devices_for_test[device_type] = list(device.keys())
 
+        # Connection data is needed to find the switch of a device
+        self.devices_connection_data = devices_connection_data or self.inventory.devices_connection_data
+        self._topology = None
+        self._leases = {}
+        self._lock = threading.Lock()
+        # Subnet from which the addresses of tests are given
+        self.test_subnet = test_subnet
+        self.index = AllocationIndex(vlan_range)
+        self._reserve_fixed_params()
+
+    def _reserve_fixed_params(self):
+        """VLANs and addresses fixed in network_params_for_test.yaml are not given to other tests"""
+        domains = self._all_vlan_domains()
+        for devices in self.network_params.values():
+            for params in devices.values():
+                for vlan in params.get("vlan") if type(params.get("vlan")) == list else [params.get("vlan")]:
+                    if type(vlan) == int:
+                        self.index.reserve_vlan(domains, vlan)
+                for key in ("ip", "ip_port_a", "ip_port_b"):
+                    if type(params.get(key)) == str:
+                        try:
+                            self.index.reserve_ip(self.test_subnet, params[key])
+                        except ValueError:
+                            logging.warning(f"Invalid address {params[key]} in network params for test")
+
     def get_all_devices_for_test(self):
         return self.all_devices_for_test
 
     def get_network_params_for_test(self):
         return self.network_params
+
+    # -----------------------------Leases----------------------------#
+    def _connection_data(self, device: str) -> dict:
+        return self.devices_connection_data.get(device, {})
+
+    @property
+    def topology(self) -> Topology:
+        if self._topology is None:
+            self._topology = Topology.from_connection_data(self.devices_connection_data, self.all_devices_for_test)
+        return self._topology
+
+    def _switch(self, device: str):
+        switches = self.topology.switches_of(device)
+        return switches[0] if switches else None
+
+    def _vlan_domain(self, switch: str) -> str:
+        return self._connection_data(switch).get("vlan_domain", "default")
+
+    def _all_vlan_domains(self) -> list:
+        switches = {switch for devices in self.all_devices_for_test.values()
+                    for device in devices for switch in self.topology.switches_of(device)}
+        return sorted({self._vlan_domain(switch) for switch in switches}) or ["default"]
+
+    def _release_expired(self):
+        for lease_id, lease in list(self._leases.items()):
+            if lease.expired:
+                logging.warning(f"The lease of {lease.owner} expired, devices are free: {lease.device_list()}")
+                self._release_network(lease)
+                del self._leases[lease_id]
+
+    def leased_devices(self) -> set:
+        with self._lock:
+            self._release_expired()
+            return {device for lease in self._leases.values() for device in lease.device_list()}
+
+    def free_devices(self) -> dict:
+        """Returns {device_type: [devices]} which are not leased"""
+        leased = self.leased_devices()
+        return {device_type: [device for device in devices if device not in leased]
+                for device_type, devices in self.all_devices_for_test.items()}
+
+    def can_satisfy(self, needs: dict, same_switch: bool = False) -> bool:
+        """Checks that the lab has enough devices for the needs when all devices are free"""
+        return self._select(self.all_devices_for_test, needs, same_switch) is not None
+
+    def _select(self, free: dict, needs: dict, same_switch: bool):
+        """Returns {device_type: [devices]} for the needs from the free devices or None"""
+        if not same_switch:
+            if any(len(free.get(device_type, [])) < count for device_type, count in needs.items()):
+                return None
+            return {device_type: free[device_type][:count] for device_type, count in needs.items()}
+        by_switch = {}
+        for device_type, devices in free.items():
+            for device in devices:
+                by_switch.setdefault(self._switch(device), {}).setdefault(device_type, []).append(device)
+        for switch, switch_devices in by_switch.items():
+            if switch is None:
+                continue
+            selected = self._select(switch_devices, needs, same_switch=False)
+            if selected:
+                return selected
+        return None
+
+    def acquire(self, owner: str, needs: dict, same_switch: bool = False, ttl: float = 3600,
+                allocate_network: bool = False):
+        """
+        Leases devices for the test.
+
+        :param owner: name of the test
+        :param needs: dictionary {device_type: count}, e.g. {"rpi": 3, "ssfp": 2, "etn": 1}
+        :param same_switch: all devices should be connected to the same switch (by switch1)
+        :param ttl: lease time in seconds, the devices are free after it even without release
+        :param allocate_network: give the test its own VLAN and addresses from test_subnet
+                                 instead of the ones fixed in network_params_for_test.yaml
+        :return: Lease or None if there are not enough free devices now
+        """
+        with self._lock:
+            self._release_expired()
+            leased = {device for lease in self._leases.values() for device in lease.device_list()}
+            free = {device_type: [device for device in devices if device not in leased]
+                    for device_type, devices in self.all_devices_for_test.items()}
+            selected = self._select(free, needs, same_switch)
+            if selected is None:
+                return None
+            network_params = {device_type: {device: self.network_params[device_type][device] for device in devices}
+                              for device_type, devices in selected.items()}
+            lease = Lease(owner, selected, network_params, ttl)
+            if allocate_network:
+                try:
+                    self._allocate_network(lease)
+                except ErrorInResourceManagerException:
+                    self._release_network(lease)
+                    raise
+            self._leases[lease.id] = lease
+        logging.info(f"Devices are leased to {owner}: {lease.device_list()}")
+        return lease
+
+    def _allocate_network(self, lease: Lease):
+        """Replaces VLANs and addresses in the network params of the lease with unique ones"""
+        switches = {switch for device in lease.device_list() for switch in self.topology.switches_of(device)}
+        lease.vlan_domains = sorted({self._vlan_domain(switch) for switch in switches}) or ["default"]
+        lease.vlan = self.index.allocate_vlan(lease.vlan_domains)
+        netmask = str(IPv4Network(self.test_subnet).netmask)
+        lease.network_params = copy.deepcopy(lease.network_params)
+        for devices in lease.network_params.values():
+            for params in devices.values():
+                params["vlan"] = lease.vlan
+                for key, netmask_key in (("ip", "netmask"), ("ip_port_a", "netmask_port_a"),
+                                         ("ip_port_b", "netmask_port_b")):
+                    if key in params:
+                        params[key] = self.index.allocate_ip(self.test_subnet)
+                        lease.addresses.append((self.test_subnet, params[key]))
+                        if netmask_key in params:
+                            params[netmask_key] = netmask
+        logging.info(f"VLAN {lease.vlan} and addresses {[address for _, address in lease.addresses]} "
+                     f"are given to {lease.owner}")
+
+    def _release_network(self, lease: Lease):
+        if lease.vlan is not None:
+            self.index.release_vlan(lease.vlan_domains, lease.vlan)
+            lease.vlan = None
+        for subnet, address in lease.addresses:
+            self.index.release_ip(subnet, address)
+        lease.addresses = []
+
+    def renew(self, lease: Lease, ttl: float = None):
+        with self._lock:
+            if lease.id not in self._leases:
+                raise ErrorInResourceManagerException(f"The lease of {lease.owner} is not active")
+            lease.expires_at = time.monotonic() + (ttl or lease.ttl)
+
+    def release(self, lease: Lease):
+        with self._lock:
+            if self._leases.pop(lease.id, None):
+                self._release_network(lease)
+                logging.info(f"Devices of {lease.owner} are free: {lease.device_list()}")
+
+
+class TestScheduler:
+    """
+    Runs tests at the same time on disjoint sets of devices.
+    A test is a dictionary {"name": ..., "needs": {device_type: count}, "same_switch": True/False,
+    "allocate_network": True/False}.
+    The leases of running tests are renewed, so the TTL only frees the devices of crashed holders.
+    """
+    def __init__(self, resource_manager: ResourceManager, ttl: float = 3600, max_parallel: int = 10,
+                 renew_interval: float = None):
+        self.resource_manager = resource_manager
+        self.ttl = ttl
+        self.max_parallel = max_parallel
+        # Seconds between renewals of the leases of running tests
+        self.renew_interval = renew_interval or ttl / 3
+
+    def run(self, tests: list, run_test) -> dict:
+        """
+        Starts every test as soon as its devices are free, tests are tried in the order of the list.
+
+        :param tests: list of tests
+        :param run_test: function (test, lease) which runs the test on the leased devices
+        :return: dictionary {test name: result of run_test}, False for tests which failed or could not start
+        """
+        results = {}
+        pending = []
+        for test in tests:
+            if self.resource_manager.can_satisfy(test["needs"], test.get("same_switch", False)):
+                pending.append(test)
+            else:
+                logging.error(f"There are not enough devices in the lab for the test {test['name']}")
+                results[test["name"]] = False
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while pending or running:
+                for test in list(pending):
+                    if len(running) >= self.max_parallel:
+                        break
+                    try:
+                        lease = self.resource_manager.acquire(test["name"], test["needs"],
+                                                              test.get("same_switch", False), self.ttl,
+                                                              test.get("allocate_network", False))
+                    except ErrorInResourceManagerException as error:
+                        # E.g. there is no free VLAN for the test, the other tests go on
+                        logging.error(f"The test {test['name']} cannot start: {error}")
+                        pending.remove(test)
+                        results[test["name"]] = False
+                        continue
+                    if lease:
+                        pending.remove(test)
+                        running[executor.submit(run_test, test, lease)] = (test, lease)
+                if not running:
+                    # The devices are leased outside the scheduler, wait until they are free
+                    time.sleep(1)
+                    continue
+                done, _ = wait(running, timeout=self.renew_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    test, lease = running.pop(future)
+                    self.resource_manager.release(lease)
+                    try:
+                        results[test["name"]] = future.result()
+                    except Exception as error:
+                        logging.error(f"The test {test['name']} failed: {error}")
+                        results[test["name"]] = False
+                for test, lease in running.values():
+                    try:
+                        self.resource_manager.renew(lease)
+                    except ErrorInResourceManagerException as error:
+                        logging.error(f"The devices of the running test {test['name']} are lost: {error}")
+        return results
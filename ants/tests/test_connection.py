@@ -0,0 +1,853 @@
+import asyncio
+import re
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import paramiko
+import pytest
+
+from ants import connection
+from ants.connection import BaseSSHParamiko, ConnectionPool, SFTPParamiko, PROMPT_PATTERN
+
+
+class FakeShell:
+    """Channel stub which returns prepared chunks of output"""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = []
+        self.timeouts = []
+
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+
+    def recv(self, size):
+        if not self.chunks:
+            raise socket.timeout()
+        return self.chunks.pop(0)
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+
+@pytest.fixture
+def ssh():
+    ssh = BaseSSHParamiko.__new__(BaseSSHParamiko)
+    ssh.ip = "192.168.0.1"
+    ssh.timeout = 0.1
+    ssh.max_read = 10000
+    ssh.promt = "pi@rpi:~$"
+    return ssh
+
+
+def test_read_until_prompt(ssh):
+    ssh._shell = FakeShell([b"show gbe a\r\n", b"vlan count 1\r\n", b"ssfp(config)# ", b"rest"])
+    assert ssh._read_until(PROMPT_PATTERN) == "show gbe a\nvlan count 1\nssfp(config)# "
+
+
+def test_read_until_ignores_prompt_chars_inside_output(ssh):
+    ssh._shell = FakeShell([b"# comment\r\n", b"pi@rpi:~$ "])
+    assert ssh._read_until(PROMPT_PATTERN) == "# comment\npi@rpi:~$ "
+
+
+def test_read_until_split_utf8(ssh):
+    data = "тест\r\n$ ".encode("utf-8")
+    ssh._shell = FakeShell([data[:3], data[3:]])
+    assert ssh._read_until(PROMPT_PATTERN) == "тест\n$ "
+
+
+def test_read_until_timeout(ssh):
+    ssh._shell = FakeShell([b"tcpdump: listening on eth0.100\r\n"])
+    assert ssh._read_until(PROMPT_PATTERN) == "tcpdump: listening on eth0.100\n"
+
+
+def test_send_shell_commands_expect(ssh):
+    ssh._shell = FakeShell([b"tcpdump\r\nlistening on eth0\r\n", b"ls\r\npi@rpi:~$ "])
+    output = ssh.send_shell_commands(["tcpdump", "ls"], expect=["listening on", None])
+    assert output == "tcpdump\nlistening on eth0\nls\npi@rpi:~$ "
+    assert ssh._shell.sent == ["tcpdump\n", "ls\n"]
+
+
+def test_prompt_is_the_whole_last_line(ssh):
+    # The chunks end with ">" and "$" inside the output
+    ssh._shell = FakeShell([b"ip a\r\n2: eth0: <BROADCAST,UP>", b" mtu 1500\r\necho $VAR", b"\r\npi@rpi:~$ "])
+    assert ssh.send_shell_commands("ip a") == "ip a\n2: eth0: <BROADCAST,UP> mtu 1500\necho $VAR\npi@rpi:~$ "
+    ssh._shell = FakeShell([b"show bert\r\nmode: <auto>", b"\r\nssfp(config-profile)# "])
+    assert list(ssh.stream_shell_command("show bert")) == ["show bert", "mode: <auto>"]
+    # The prompt found at login is a prompt even if it does not look like one
+    ssh.promt = "$"
+    ssh._shell = FakeShell([b"ls\r\n$ "])
+    assert ssh.send_shell_commands("ls") == "ls\n$ "
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+        self._channels = []
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(connection, "_connect_client", lambda ip, username, password, timeout: FakeClient())
+    return ConnectionPool(idle_timeout=300)
+
+
+def test_pool_reuses_live_transport(pool):
+    client = pool.acquire("10.0.0.1", "pi", "raspberry")
+    assert pool.acquire("10.0.0.1", "pi", "raspberry") is client
+    assert pool.acquire("10.0.0.1", "root", "root") is not client
+
+
+def test_pool_reconnects_dead_transport(pool):
+    client = pool.acquire("10.0.0.1", "pi", "raspberry")
+    client.transport.active = False
+    assert pool.acquire("10.0.0.1", "pi", "raspberry") is not client
+    assert client.closed
+
+
+def test_pool_evicts_idle(pool):
+    client = pool.acquire("10.0.0.1", "pi", "raspberry")
+    pool.idle_timeout = 0
+    pool.evict_idle()
+    assert client.closed
+
+
+def test_pool_keeps_transport_with_open_channels(pool):
+    client = pool.acquire("10.0.0.1", "pi", "raspberry")
+    # e.g. a klish session or tcpdump waiting on the shell
+    client.transport._channels.append(object())
+    pool.idle_timeout = 0
+    pool.evict_idle()
+    assert not client.closed
+    client.transport._channels.clear()
+    pool.idle_timeout = -1
+    pool.evict_idle()
+    assert client.closed
+
+
+def test_pool_evicts_transport_with_only_parked_shells(pool):
+    client = pool.acquire("10.0.0.1", "pi", "raspberry")
+    shell = SimpleNamespace(closed=False, close=lambda: None)
+    # e.g. the broker prepared a shell for the next session
+    client.transport._channels.append(shell)
+    pool.put_shell(("10.0.0.1", "pi", False), client, shell, "pi@rpi:~$")
+    pool.idle_timeout = -1
+    pool.evict_idle()
+    assert client.closed
+    assert pool.take_shell(("10.0.0.1", "pi", False)) is None
+
+
+def test_pool_invalidate_all_users_of_device(pool):
+    pi = pool.acquire("10.0.0.1", "pi", "raspberry")
+    root = pool.acquire("10.0.0.1", "root", "root")
+    other = pool.acquire("10.0.0.2", "pi", "raspberry")
+    pool.invalidate("10.0.0.1")
+    assert pi.closed and root.closed and not other.closed
+
+
+class FakeSSH:
+    active = 0
+    max_active = 0
+
+    def __init__(self, **device_data):
+        self.ip = device_data["ip"]
+        if self.ip == "10.0.0.3":
+            raise connection.ErrorInConnectionException("timeout")
+        FakeSSH.active += 1
+        FakeSSH.max_active = max(FakeSSH.max_active, FakeSSH.active)
+
+    def send_shell_commands(self, commands, **kwargs):
+        time.sleep(0.05)
+        return f"{self.ip}: {commands}"
+
+    def close(self):
+        FakeSSH.active -= 1
+
+
+def test_send_commands_to_fleet(monkeypatch):
+    monkeypatch.setattr(connection.AsyncSSHParamiko, "sync_class", FakeSSH)
+    devices = {f"rpi{i}": {"ip": f"10.0.0.{i}"} for i in range(1, 7)}
+    result = connection.send_commands_to_fleet(devices, {dev: "ip a" for dev in devices}, limit=2)
+    assert list(result) == list(devices)
+    assert result["rpi1"] == "10.0.0.1: ip a"
+    assert result["rpi3"] is False
+    assert FakeSSH.max_active == 2
+
+
+def test_split_batch_by_window_and_barriers():
+    commands = ["run-klish", "configure terminal", "tsins stop profile0", "tsins stop profile1", "up"]
+    assert connection._split_batch(commands, window=2) == [
+        ["run-klish"], ["configure terminal", "tsins stop profile0"], ["tsins stop profile1", "up"]
+    ]
+
+
+def test_split_batch_output():
+    output = ("ssfp> configure terminal\n"
+              "ssfp(config)# tsins stop profile0\n"
+              "% Error: profile is not running\n"
+              "ssfp(config)# show gbe a\n"
+              "vlan count 1\n"
+              "vlan 1 id 100\n"
+              "ssfp(config)# ")
+    commands = ["configure terminal", "tsins stop profile0", "show gbe a"]
+    assert connection.split_batch_output(output, commands) == [
+        "", "% Error: profile is not running", "vlan count 1\nvlan 1 id 100"
+    ]
+
+
+def test_split_batch_output_short_commands():
+    # "up" and "exit" are also in the output of the previous command
+    output = ("run-klish\n"
+              "ssfp> tsins show profile0\n"
+              "up\n"
+              "exit\n"
+              "ssfp> up\n"
+              "ssfp> exit\n"
+              "root@ssfp:~# ")
+    commands = ["tsins show profile0", "up", "exit"]
+    assert connection.split_batch_output(output, commands) == ["up\nexit", "", ""]
+    assert connection.split_batch_output("exit\nroot@ssfp:~# ", ["exit"]) == [""]
+
+
+def test_error_pattern():
+    assert re.search(connection.ERROR_PATTERN, "% Error: profile is not running\n")
+    assert re.search(connection.ERROR_PATTERN, "Error: Nexthop has invalid gateway.\n")
+    assert re.search(connection.ERROR_PATTERN, "bash: tsins: command not found\n")
+    assert not re.search(connection.ERROR_PATTERN, "errors: 0\nerror count: 0\n")
+
+
+def test_send_shell_batch(ssh):
+    ssh._shell = FakeShell([b"ssfp> configure terminal\r\nssfp(config)# tsins stop profile0\r\n",
+                            b"% Error: profile is not running\r\nssfp(config)# "])
+    results = ssh.send_shell_batch(["configure terminal", "tsins stop profile0", ""])
+    assert ssh._shell.sent == ["configure terminal\ntsins stop profile0\n"]
+    assert [result["error"] for result in results] == [False, True]
+
+
+def test_stream_shell_command(ssh, tmp_path):
+    ssh._shell = FakeShell([b"show bert\r\nstatus: run", b"ning\r\nerrors: 0\r", b"\nssfp# ", b"next"])
+    spill_path = tmp_path / "bert.log"
+    lines = list(ssh.stream_shell_command("show bert", spill_path=spill_path))
+    assert lines == ["show bert", "status: running", "errors: 0"]
+    assert spill_path.read_text() == "show bert\nstatus: running\nerrors: 0\n"
+    assert ssh._shell.chunks == [b"next"]
+    # Without a timeout recv blocks instead of spinning on the timeout left by _read_until
+    assert ssh._shell.timeouts == [None]
+
+
+class FakeExecChannel:
+    """
+    Exec channel stub which gives out the data in chunks. Like a real command,
+    it does not send stdout while its stderr is not read.
+    """
+    def __init__(self, stdout, stderr, status):
+        self.stdout = [stdout[i:i + 4] for i in range(0, len(stdout), 4)]
+        self.stderr = [stderr[i:i + 4] for i in range(0, len(stderr), 4)]
+        self.status = status
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def recv_ready(self):
+        return bool(self.stdout) and not self.stderr
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return not self.stdout and not self.stderr
+
+    def recv_exit_status(self):
+        return self.status
+
+
+class FakeExecClient:
+    """Exec stub of a transport with a shell open, sshd refuses sessions over max_sessions"""
+    def __init__(self, max_sessions=10):
+        self.max_sessions = max_sessions
+        self.started = []
+        self.channels = []
+        self.transport = SimpleNamespace(_channels=["shell"])
+
+    def get_transport(self):
+        return self.transport
+
+    def exec_command(self, command):
+        open_channels = [channel for channel in self.channels if not channel.closed]
+        if len(self.transport._channels) + len(open_channels) >= self.max_sessions:
+            raise paramiko.ChannelException(2, "Connect failed")
+        self.started.append(command)
+        status = 0 if command != "cat /nofile" else 1
+        stderr = b"" if status == 0 else b"No such file or directory\n"
+        channel = FakeExecChannel(f"{command} output\r\n".encode(), stderr, status)
+        self.channels.append(channel)
+        return None, SimpleNamespace(channel=channel), SimpleNamespace(channel=channel)
+
+
+def test_send_exec_commands_parallel(ssh):
+    ssh.cl = FakeExecClient()
+    commands = ["ip a", "ls", "cat /nofile"]
+    results = ssh.send_exec_commands(commands, parallel=True, max_channels=2)
+    assert [result["command"] for result in results] == commands
+    assert results[0]["stdout"] == "ip a output\n"
+    assert results[2]["exit_status"] == 1
+    assert results[2]["stderr"] == "No such file or directory\n"
+    assert all(channel.closed for channel in ssh.cl.channels)
+
+
+def test_send_exec_commands_parallel_within_max_sessions(ssh):
+    ssh.cl = FakeExecClient()
+    commands = [f"cat /sys/class/net/eth{i}/statistics/rx_bytes" for i in range(20)]
+    results = ssh.send_exec_commands(commands, parallel=True)
+    assert [result["command"] for result in results] == commands
+    assert all(result["exit_status"] == 0 for result in results)
+
+    # sshd allows fewer sessions than expected: every command still gets a result
+    ssh.cl = FakeExecClient(max_sessions=4)
+    results = ssh.send_exec_commands(commands[:5], parallel=True, max_channels=6)
+    assert [result["command"] for result in results] == commands[:5]
+    assert [result["exit_status"] for result in results] == [None] * 5
+    assert all(result["error"] for result in results)
+    assert all(channel.closed for channel in ssh.cl.channels)
+
+
+class FakeSFTPClient:
+    """SFTP stub which keeps remote files in a dictionary {path: [content, mode, mtime]}"""
+    def __init__(self, files):
+        self.files = files
+        self.puts = []
+        # Remote paths to which the upload fails
+        self.broken = set()
+
+    def stat(self, path):
+        if path not in self.files and not any(name.startswith(f"{path}/") for name in self.files):
+            raise IOError("No such file")
+        content, mode, mtime = self.files.get(path, [b"", 0o40755, 0])
+        return SimpleNamespace(st_size=len(content), st_mode=mode, st_mtime=mtime)
+
+    def mkdir(self, path):
+        self.files[f"{path}/"] = [b"", 0o40755, 0]
+
+    def chmod(self, path, mode):
+        self.files[path][1] = 0o100000 | mode
+
+    def put(self, local_path, remote_path):
+        if remote_path in self.broken:
+            self.files[remote_path] = [b"part", 0o100644, 0]
+            raise IOError("Failure")
+        self.puts.append(remote_path)
+        self.files[remote_path] = [Path(local_path).read_bytes(), 0o100644, len(self.puts)]
+
+    def open_sftp(self):
+        return self
+
+    def close(self):
+        pass
+
+
+def test_sync_files_uploads_only_changed(tmp_path):
+    script = tmp_path / "pattern_ssfp.py"
+    script.write_text("print('pattern')\n")
+    params = tmp_path / "send_to_rpi_file.yaml"
+    params.write_text("vlan: 100\n")
+    sftp = SFTPParamiko.__new__(SFTPParamiko)
+    sftp.ip = "10.0.0.1"
+    sftp.sftp_cl = sftp.root_cl = FakeSFTPClient({})
+    sftp._fresh_files = set()
+    sftp.send_exec_commands = lambda commands: ""
+    manifest_path = tmp_path / "manifest.json"
+
+    remote_paths = sftp.sync_files([script, params], "/home/pi/tests/tsins", 0o755, manifest_path=manifest_path)
+    assert remote_paths == ["/home/pi/tests/tsins/pattern_ssfp.py", "/home/pi/tests/tsins/send_to_rpi_file.yaml"]
+    assert sftp.sftp_cl.puts == remote_paths
+    assert sftp.sftp_cl.files[remote_paths[0]][1] & 0o777 == 0o755
+
+    sftp.sync_files([script, params], "/home/pi/tests/tsins", 0o755, manifest_path=manifest_path)
+    assert len(sftp.sftp_cl.puts) == 2
+
+    params.write_text("vlan: 200\n")
+    sftp.sync_files([script, params], "/home/pi/tests/tsins", 0o755, manifest_path=manifest_path)
+    assert sftp.sftp_cl.puts[2:] == [remote_paths[1]]
+
+
+def test_sync_files_reports_failed_uploads(tmp_path):
+    script = tmp_path / "pattern ssfp.py"
+    script.write_text("print('pattern')\n")
+    sftp = SFTPParamiko.__new__(SFTPParamiko)
+    sftp.ip = "10.0.0.1"
+    sftp.sftp_cl = sftp.root_cl = FakeSFTPClient({})
+    sftp._fresh_files = set()
+    commands = []
+    sftp.send_exec_commands = lambda command: commands.append(command) or ""
+    manifest_path = tmp_path / "manifest.json"
+    remote_path = "/home/pi/tests/tsins/pattern ssfp.py"
+
+    sftp.sftp_cl.broken.add(remote_path)
+    assert sftp.sync_files([script], "/home/pi/tests/tsins", manifest_path=manifest_path) == [None]
+    assert not manifest_path.exists() or remote_path not in manifest_path.read_text()
+
+    # The partly written file has the same size, its hash is checked before the upload
+    script.write_text("part")
+    sftp.sftp_cl.broken.clear()
+    assert sftp.sync_files([script], "/home/pi/tests/tsins", manifest_path=manifest_path) == [remote_path]
+    assert commands == ["sha256sum '/home/pi/tests/tsins/pattern ssfp.py'"]
+    assert sftp.sftp_cl.puts == [remote_path]
+
+
+class FakeRemoteFile:
+    """Remote file stub which, like paramiko, buffers writes until flush or close"""
+    def __init__(self, sftp_cl, path, mode):
+        self.sftp_cl = sftp_cl
+        self.path = path
+        self.buffer = b""
+        if mode == "w+":
+            sftp_cl.files[path] = [b"", 0o100644, sftp_cl.tick()]
+
+    def read(self):
+        self.sftp_cl.reads += 1
+        return self.sftp_cl.files[self.path][0]
+
+    def write(self, content):
+        self.buffer += content.encode()
+
+    def flush(self):
+        if self.buffer:
+            entry = self.sftp_cl.files[self.path]
+            entry[0] += self.buffer
+            entry[2] = self.sftp_cl.tick()
+            self.buffer = b""
+
+    def stat(self):
+        return self.sftp_cl.stat(self.path)
+
+    def close(self):
+        self.flush()
+
+
+class FakeFileSFTPClient(FakeSFTPClient):
+    def __init__(self, files):
+        super().__init__(files)
+        self.reads = 0
+        self.clock = 0
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def open(self, path, mode="r"):
+        return FakeRemoteFile(self, path, mode)
+
+
+def make_sftp(sftp_cl):
+    sftp = SFTPParamiko.__new__(SFTPParamiko)
+    sftp.ip = "10.0.0.1"
+    sftp.sftp_cl = sftp_cl
+    sftp._fresh_files = set()
+    return sftp
+
+
+def test_read_file_cache():
+    sftp_cl = FakeFileSFTPClient({"/etc/network/interfaces": [b"auto eth0\n", 0o100644, 0]})
+    sftp = make_sftp(sftp_cl)
+    assert sftp.read_file("/etc/network/interfaces") == "auto eth0\n"
+    sftp.add_to_file("auto eth0.100\n", "/etc/network/interfaces")
+    assert sftp.read_file("/etc/network/interfaces") == "auto eth0\nauto eth0.100\n"
+    assert sftp_cl.reads == 1
+
+    # A new session checks mtime and size of the cached file
+    sftp = make_sftp(sftp_cl)
+    assert sftp.read_file("/etc/network/interfaces") == "auto eth0\nauto eth0.100\n"
+    assert sftp_cl.reads == 1
+    sftp.overwrite_file("auto eth0\n", "/etc/network/interfaces")
+    sftp = make_sftp(sftp_cl)
+    assert sftp.read_file("/etc/network/interfaces") == "auto eth0\n"
+    assert sftp_cl.reads == 1
+    sftp_cl.files["/etc/network/interfaces"] = [b"auto eth1\n", 0o100644, sftp_cl.tick()]
+    sftp = make_sftp(sftp_cl)
+    assert sftp.read_file("/etc/network/interfaces") == "auto eth1\n"
+    assert sftp_cl.reads == 2
+    connection._file_cache.clear()
+
+
+class FakeHTTPSession:
+    """ubus JSON-RPC stub: counts HTTP requests and denies the calls with an unknown session"""
+    def __init__(self):
+        self.posts = []
+        self.sessions = 0
+        self.valid_session = None
+
+    def post(self, url, json, timeout):
+        self.posts.append(json)
+        if isinstance(json, dict):
+            self.sessions += 1
+            self.valid_session = f"session{self.sessions}"
+            result = {"id": 1, "result": [0, {"ubus_rpc_session": self.valid_session}]}
+        else:
+            result = [{"id": request["id"], "result": [6]} if request["params"][0] != self.valid_session
+                      else {"id": request["id"], "result": [0, {"retcode": 0, "retmsg": "ok"}]}
+                      for request in reversed(json)]
+        return SimpleNamespace(json=lambda: result, content=b"")
+
+
+def test_restapi_batch_and_cached_token(monkeypatch):
+    http_session = FakeHTTPSession()
+    monkeypatch.setattr(connection.RESTfulAPIClient, "_http_session", http_session)
+    monkeypatch.setattr(connection.RESTfulAPIClient, "_tokens", {})
+    device = {"ip": "10.0.0.1", "login": "admin", "password": "admin"}
+    client = connection.RESTfulAPIClient(**device)
+    results = client.send_batch_restapi([("tsins", "setprm", {"status": 1}), ("tsins", "getsts", {})])
+    assert [result["id"] for result in results] == [1, 2]
+    assert connection.RESTfulAPIClient(**device).send_command_restapi("tsins", "getprm", {})
+    assert http_session.sessions == 1
+    assert len(http_session.posts) == 3
+
+    # The device has forgotten the session: login again and repeat the batch
+    http_session.valid_session = None
+    assert client.send_command_restapi("tsins", "getprm", {})
+    assert http_session.sessions == 2
+
+
+def test_scan_devices_tcp_stage_and_cache():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    devices = {
+        "rpi1": {"ip": "127.0.0.1", "scan_port": server.getsockname()[1]},
+        "rpi2": {"ip": "127.0.0.2", "scan_port": closed_port},
+    }
+    scan = connection.ScanDevices(devices, ["rpi1", "rpi2"])
+    assert scan.scan_devices(check_auth=False) == (["127.0.0.1"], ["127.0.0.2"])
+    server.close()
+    # rpi1 passed the scan less than ttl seconds ago
+    assert scan.scan_devices(check_auth=False) == (["127.0.0.1"], ["127.0.0.2"])
+    connection.ScanDevices.invalidate("127.0.0.1")
+    assert scan.scan_devices(check_auth=False) == ([], ["127.0.0.1", "127.0.0.2"])
+
+
+def test_scan_devices_skips_auth_of_rest_devices(monkeypatch):
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    monkeypatch.setattr(connection.ScanDevices, "_passed", {})
+    monkeypatch.setattr(connection.ScanDevices, "_scan_device", lambda self, device: pytest.fail("SSH login"))
+    devices = {"ssfp1": {"ip": "127.0.0.1", "scan_port": server.getsockname()[1]}}
+    try:
+        assert connection.ScanDevices(devices, ["ssfp1"]).scan_devices() == (["127.0.0.1"], [])
+    finally:
+        server.close()
+
+
+def test_one_import_path_for_the_package():
+    from ants import broker, network_manager, resource_manager
+    # The managers share the connection pool and the inventory cache of the package modules
+    assert network_manager.open_ssh is connection.open_ssh
+    assert broker.connection_pool is connection.connection_pool
+    assert resource_manager.load_inventory.__module__ == "ants.inventory"
+    assert not {"connection", "inventory", "topology"} & set(sys.modules)
+
+
+def test_scan_keeps_connections_of_the_next_phase(monkeypatch):
+    acquired = []
+    parked = []
+
+    class FakeParkSSH:
+        def __init__(self, **device_data):
+            self.ip = device_data["ip"]
+
+        def park(self):
+            parked.append(self.ip)
+
+    monkeypatch.setattr(connection.connection_pool, "acquire",
+                        lambda ip, username, password, device_type="default": acquired.append((ip, username)))
+    monkeypatch.setattr(connection, "BaseSSHParamiko", FakeParkSSH)
+    rpi = {"ip": "10.0.0.1", "login": "pi", "password": "pi", "root_password": "root"}
+    etn = {"ip": "10.0.0.2", "login": "admin", "password": "admin"}
+    scan = connection.ScanDevices({"rpi1": rpi, "etn1": etn}, [], keep_connections=True, with_root=True)
+    assert scan._open_device(rpi) and scan._open_device(etn)
+    # SFTP of the network manager logs in as root, ETN uses the login
+    assert acquired == [("10.0.0.1", "root"), ("10.0.0.2", "admin")]
+    assert parked == ["10.0.0.1"]
+
+
+def test_pool_idle_shells(pool):
+    client = pool.acquire("10.0.0.1", "pi", "raspberry")
+    shell = SimpleNamespace(closed=False, close=lambda: None)
+    key = ("10.0.0.1", "pi", True)
+    pool.max_idle_shells = 1
+    assert pool.put_shell(key, client, shell, "root@rpi:~#")
+    assert not pool.put_shell(key, client, shell, "root@rpi:~#")
+    assert pool.take_shell(("10.0.0.1", "pi", False)) is None
+    assert pool.take_shell(key) == (client, shell, "root@rpi:~#")
+    assert pool.take_shell(key) is None
+
+    pool.put_shell(key, client, shell, "root@rpi:~#")
+    pool.invalidate("10.0.0.1")
+    assert pool.take_shell(key) is None
+
+
+def test_connect_with_retry_and_circuit_breaker(monkeypatch):
+    attempts = []
+
+    def connect_client(ip, username, password, timeout):
+        attempts.append(ip)
+        if len(attempts) < 3:
+            raise EOFError()
+        return FakeClient()
+
+    monkeypatch.setattr(connection, "_connect_client", connect_client)
+    monkeypatch.setattr(connection.time, "sleep", lambda delay: None)
+    monkeypatch.setitem(connection.RETRY_POLICIES, "switch", connection.RetryPolicy(max_attempts=3))
+    monkeypatch.setattr(connection, "circuit_breaker", connection.CircuitBreaker(failure_threshold=2))
+    assert isinstance(connection._connect_with_retry("10.0.0.9", "admin", "admin", "switch"), FakeClient)
+    assert len(attempts) == 3
+
+    def unreachable(ip, username, password, timeout):
+        raise socket.timeout()
+
+    monkeypatch.setattr(connection, "_connect_client", unreachable)
+    for _ in range(2):
+        with pytest.raises(socket.timeout):
+            connection._connect_with_retry("10.0.0.9", "admin", "admin")
+    with pytest.raises(connection.ErrorInConnectionException):
+        connection._connect_with_retry("10.0.0.9", "admin", "admin")
+
+
+def test_connect_seconds_without_backoff_sleep(monkeypatch):
+    now = [0.0]
+
+    def connect_client(ip, username, password, timeout):
+        now[0] += 1
+        raise EOFError()
+
+    monkeypatch.setattr(connection, "_connect_client", connect_client)
+    monkeypatch.setattr(connection.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(connection.time, "sleep", lambda delay: now.__setitem__(0, now[0] + delay))
+    monkeypatch.setitem(connection.RETRY_POLICIES, "switch",
+                        connection.RetryPolicy(max_attempts=3, base_delay=10, jitter=0))
+    monkeypatch.setattr(connection, "circuit_breaker", connection.CircuitBreaker())
+    connection.metrics.reset()
+    with pytest.raises(EOFError):
+        connection._connect_with_retry("10.0.0.9", "admin", "admin", "switch")
+    device_metrics = connection.metrics.to_dict()["devices"]["10.0.0.9"]
+    assert device_metrics["connect_seconds"] == 3
+    assert device_metrics["sleep_seconds"] == 20
+    connection.metrics.reset()
+
+
+def test_probe_connects_once_without_circuit_breaker(monkeypatch):
+    timeouts = []
+
+    def unreachable(ip, username, password, timeout):
+        timeouts.append(timeout)
+        raise socket.timeout()
+
+    monkeypatch.setattr(connection, "_connect_client", unreachable)
+    monkeypatch.setattr(connection, "circuit_breaker", connection.CircuitBreaker(failure_threshold=1))
+    with pytest.raises(socket.timeout):
+        connection._connect_with_retry("10.0.0.9", "pi", "pi", "probe")
+    assert timeouts == [5]
+    # The failed probe is not a failure of the device for the other callers
+    connection.circuit_breaker.check("10.0.0.9")
+    connection.circuit_breaker.failure("10.0.0.9")
+    with pytest.raises(socket.timeout):
+        connection._connect_with_retry("10.0.0.9", "pi", "pi", "probe")
+    # and the probe does not close the open circuit
+    with pytest.raises(connection.ErrorInConnectionException):
+        connection.circuit_breaker.check("10.0.0.9")
+
+
+def test_retry_policy_delay():
+    policy = connection.RetryPolicy(base_delay=1, max_delay=4, jitter=0)
+    assert [policy.delay(attempt) for attempt in range(4)] == [1, 2, 4, 4]
+
+
+class FakeBrokerSSH:
+    parked = []
+
+    def __init__(self, **device_data):
+        self.ip = device_data["ip"]
+        self.promt = "root@rpi:~#"
+        self.cwd = "/root"
+
+    def send_shell_commands(self, commands, print_output=True, expect=None, timeout=None):
+        if commands.startswith("cd "):
+            self.cwd = commands[3:]
+        return f"{self.ip}:{self.cwd}$ {commands}"
+
+    def park(self):
+        FakeBrokerSSH.parked.append(self.ip)
+
+    def close(self):
+        pass
+
+
+def test_broker_session(monkeypatch, tmp_path):
+    from ants import broker
+    monkeypatch.setattr(broker, "BaseSSHParamiko", FakeBrokerSSH)
+    monkeypatch.setattr(broker, "prepare_shell", lambda device: FakeBrokerSSH(**device).park())
+    socket_path = str(tmp_path / "broker.sock")
+    server = broker.BrokerServer(socket_path, broker.BrokerHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with connection.BrokerSSH(socket_path, ip="10.0.0.1", login="pi", password="pi") as ssh:
+            assert ssh.promt == "root@rpi:~#"
+            ssh.send_shell_commands("cd /home/pi/tests")
+            assert ssh.send_shell_commands("ls") == "10.0.0.1:/home/pi/tests$ ls"
+            with pytest.raises(connection.ErrorInConnectionException):
+                ssh._broker.request("ssh", method="close", args=[])
+            invalidated = []
+            monkeypatch.setattr(broker.connection_pool, "invalidate", lambda ip: invalidated.append(ip))
+            assert ssh._broker.request("invalidate", ip="10.0.0.1")
+            assert invalidated == ["10.0.0.1"]
+        time.sleep(0.1)
+        assert FakeBrokerSSH.parked == ["10.0.0.1"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_export(ssh, tmp_path):
+    ssh._shell = FakeShell([b"show gbe a\r\nssfp# "])
+    connection.metrics.reset()
+    ssh.send_shell_commands("show gbe a")
+    connection.metrics.add("10.0.0.2", "retries")
+    summary = connection.metrics.to_dict()
+    assert summary["devices"]["192.168.0.1"]["bytes_sent"] == len("show gbe a\n")
+    assert summary["devices"]["192.168.0.1"]["bytes_received"] == len("show gbe a\r\nssfp# ")
+    assert summary["commands"][0]["command"] == "show gbe a"
+    prometheus = connection.metrics.to_prometheus()
+    assert 'ants_retries_total{device="10.0.0.2"} 1' in prometheus
+    assert 'ants_command_seconds_count{device="192.168.0.1",command="show gbe a"} 1' in prometheus
+    connection.metrics.save(tmp_path)
+    assert (tmp_path / "ants_metrics.json").exists() and (tmp_path / "ants_metrics.prom").exists()
+    connection.metrics.reset()
+
+
+def test_command_labels_are_bounded():
+    assert connection._command_label("tcpdump -i eth0.100 -w /tmp/dump_20231018_101500.pcap") == "tcpdump"
+    assert connection._command_label("tsins stop profile0") == "tsins stop"
+    assert connection._command_label("python3 /home/pi/tests/tsins/pattern_ssfp.py") == "python3"
+    assert connection._command_label("./pattern_ssfp.py") == "other"
+    assert connection._broker_label("send_shell_commands", (["show gbe a", "show gbe b"], True)) == \
+        "broker: show gbe a"
+    assert connection._broker_label("read_file", ("/etc/network/interfaces",)) == "broker: read_file"
+
+
+class FakeBatchSSH:
+    ip = "10.0.0.3"
+    closed = False
+
+    def __init__(self):
+        self.batches = []
+
+    def send_shell_batch(self, commands, window=None, timeout=None):
+        self.batches.append(commands)
+        return [{"command": command, "output": "", "error": False} for command in commands]
+
+
+def test_klish_session_sends_only_needed_transitions():
+    ssh = FakeBatchSSH()
+    session = connection.KlishSession(ssh)
+    session.send_commands(["run-klish ", "configure terminal", "tsins config profile0", "duration endless", ""])
+    assert ssh.batches[-1] == ["run-klish", "configure terminal", "tsins config profile0", "duration endless"]
+    assert session.mode == connection.KLISH_PROFILE
+    session.send_commands(["run-klish", "configure terminal", "erspan stop profile0"])
+    assert ssh.batches[-1] == ["up", "erspan stop profile0"]
+    assert session.mode == connection.KLISH_CONFIGURE
+    session.send_commands(["run-klish", "configure terminal", "tsins stop profile0"])
+    assert ssh.batches[-1] == ["tsins stop profile0"]
+    assert not session.closed
+
+
+def test_wait_until_ready_with_backoff_and_deadline():
+    attempts = {}
+
+    def probe(device_data):
+        attempts[device_data["ip"]] = attempts.get(device_data["ip"], 0) + 1
+        return device_data["ip"] == "10.0.0.1" and attempts["10.0.0.1"] >= 3
+
+    devices = {"rpi1": {"ip": "10.0.0.1"}, "rpi2": {"ip": "10.0.0.2"}}
+    policy = connection.RetryPolicy(base_delay=0.01, max_delay=0.02, jitter=0)
+    ready, not_ready = connection.wait_until_ready(devices, ["rpi1", "rpi2"], probes=[probe],
+                                                   deadline=0.2, policy=policy)
+    assert ready == ["rpi1"] and not_ready == ["rpi2"]
+    assert attempts["10.0.0.1"] == 3 and attempts["10.0.0.2"] > 3
+
+
+def test_probe_rebooted(monkeypatch):
+    boot_id = ["4f1c1d0e-7d0b-4c55-9a57-1b2c3d4e5f60"]
+
+    class FakeProbeSSH:
+        def __init__(self, **device_data):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def send_exec_commands(self, commands):
+            assert commands == connection.BOOT_ID_COMMAND
+            return f"{boot_id[0]}\n"
+
+    monkeypatch.setattr(connection, "open_ssh", FakeProbeSSH)
+    probe = connection.probe_rebooted({"10.0.0.1": "4f1c1d0e-7d0b-4c55-9a57-1b2c3d4e5f60"})
+    # The device has not gone down yet
+    assert not probe({"ip": "10.0.0.1"})
+    boot_id[0] = "0a9b8c7d-6e5f-4a3b-2c1d-0e9f8a7b6c5d"
+    assert probe({"ip": "10.0.0.1"})
+    assert probe({"ip": "10.0.0.2"})
+
+
+def test_probe_ssh_banner():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def answer():
+        client, _ = server.accept()
+        client.sendall(b"SSH-2.0-OpenSSH_8.4\r\n")
+        client.close()
+
+    threading.Thread(target=answer, daemon=True).start()
+    device_data = {"ip": "127.0.0.1", "scan_port": server.getsockname()[1]}
+    try:
+        assert asyncio.run(connection.probe_ssh_banner(device_data))
+    finally:
+        server.close()
@@ -0,0 +1,75 @@
+import pytest
+
+from ants import inventory
+from ants.inventory import ErrorInInventoryException, load_inventory
+
+
+DEVICES_YAML = """
+raspberry:
+  rpi2: {ip: 192.168.1.2, login: pi, password: pi, switch1: sw1, port1: 1}
+  sw1: {ip: 192.168.1.250, login: admin, password: admin}
+ssfp:
+  ssfp4: {ip: 192.168.1.14, login: admin, password: admin, switch1: sw1, port1: 7}
+"""
+NETWORK_PARAMS_YAML = """
+rpi:
+  rpi2: {vlan: 100, ip: 10.1.1.2, interface: eth0}
+ssfp:
+  ssfp4: {vlan: 100, ip: 10.1.1.14}
+"""
+
+
+@pytest.fixture
+def files(tmp_path):
+    devices_path = tmp_path / "devices.yaml"
+    network_params_path = tmp_path / "network_params_for_test.yaml"
+    devices_path.write_text(DEVICES_YAML)
+    network_params_path.write_text(NETWORK_PARAMS_YAML)
+    inventory._inventories.clear()
+    return devices_path, network_params_path, tmp_path / "cache" / "inventory.pickle"
+
+
+def test_indexes_and_copies(files):
+    lab = load_inventory(*files)
+    assert lab.connection_data("rpi2")["ip"] == "192.168.1.2"
+    assert lab.devices_by_ip["192.168.1.14"] == "ssfp4"
+    assert lab.groups["ssfp"] == ("ssfp4",)
+    assert lab.devices_by_type == {"rpi": ("rpi2",), "ssfp": ("ssfp4",)}
+    assert lab.params("ssfp4")["vlan"] == 100
+    with pytest.raises(TypeError):
+        lab.devices_connection_data["rpi2"]["ip"] = "10.0.0.1"
+    with pytest.raises(ErrorInInventoryException):
+        lab.connection_data("rpi9")
+    params = lab.network_params_dict()
+    params["rpi"]["rpi2"]["vlan"] = 200
+    assert lab.params("rpi2")["vlan"] == 100
+    assert lab.connection_data_dict()["sw1"] == {"ip": "192.168.1.250", "login": "admin", "password": "admin"}
+
+
+def test_cache(files, monkeypatch):
+    devices_path, network_params_path, cache_path = files
+    lab = load_inventory(*files)
+    assert load_inventory(*files) is lab
+    assert cache_path.exists()
+
+    # Another process: the files are taken from the cache without parsing YAML
+    inventory._inventories.clear()
+    monkeypatch.setattr(inventory.yaml, "load", lambda *args, **kwargs: pytest.fail("YAML parsed"))
+    assert load_inventory(*files).devices_by_type == lab.devices_by_type
+    monkeypatch.undo()
+
+    devices_path.write_text(DEVICES_YAML.replace("192.168.1.2,", "192.168.1.30,"))
+    assert load_inventory(*files).connection_data("rpi2")["ip"] == "192.168.1.30"
+
+
+def test_validation(files):
+    devices_path, _, _ = files
+    devices_path.write_text("raspberry:\n  rpi2: {login: pi, switch1: sw1, port1: 1}\n")
+    with pytest.raises(ErrorInInventoryException, match="has no 'ip'"):
+        load_inventory(*files)
+    devices_path.write_text("raspberry:\n  rpi2: {ip: 192.168.1.2, switch1: sw1}\n")
+    with pytest.raises(ErrorInInventoryException, match="without 'port1'"):
+        load_inventory(*files)
+    devices_path.write_text("raspberry:\n  rpi2: {ip: 192.168.1.2, port1: [1]}\n")
+    with pytest.raises(ErrorInInventoryException, match="wrong type"):
+        load_inventory(*files)
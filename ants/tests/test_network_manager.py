@@ -0,0 +1,352 @@
+import json
+import re
+import threading
+
+import pytest
+
+from ants import network_manager
+from ants.network_manager import BaseNetworkManager, ConfigureNetwork, DeconfigureNetwork
+
+
+class FakeScan:
+    """ScanDevices stub: all devices of the test are available"""
+    def __init__(self, devices_connection_data, test_devices, **kwargs):
+        self.test_devices = test_devices
+
+    def scan_devices(self):
+        return self.test_devices, []
+
+
+@pytest.fixture(autouse=True)
+def no_scan(monkeypatch):
+    monkeypatch.setattr(network_manager, "ScanDevices", FakeScan)
+
+
+def make_manager(devices_connection_data, network_params, limit=10):
+    all_devices_for_test = {device_type: list(devices) for device_type, devices in network_params.items()}
+    return BaseNetworkManager(devices_connection_data, all_devices_for_test, network_params, limit)
+
+
+class FakeSwitch:
+    """
+    Switch stub which applies the VLAN commands to its state and records the sessions.
+    Like the switch CLI, a new session pages the show output until "terminal length 0".
+    """
+    page_length = 2
+
+    def __init__(self, vlans, ports):
+        self.vlans = set(vlans)
+        self.ports = {port: set(port_vlans) for port, port_vlans in ports.items()}
+        self.batches = []
+        self.paging = True
+        # VLANs which the switch fails to create or delete
+        self.stuck_vlans = set()
+
+    def __call__(self, **device_data):
+        self.paging = True
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def running_config(self):
+        lines = [f"vlan {network_manager.vlan_ranges(self.vlans)}", "!"]
+        for port, vlans in sorted(self.ports.items()):
+            lines += [f"Interface Ethernet1/0/{port}", " switchport mode trunk",
+                      f" switchport trunk allowed vlan {network_manager.vlan_ranges(vlans)}", "!"]
+        return "\n".join(lines) + "\n"
+
+    def send_shell_batch(self, commands):
+        self.batches.append(commands)
+        port = None
+        for command in commands:
+            if command == "terminal length 0":
+                self.paging = False
+            match = re.match(r"(no )?vlan ([\d,-]+)$", command)
+            if match:
+                vlans = network_manager._parse_vlans(match.group(2))
+                if match.group(1):
+                    self.vlans -= vlans - self.stuck_vlans
+                else:
+                    self.vlans |= vlans - self.stuck_vlans
+            match = re.match(r"interface ethernet 1/0/(\d+)$", command)
+            if match:
+                port = int(match.group(1))
+            match = re.match(r"switchport trunk allowed vlan (add|remove) ([\d,-]+)$", command)
+            if match:
+                vlans = network_manager._parse_vlans(match.group(2))
+                port_vlans = self.ports.setdefault(port, set())
+                self.ports[port] = port_vlans | vlans if match.group(1) == "add" else port_vlans - vlans
+        return [{"command": command, "output": self.running_config() if command == "show running-config" else "",
+                 "error": False} for command in commands]
+
+    def send_shell_commands(self, commands, print_output=True):
+        # BaseSSHParamiko returns nothing without print_output
+        if print_output:
+            lines = [f"{vlan}    VLAN{vlan:04}\n" for vlan in sorted(self.vlans)]
+            if self.paging and len(lines) > self.page_length:
+                return "".join(lines[:self.page_length]) + " --More-- "
+            return "".join(lines)
+
+
+DEVICES = {
+    "rpi1": {"ip": "10.0.0.1", "switch1": "sw1", "port1": 1},
+    "rpi2": {"ip": "10.0.0.2", "switch1": "sw1", "port1": 2, "switch2": "sw2", "port2": 5},
+    "ssfp1": {"ip": "10.0.0.3", "switch1": "sw2", "port1": 3},
+}
+PARAMS = {"rpi": {"rpi1": {"vlan": 100}, "rpi2": {"vlan": 101}}, "ssfp": {"ssfp1": {"vlan": 100}}}
+
+
+def test_build_plan_groups_changes_by_switch():
+    manager = make_manager(DEVICES, PARAMS)
+    plan = manager.build_plan()
+    assert plan["switches"] == {"sw1": [(1, 100), (2, 101)], "sw2": [(5, 101), (3, 100)]}
+    assert plan["devices"] == ["rpi1", "rpi2", "ssfp1"]
+
+
+def test_run_plan_runs_switches_and_devices_in_parallel():
+    manager = make_manager(DEVICES, PARAMS)
+    calls = []
+    # Passes only when both switches and all devices are configured at the same time
+    barrier = threading.Barrier(5, timeout=5)
+
+    def switch_action(switch, changes):
+        calls.append((switch, changes))
+        barrier.wait()
+        return switch
+
+    def device_action(device):
+        barrier.wait()
+        return device
+
+    results = manager.run_plan(manager.build_plan(), switch_action, device_action)
+    # All changes of a switch are made by one action, one after another
+    assert sorted(calls) == [("sw1", [(1, 100), (2, 101)]), ("sw2", [(5, 101), (3, 100)])]
+    assert results == {"switches": {"sw1": "sw1", "sw2": "sw2"},
+                       "devices": {"rpi1": "rpi1", "rpi2": "rpi2", "ssfp1": "ssfp1"}}
+
+
+def test_switch_commands_use_vlan_ranges():
+    assert network_manager.vlan_ranges([105, 100, 102, 101]) == "100-102,105"
+    commands = network_manager.switch_commands({2: {101}, 1: {100, 101, 102}})
+    assert commands == ["configure terminal", "vlan 100-102",
+                        "interface ethernet 1/0/1", "switchport mode trunk",
+                        "switchport trunk allowed vlan add 100-102", "exit",
+                        "interface ethernet 1/0/2", "switchport mode trunk",
+                        "switchport trunk allowed vlan add 101", "exit",
+                        "exit"]
+    assert network_manager.switch_commands({1: {100}}, remove=True)[1] == "no vlan 100"
+
+
+def test_check_switch_vlans():
+    output = ("show vlan\n"
+              "VLAN Name         Type       Media     Ports\n"
+              "---- ------------ ---------- --------- ------------------\n"
+              "1    default      Static     ENET      Ethernet1/0/1(T)\n"
+              "100  VLAN0100     Static     ENET      Ethernet1/0/1(T)\n"
+              "switch# ")
+    assert network_manager.check_switch_vlans(output, {1, 100})
+    assert not network_manager.check_switch_vlans(output, {100, 101})
+    assert not network_manager.check_switch_vlans(output, {100}, present=False)
+
+
+def test_parse_switch_config():
+    output = ("show running-config\n"
+              "!\n"
+              "vlan 1;100-102\n"
+              "!\n"
+              "Interface Ethernet1/0/1\n"
+              " switchport mode trunk\n"
+              " switchport trunk allowed vlan 100;102\n"
+              "!\n"
+              "Interface Ethernet1/0/2\n"
+              "!\n"
+              "switch# ")
+    state = network_manager.parse_switch_config(output)
+    assert state == {"vlans": {1, 100, 101, 102}, "ports": {1: {100, 102}}}
+
+
+def test_apply_switch_changes_sends_only_diff(monkeypatch):
+    switch = FakeSwitch({1, 100}, {1: {100}})
+    monkeypatch.setattr(network_manager, "open_ssh", switch)
+    manager = make_manager({"sw1": {"ip": "10.0.0.10"}}, {})
+    current = {"vlans": {1, 100}, "ports": {1: {100}}}
+    assert manager.apply_switch_changes("sw1", [(1, 100)], current=current)
+    assert switch.batches == []
+    assert manager.apply_switch_changes("sw1", [(1, 100), (2, 101)], current=current)
+    assert switch.batches == [["terminal length 0", "configure terminal", "vlan 101", "interface ethernet 1/0/2", "switchport mode trunk",
+                               "switchport trunk allowed vlan add 101", "exit", "exit"]]
+
+
+def test_etn_commands_diff():
+    outputs = {"show network a": "IP address: 10.1.1.1\nSubnet mask: 255.255.255.0\n",
+               "show gbe a": "vlan count: 1\nvlan 1 id: 100\n"}
+    current = network_manager.parse_etn_state(outputs)
+    desired = {"a": {"ip": "10.1.1.1", "subnet": "255.255.255.0", "vlan count": "1", "vlan id": "101"}}
+    assert network_manager.etn_commands(desired, current) == ["gbe a vlan 1 id 101"]
+    assert len(network_manager.etn_commands(desired)) == 4
+
+
+class FakeLiveSFTP:
+    """SFTP stub of a device without ifupdown: only ip commands change interfaces"""
+    def __init__(self):
+        self.interfaces = [{"ifname": "eth0", "addr_info": [{"local": "10.0.0.1"}]}]
+        self.commands = []
+
+    def send_exec_commands(self, commands, print_output=True):
+        commands = [commands] if type(commands) == str else commands
+        self.commands += commands
+        for command in commands:
+            if command.startswith("ip link add"):
+                self.interfaces.append({"ifname": "eth0.100", "addr_info": []})
+            elif command.startswith("ip addr add"):
+                self.interfaces[-1]["addr_info"].append({"local": command.split()[3].split("/")[0]})
+        return json.dumps(self.interfaces) if commands == ["ip -j addr show"] else ""
+
+
+def test_apply_subinterface_falls_back_to_ip_link():
+    manager = make_manager({}, {"rpi": {"rpi1": {"interface": "eth0", "vlan": 100,
+                                                 "ip": "192.168.100.2", "netmask": "255.255.255.0"}}})
+    sftp = FakeLiveSFTP()
+    assert manager.apply_subinterface(sftp, "rpi1")
+    assert "ip addr add 192.168.100.2/24 dev eth0.100" in sftp.commands
+    assert "reboot" not in sftp.commands
+    assert not network_manager.check_subinterface("ip: unknown option -j", manager.network_params["rpi1"])
+
+
+class FakeFileSFTP(FakeLiveSFTP):
+    """SFTP stub of a device whose network config file already has the subinterface of the test"""
+    def __init__(self, content, up=True):
+        super().__init__()
+        self.ip = "10.0.0.1"
+        self.content = content
+        if up:
+            self.interfaces.append({"ifname": "eth0.101", "addr_info": [{"local": "192.168.101.2"}]})
+
+    def __call__(self, **device_data):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def read_file(self, file_path):
+        return self.content
+
+    def send_exec_commands(self, commands, print_output=True):
+        if commands == network_manager.BOOT_ID_COMMAND:
+            return "4f1c1d0e-7d0b-4c55-9a57-1b2c3d4e5f60\n"
+        return super().send_exec_commands(commands, print_output)
+
+
+def test_configure_brings_up_subinterface_from_the_file(monkeypatch, tmp_path):
+    sftp = FakeFileSFTP("auto eth0.100\niface eth0.100 inet static\naddress 192.168.100.2\n", up=False)
+    monkeypatch.setattr(network_manager, "open_ssh", FakeSwitch({1, 100}, {1: {100}}))
+    monkeypatch.setattr(network_manager, "open_sftp", sftp)
+    monkeypatch.setattr(network_manager, "network_snapshot_dir", tmp_path)
+    devices = {"sw1": {"ip": "10.0.0.10"}, "rpi1": {"ip": "10.0.0.1", "switch1": "sw1", "port1": 1}}
+    params = {"rpi": {"rpi1": {"vlan": 100, "interface": "eth0", "ip": "192.168.100.2"}}}
+    configure = ConfigureNetwork(devices, {"rpi": ["rpi1"]}, params)
+    assert "ip addr add 192.168.100.2/24 dev eth0.100" in sftp.commands
+    assert "reboot" not in sftp.commands
+    # The subinterface is up, nothing is changed
+    sftp.commands.clear()
+    assert not configure.configure_network_config_file("rpi1", network_manager.rpi_config_file_path)
+    assert sftp.commands == ["ip -j addr show"]
+
+
+def test_rebooted_devices_are_waited_for_a_new_boot(monkeypatch, tmp_path):
+    sftp = FakeFileSFTP("auto eth0.100\niface eth0.100 inet static\naddress 192.168.100.2\n", up=False)
+    monkeypatch.setattr(network_manager, "open_ssh", FakeSwitch({1, 100}, {1: {100}}))
+    monkeypatch.setattr(network_manager, "open_sftp", sftp)
+    monkeypatch.setattr(network_manager, "network_snapshot_dir", tmp_path)
+    boot_ids = []
+    waited = []
+    monkeypatch.setattr(network_manager, "probe_rebooted", lambda ids: boot_ids.append(dict(ids)) or "rebooted")
+    monkeypatch.setattr(network_manager, "wait_until_ready",
+                        lambda data, devices, probes, **kwargs: waited.append((devices, probes)) or (devices, []))
+    devices = {"sw1": {"ip": "10.0.0.10"}, "rpi1": {"ip": "10.0.0.1", "switch1": "sw1", "port1": 1}}
+    params = {"rpi": {"rpi1": {"vlan": 100, "interface": "eth0", "ip": "192.168.100.2"}}}
+    ConfigureNetwork(devices, {"rpi": ["rpi1"]}, params, live_apply=False)
+    # The boot id is read before the reboot
+    assert sftp.commands == ["ip -j addr show", "reboot"]
+    assert boot_ids == [{"10.0.0.1": "4f1c1d0e-7d0b-4c55-9a57-1b2c3d4e5f60"}]
+    assert waited == [(["rpi1"], (network_manager.probe_ssh_banner, "rebooted", network_manager.probe_prompt))]
+
+
+def test_configure_and_deconfigure_restore_the_switch(monkeypatch, tmp_path):
+    switch = FakeSwitch({1, 100}, {1: {100}})
+    sftp = FakeFileSFTP("auto eth0.101\niface eth0.101 inet static\naddress 192.168.101.2\n")
+    monkeypatch.setattr(network_manager, "open_ssh", switch)
+    monkeypatch.setattr(network_manager, "open_sftp", sftp)
+    monkeypatch.setattr(network_manager, "network_snapshot_dir", tmp_path)
+    devices = {"sw1": {"ip": "10.0.0.10"}, "rpi1": {"ip": "10.0.0.1", "switch1": "sw1", "port1": 1}}
+    params = {"rpi": {"rpi1": {"vlan": 101, "interface": "eth0", "ip": "192.168.101.2"}}}
+    all_devices = {"rpi": ["rpi1"]}
+
+    configure = ConfigureNetwork(devices, all_devices, params, snapshot_id="lease1")
+    assert configure.snapshot["switches"]["sw1"] == {"vlans": [], "ports": {"1": []}}
+    assert configure.snapshot["devices"]["rpi1"] == sftp.content
+    assert switch.vlans == {1, 100, 101} and switch.ports == {1: {100, 101}}
+    # Another run on the stand has its own snapshot file
+    other = ConfigureNetwork(devices, all_devices, params)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [f"network_snapshot_{other.snapshot_id}.json", "network_snapshot_lease1.json"])
+
+    # The snapshot is read from the file of the run
+    DeconfigureNetwork(devices, all_devices, params, snapshot_id="lease1")
+    assert switch.batches[0] == ["terminal length 0", "show running-config"]
+    assert switch.batches[-1] == ["terminal length 0", "configure terminal", "no vlan 101", "interface ethernet 1/0/1",
+                                  "switchport mode trunk", "switchport trunk allowed vlan remove 101",
+                                  "exit", "exit"]
+    assert switch.vlans == {1, 100} and switch.ports == {1: {100}}
+    assert [path.name for path in tmp_path.iterdir()] == [f"network_snapshot_{other.snapshot_id}.json"]
+
+
+def test_unverified_switch_fails_the_setup(monkeypatch, tmp_path, caplog):
+    switch = FakeSwitch({1}, {})
+    switch.stuck_vlans = {101}
+    monkeypatch.setattr(network_manager, "open_ssh", switch)
+    monkeypatch.setattr(network_manager, "open_sftp", FakeFileSFTP("auto eth0.101\naddress 192.168.101.2\n"))
+    monkeypatch.setattr(network_manager, "network_snapshot_dir", tmp_path)
+    devices = {"sw1": {"ip": "10.0.0.10"}, "rpi1": {"ip": "10.0.0.1", "switch1": "sw1", "port1": 1}}
+    params = {"rpi": {"rpi1": {"vlan": 101, "interface": "eth0", "ip": "192.168.101.2"}}}
+    with pytest.raises(SystemExit, match="sw1"):
+        ConfigureNetwork(devices, {"rpi": ["rpi1"]}, params, snapshot_id="lease1")
+
+    # VLAN 101 cannot be deleted either
+    switch.vlans.add(101)
+    DeconfigureNetwork(devices, {"rpi": ["rpi1"]}, params, snapshot_id="lease1")
+    assert "not removed from switches - ['sw1']" in caplog.text
+
+
+def test_restore_etn_with_incomplete_snapshot_uses_defaults(monkeypatch):
+    sent = []
+
+    class FakeEtn:
+        def __init__(self, **device_data):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def send_shell_commands(self, commands, print_output=True):
+            sent.append(commands)
+            return ""
+
+    monkeypatch.setattr(network_manager, "open_ssh", FakeEtn)
+    params = {"etn": {"etn1": {"vlan": 100, "ip_port_a": "10.1.1.1", "ip_port_b": "10.1.2.1",
+                               "netmask_port_a": "255.255.255.0", "netmask_port_b": "255.255.255.0"}}}
+    # "show gbe a" was not parsed before the test
+    port = {"ip": "192.168.1.1", "subnet": "255.255.255.0", "vlan count": None, "vlan id": None}
+    snapshot = {"switches": {}, "devices": {"etn1": {"a": port, "b": port}}}
+    DeconfigureNetwork({"etn1": {"ip": "10.0.0.5"}}, {"etn": ["etn1"]}, params, snapshot=snapshot)
+    assert "gbe a vlan count off" in sent[0] and "gbe b vlan count off" in sent[0]
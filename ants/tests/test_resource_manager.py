@@ -0,0 +1,138 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from ants import resource_manager
+from ants.inventory import Inventory
+
+
+NETWORK_PARAMS = {
+    "rpi": {"rpi1": {"vlan": 100, "ip": "192.168.1.1"}, "rpi2": {"vlan": 101, "ip": "192.168.1.2"},
+            "rpi3": {"vlan": 102, "ip": "192.168.1.3"}, "rpi4": {"vlan": 103, "ip": "192.168.1.4"}},
+    "ssfp": {"ssfp1": {"vlan": 100}, "ssfp2": {"vlan": 101}},
+}
+DEVICES = {"rpi1": {"ip": "10.0.0.1", "switch1": "sw1", "port1": 1},
+           "rpi2": {"ip": "10.0.0.2", "switch1": "sw2", "port1": 1},
+           "rpi3": {"ip": "10.0.0.3", "switch1": "sw2", "port1": 2},
+           "rpi4": {"ip": "10.0.0.4", "switch1": "sw1", "port1": 2},
+           "ssfp1": {"ip": "10.0.0.5", "switch1": "sw1", "port1": 3},
+           "ssfp2": {"ip": "10.0.0.6", "switch1": "sw2", "port1": 3}}
+
+
+@pytest.fixture
+def manager():
+    inventory = Inventory({"lab": DEVICES}, NETWORK_PARAMS)
+    return resource_manager.ResourceManager(DEVICES, test_subnet="10.100.0.0/24", inventory=inventory)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time of the leases, moved by the test instead of sleeping"""
+    now = [1000.0]
+    monkeypatch.setattr(resource_manager, "time", SimpleNamespace(monotonic=lambda: now[0], sleep=time.sleep))
+    return now
+
+
+def test_leases_are_exclusive_and_expire(manager, clock):
+    first = manager.acquire("test1", {"rpi": 2, "ssfp": 1}, same_switch=True, ttl=60)
+    assert first.devices == {"rpi": ["rpi1", "rpi4"], "ssfp": ["ssfp1"]}
+    assert first.network_params["ssfp"] == {"ssfp1": {"vlan": 100}}
+    second = manager.acquire("test2", {"rpi": 2, "ssfp": 1}, same_switch=True)
+    assert second.devices == {"rpi": ["rpi2", "rpi3"], "ssfp": ["ssfp2"]}
+    assert manager.acquire("test3", {"rpi": 1}) is None
+    clock[0] += 60
+    assert manager.acquire("test3", {"rpi": 1}).devices == {"rpi": ["rpi1"]}
+
+
+def test_scheduler_runs_disjoint_tests_at_the_same_time(manager):
+    events = []
+    # a and b pass the barrier only when they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def run_test(test, lease):
+        events.append(("start", test["name"]))
+        if test["name"] in ("a", "b"):
+            barrier.wait()
+        events.append(("end", test["name"]))
+        return lease.device_list()
+
+    tests = [{"name": "a", "needs": {"rpi": 2, "ssfp": 1}, "same_switch": True},
+             {"name": "b", "needs": {"rpi": 2, "ssfp": 1}, "same_switch": True},
+             {"name": "c", "needs": {"rpi": 3}},
+             {"name": "d", "needs": {"etn": 1}}]
+    results = resource_manager.TestScheduler(manager).run(tests, run_test)
+    assert set(results["a"]).isdisjoint(results["b"])
+    # c needs devices of both a and b
+    assert events.index(("start", "c")) > max(events.index(("end", "a")), events.index(("end", "b")))
+    assert len(results["c"]) == 3
+    assert results["d"] is False
+    assert manager.leased_devices() == set()
+
+
+def test_scheduler_renews_leases_of_running_tests(manager, clock):
+    leased = []
+
+    def run_test(test, lease):
+        # The test runs longer than the TTL
+        for _ in range(2):
+            clock[0] += 40
+            renewed_until = clock[0] + 60
+            for _ in range(500):
+                if lease.expires_at >= renewed_until:
+                    break
+                time.sleep(0.01)
+        leased.append(manager.leased_devices())
+        return True
+
+    scheduler = resource_manager.TestScheduler(manager, ttl=60, renew_interval=0.01)
+    assert scheduler.run([{"name": "a", "needs": {"rpi": 1}}], run_test) == {"a": True}
+    assert leased == [{"rpi1"}]
+
+
+def test_scheduler_reports_tests_without_network(manager):
+    manager.index = resource_manager.AllocationIndex(vlan_range=(2, 2))
+    started = []
+
+    def run_test(test, lease):
+        started.append(test["name"])
+        return lease.vlan
+
+    tests = [{"name": "a", "needs": {"rpi": 1}, "allocate_network": True},
+             {"name": "b", "needs": {"rpi": 1}, "allocate_network": True}]
+    # There is one VLAN in the lab, b cannot start while a is running
+    assert resource_manager.TestScheduler(manager).run(tests, run_test) == {"a": 2, "b": False}
+    assert started == ["a"]
+    assert manager.leased_devices() == set()
+
+
+def test_vlan_and_ip_allocators():
+    vlans = resource_manager.VlanAllocator(2, 5)
+    assert vlans.reserve(3)
+    assert [vlans.allocate(), vlans.allocate(), vlans.allocate()] == [2, 4, 5]
+    with pytest.raises(resource_manager.ErrorInResourceManagerException):
+        vlans.allocate()
+    vlans.release(4)
+    assert vlans.allocate() == 4
+
+    pool = resource_manager.IpPool("10.0.0.0/30")
+    assert pool.reserve("10.0.0.1")
+    assert pool.allocate() == "10.0.0.2"
+    with pytest.raises(resource_manager.ErrorInResourceManagerException):
+        pool.allocate()
+    pool.release("10.0.0.1")
+    assert pool.allocate() == "10.0.0.1"
+
+
+def test_leases_get_unique_network_and_release_it(manager):
+    manager.index.reserve_vlan(["default"], 2)
+    first = manager.acquire("test1", {"rpi": 1, "ssfp": 1}, allocate_network=True)
+    second = manager.acquire("test2", {"rpi": 1}, allocate_network=True)
+    assert (first.vlan, second.vlan) == (3, 4)
+    assert first.network_params["rpi"]["rpi1"]["vlan"] == 3
+    assert NETWORK_PARAMS["rpi"]["rpi1"]["vlan"] == 100
+    assert first.network_params["rpi"]["rpi1"]["ip"] == "10.100.0.1"
+    assert [address for _, address in second.addresses] == ["10.100.0.2"]
+    manager.release(first)
+    assert manager.acquire("test3", {"rpi": 1}, allocate_network=True).vlan == 3
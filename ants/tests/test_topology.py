@@ -0,0 +1,42 @@
+import pytest
+
+from ants.topology import ErrorInTopologyException, Topology
+
+
+DEVICES = {
+    "rpi2": {"switch1": "sw1", "port1": 1},
+    "ssfp4": {"switch1": "sw3", "port1": 7, "switch2": "sw1", "port2": 2},
+    "etn1": {"switch1": "sw2", "port1": 5, "type": "etn"},
+    "sw1": {"uplinks": {"sw2": 24}},
+    "sw2": {"uplinks": {"sw1": 23}},
+}
+
+
+@pytest.fixture
+def topology():
+    return Topology.from_connection_data(DEVICES, {"rpi": ["rpi2"]})
+
+
+def test_device_types_and_switches(topology):
+    assert topology.device_type("rpi2") == "rpi"
+    assert topology.device_type("ssfp4") == "ssfp"
+    assert topology.devices_by_type["etn"] == ["etn1"]
+    assert topology.devices_on_switch("sw1") == {"rpi2": 1, "ssfp4": 2}
+    assert topology.shared_switches("rpi2", "ssfp4") == {"sw1"}
+    with pytest.raises(ErrorInTopologyException):
+        topology.device_type("rpi9")
+
+
+def test_vlan_ports(topology):
+    # ssfp4 is on sw1 too, so the path does not go through sw3
+    assert topology.vlan_ports("rpi2", "ssfp4") == [("sw1", 1), ("sw1", 2)]
+    assert topology.vlan_ports("rpi2", "etn1") == [("sw1", 1), ("sw1", 24), ("sw2", 23), ("sw2", 5)]
+    topology.add_device("rpi7", "rpi", [("sw9", 1)])
+    with pytest.raises(ErrorInTopologyException):
+        topology.vlan_ports("rpi2", "rpi7")
+
+
+def test_port_used_twice():
+    with pytest.raises(ErrorInTopologyException):
+        Topology.from_connection_data({"rpi1": {"switch1": "sw1", "port1": 1},
+                                       "rpi2": {"switch1": "sw1", "port1": 1}})
@@ -0,0 +1,155 @@
+"""
+Topology of the lab: devices, switches and the switch ports which connect them.
+
+The graph is compiled once from the connection data ("switch1"/"port1", "switch2"/"port2" of devices,
+"uplinks" {neighbour switch: port} of switches) into adjacency indexes,
+so the questions of the network manager and the resource manager are dictionary lookups.
+"""
+import re
+from collections import deque
+
+
+class ErrorInTopologyException(Exception):
+    pass
+
+
+class Topology:
+    def __init__(self):
+        # device -> type ("rpi", "ssfp", "etn", ...)
+        self.device_types = {}
+        # type -> [devices]
+        self.devices_by_type = {}
+        # device -> [(switch, port)]
+        self.device_ports = {}
+        # switch -> {device: port}
+        self.switch_devices = {}
+        # (switch, port) -> device
+        self.port_owners = {}
+        # switch -> {neighbour switch: port of the switch to the neighbour}
+        self.uplinks = {}
+        # switch -> set of neighbour switches
+        self._adjacency = {}
+        # (switch, switch) -> list of switches of the shortest path
+        self._paths = {}
+
+    @classmethod
+    def from_connection_data(cls, devices_connection_data: dict, devices_by_type: dict = None):
+        """
+        Compiles the topology.
+
+        :param devices_connection_data: dictionary {device: connection data}
+        :param devices_by_type: dictionary {type: [devices]}, e.g. the network params for test,
+                                the type of other devices is "type" from the connection data
+                                or the name without the number ("ssfp4" -> "ssfp")
+        """
+        topology = cls()
+        types = {device: device_type for device_type, devices in (devices_by_type or {}).items()
+                 for device in devices}
+        switches = {data[key] for data in devices_connection_data.values()
+                    for key in ("switch1", "switch2") if data.get(key)}
+        for switch in switches:
+            topology.add_switch(switch)
+        for name, data in devices_connection_data.items():
+            if name in switches:
+                for neighbour, port in (data.get("uplinks") or {}).items():
+                    topology.add_uplink(name, neighbour, port)
+                continue
+            ports = [(data[switch_key], data[port_key])
+                     for switch_key, port_key in (("switch1", "port1"), ("switch2", "port2"))
+                     if data.get(switch_key)]
+            topology.add_device(name, types.get(name) or data.get("type") or _type_from_name(name), ports)
+        return topology
+
+    def add_switch(self, switch: str):
+        self.switch_devices.setdefault(switch, {})
+        self.uplinks.setdefault(switch, {})
+        self._adjacency.setdefault(switch, set())
+
+    def add_device(self, device: str, device_type: str, ports: list):
+        self.device_types[device] = device_type
+        self.devices_by_type.setdefault(device_type, []).append(device)
+        self.device_ports[device] = []
+        for switch, port in ports:
+            self.add_switch(switch)
+            if (switch, port) in self.port_owners:
+                raise ErrorInTopologyException(
+                    f"Port {port} of {switch} is used by {self.port_owners[(switch, port)]} and {device}"
+                )
+            self.device_ports[device].append((switch, port))
+            self.switch_devices[switch][device] = port
+            self.port_owners[(switch, port)] = device
+
+    def add_uplink(self, switch: str, neighbour: str, port):
+        self.add_switch(switch)
+        self.add_switch(neighbour)
+        self.uplinks[switch][neighbour] = port
+        self._adjacency[switch].add(neighbour)
+        self._adjacency[neighbour].add(switch)
+        self._paths.clear()
+
+    def device_type(self, device: str) -> str:
+        try:
+            return self.device_types[device]
+        except KeyError:
+            raise ErrorInTopologyException(f"Unknown device: {device}")
+
+    def switches_of(self, device: str) -> list:
+        return [switch for switch, _ in self.device_ports.get(device, [])]
+
+    def devices_on_switch(self, switch: str) -> dict:
+        """Returns {device: port} of the devices connected to the switch"""
+        return self.switch_devices.get(switch, {})
+
+    def shared_switches(self, first: str, second: str) -> set:
+        return set(self.switches_of(first)) & set(self.switches_of(second))
+
+    def switch_path(self, source: str, target: str) -> list:
+        """Returns switches of the shortest path between two switches, None if they are not connected"""
+        key = (source, target)
+        if key not in self._paths:
+            previous = {source: None}
+            queue = deque([source])
+            while queue:
+                switch = queue.popleft()
+                if switch == target:
+                    break
+                for neighbour in self._adjacency.get(switch, ()):
+                    if neighbour not in previous:
+                        previous[neighbour] = switch
+                        queue.append(neighbour)
+            path = None
+            if target in previous:
+                path = [target]
+                while previous[path[-1]] is not None:
+                    path.append(previous[path[-1]])
+                path.reverse()
+            self._paths[key] = path
+        return self._paths[key]
+
+    def vlan_ports(self, first: str, second: str) -> list:
+        """
+        Returns (switch, port) pairs which must carry a VLAN to connect two devices:
+        ports of the devices and uplink ports of the switches between them.
+        """
+        best = None
+        for first_switch, first_port in self.device_ports.get(first, []):
+            for second_switch, second_port in self.device_ports.get(second, []):
+                path = self.switch_path(first_switch, second_switch)
+                if path is not None and (best is None or len(path) < len(best[0])):
+                    best = (path, (first_switch, first_port), (second_switch, second_port))
+        if best is None:
+            raise ErrorInTopologyException(f"There is no path between {first} and {second}")
+        path, first_end, second_end = best
+        ports = [first_end]
+        for switch, neighbour in zip(path, path[1:]):
+            for side, other in ((switch, neighbour), (neighbour, switch)):
+                port = self.uplinks[side].get(other)
+                if port is not None:
+                    ports.append((side, port))
+        ports.append(second_end)
+        return list(dict.fromkeys(ports))
+
+
+def _type_from_name(name: str) -> str:
+    match = re.match(r"[a-zA-Z]+", name)
+    return match.group().lower() if match else name